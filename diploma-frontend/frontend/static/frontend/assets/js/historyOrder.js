@@ -1,12 +1,16 @@
 var mix = {
 	methods: {
 		getHistoryOrder() {
-			this.getData("/api/orders")
+			const url = this.nextCursor
+				? `/api/orders?cursor=${encodeURIComponent(this.nextCursor)}`
+				: "/api/orders"
+			this.getData(url)
 				.then(data => {
 					console.log(data)
-					this.orders = data
+					this.orders = this.orders.concat(data.items)
+					this.nextCursor = data.nextCursor
 				}).catch(() => {
-				this.orders = []
+				this.nextCursor = null
 				console.warn('Ошибка при получении списка заказов')
 			})
 		}
@@ -17,6 +21,7 @@ var mix = {
 	data() {
 		return {
 			orders: [],
+			nextCursor: null,
 		}
 	}
-}
\ No newline at end of file
+}
@@ -17,14 +17,13 @@ var mix = {
 				year: this.year,
 				month: this.month,
 				code: this.code
-			}).then(() => {
-				alert('Успешная оплата')
+			}).then(({ data }) => {
 				this.number1 = ''
 				this.name = ''
 				this.year = ''
 				this.month = ''
 				this.code = ''
-				location.assign('/')
+				location.assign(`/progress-payment/?job=${data.jobId}`)
 			}).catch(() => {
 			 	console.warn('Ошибка при оплате')
 			})
@@ -26,6 +26,15 @@ var mix = {
                 console.warn('Ошибка при получении товара')
             })
         },
+        getReviews() {
+            const cursor = encodeURIComponent(this.product.reviewsNextCursor)
+            this.getData(`/api/product/${this.product.id}/reviews?cursor=${cursor}`).then(data => {
+                this.product.reviews = [...(this.product.reviews || []), ...data.items]
+                this.product.reviewsNextCursor = data.nextCursor
+            }).catch(() => {
+                console.warn('Ошибка при получении отзывов')
+            })
+        },
         submitReview () {
             this.postData(`/api/product/${this.product.id}/reviews`, {
                 author: this.review.author,
@@ -33,7 +42,9 @@ var mix = {
                 text: this.review.text,
                 rate: this.review.rate
             }).then(({data}) => {
-                this.product.reviews = data
+                this.product.reviews = [data.review, ...(this.product.reviews || [])]
+                this.product.reviewsCount = data.reviewsCount
+                this.product.rating = data.rating
                 alert('Отзыв опубликован')
                 this.review.author = ''
                 this.review.email = ''
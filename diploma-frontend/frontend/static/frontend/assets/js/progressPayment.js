@@ -0,0 +1,25 @@
+var mix = {
+	methods: {
+		getPaymentStatus() {
+			const jobId = new URLSearchParams(location.search).get('job')
+			if (!jobId) return
+			this.getData(`/api/payment-job/${jobId}`)
+				.then(data => {
+					if (data.status === 'paid') {
+						alert('Успешная оплата')
+						location.assign('/')
+					} else if (data.status === 'failed') {
+						alert(`Ошибка при оплате: ${data.error}`)
+						location.assign(`/orders/${data.orderId}/`)
+					} else {
+						setTimeout(this.getPaymentStatus, 1000)
+					}
+				}).catch(() => {
+				console.warn('Ошибка при получении статуса оплаты')
+			})
+		}
+	},
+	mounted() {
+		this.getPaymentStatus();
+	},
+}
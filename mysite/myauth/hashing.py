@@ -0,0 +1,118 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, get_hasher, identify_hasher, make_password
+from django.contrib.auth.models import User
+from rest_framework import status
+from rest_framework.response import Response
+
+_executor = None
+_slots = None
+_pool_lock = threading.Lock()
+
+
+class HashingPoolBusy(Exception):
+    """
+    Все потоки хеширования заняты и очередь заполнена
+    """
+
+
+def get_hashing_workers() -> int:
+    return getattr(settings, 'AUTH_HASHING_WORKERS', 2)
+
+
+def get_hashing_queue_size() -> int:
+    return getattr(settings, 'AUTH_HASHING_QUEUE_SIZE', 8)
+
+
+def get_hashing_retry_after() -> int:
+    return getattr(settings, 'AUTH_HASHING_RETRY_AFTER', 1)
+
+
+def _get_pool() -> tuple:
+    global _executor, _slots
+    with _pool_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_hashing_workers(), thread_name_prefix='hashing')
+            _slots = threading.BoundedSemaphore(get_hashing_workers() + get_hashing_queue_size())
+        return _executor, _slots
+
+
+def run_hashing(func, *args):
+    """
+    Выполняет хеширование в отдельном ограниченном пуле потоков (AUTH_HASHING_WORKERS),
+    чтобы всплеск входов не занимал процессор, нужный остальным запросам.
+    Если в работе и в очереди уже AUTH_HASHING_WORKERS + AUTH_HASHING_QUEUE_SIZE задач,
+    функция сразу выбрасывает HashingPoolBusy, не дожидаясь своей очереди
+    :param func:
+    :param args:
+    :return: результат func
+    """
+    executor, slots = _get_pool()
+    if not slots.acquire(blocking=False):
+        raise HashingPoolBusy
+    try:
+        future = executor.submit(func, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda done: slots.release())
+    return future.result()
+
+
+def password_needs_upgrade(encoded: str) -> bool:
+    """
+    Хеш нужно пересчитать, если он сделан не основным хешером (PASSWORD_HASHERS[0]) или с устаревшими параметрами
+    :param encoded:
+    :return:
+    """
+    preferred = get_hasher('default')
+    try:
+        hasher = identify_hasher(encoded)
+    except ValueError:
+        return False
+    return hasher.algorithm != preferred.algorithm or preferred.must_update(encoded)
+
+
+def _check_and_upgrade(raw_password: str, encoded: str) -> tuple:
+    if not check_password(raw_password, encoded):
+        return False, None
+    if password_needs_upgrade(encoded):
+        return True, make_password(raw_password)
+    return True, None
+
+
+def verify_password(user: User, raw_password: str) -> bool:
+    """
+    Проверяет пароль пользователя в пуле хеширования.
+    При успешной проверке хеш прозрачно пересчитывается основным хешером, если это нужно
+    :param user:
+    :param raw_password:
+    :return:
+    """
+    valid, upgraded = run_hashing(_check_and_upgrade, raw_password, user.password)
+    if upgraded is not None:
+        user.password = upgraded
+        user.save(update_fields=['password'])
+    return valid
+
+
+def get_busy_response() -> Response:
+    """
+    Ответ на запрос, для которого не нашлось места в пуле хеширования
+    :return:
+    """
+    message_error = {'error': 'Too many authentication requests, try again later'}
+    response = Response(data=message_error, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(get_hashing_retry_after())
+    return response
+
+
+def hash_password(raw_password: str) -> str:
+    """
+    Хеширует новый пароль в пуле хеширования
+    :param raw_password:
+    :return: хеш для User.password
+    """
+    return run_hashing(make_password, raw_password)
@@ -1,12 +1,15 @@
 import json
+from collections import Counter
 from typing import Optional
 
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db import transaction
 from django.http import QueryDict
 from rest_framework.request import Request
 
+from shopapp.baskets import claim_anonymous_basket, get_basket_store
 from shopapp.models import Basket, Order
+from shopapp.services import get_available_stock
 
 
 def get_user_data(data_request: QueryDict) -> Optional[dict]:
@@ -28,18 +31,53 @@ def get_user_data(data_request: QueryDict) -> Optional[dict]:
 
 def get_and_update_baskets_orders(user: User, request: Request) -> None:
     """
-    Функция после аутентификация пользователя проверяет анонимный токен и добавляет ему его анонимные basket и order
+    Функция после аутентификации пользователя проверяет анонимный токен и добавляет ему его анонимные basket и order.
+    Анонимная корзина (хранилище и строки Basket по токену) сливается с активной корзиной пользователя
+    в одной транзакции: количества по каждому продукту суммируются и ограничиваются доступным остатком.
+    Перенос захватывается в той же транзакции (claim_anonymous_basket), поэтому при входе из двух вкладок
+    корзину переносит только один запрос.
+    Количество запросов не зависит от размера корзины.
     :param user:
     :param request:
     :return:
     """
     token = request.session.get('user', None)
-    if token:
-        baskets_old = Basket.objects.filter(Q(archived=False) & Q(user_auth_user=user))
-        baskets_old.update(archived=True)
-        baskets = Basket.objects.filter(Q(archived=False) & Q(user=token))
-        if baskets:
-            baskets.update(user=None, user_auth_user=user)
-        orders = Order.objects.filter(user=token)
-        if orders:
-            orders.update(user=None, user_auth_user=user)
+    if not token:
+        return
+    store = get_basket_store(request, token)
+    with transaction.atomic():
+        if not claim_anonymous_basket(token):
+            return
+        anonymous_baskets = Basket.objects.filter(archived=False, user=token)
+        counts = Counter(store.get())
+        for product_pk, count in anonymous_baskets.values_list('product_id', 'count'):
+            counts[product_pk] += count
+        if counts:
+            user_baskets = {
+                basket.product_id: basket
+                for basket in Basket.objects.select_for_update().filter(
+                    archived=False,
+                    user_auth_user=user,
+                    product__in=counts
+                )
+            }
+            stock = get_available_stock(counts)
+            baskets_update, baskets_create = [], []
+            for product_pk, count in counts.items():
+                if product_pk not in stock:
+                    continue
+                basket = user_baskets.get(product_pk)
+                if basket is None:
+                    baskets_create.append(Basket(
+                        user_auth_user=user,
+                        product_id=product_pk,
+                        count=min(count, stock[product_pk])
+                    ))
+                else:
+                    basket.count = min(basket.count + count, stock[product_pk])
+                    baskets_update.append(basket)
+            Basket.objects.bulk_update(baskets_update, ['count'])
+            Basket.objects.bulk_create(baskets_create)
+            anonymous_baskets.delete()
+        Order.objects.filter(user=token).update(user=None, user_auth_user=user)
+    store.clear()
@@ -1,3 +1,127 @@
-from django.test import TestCase
+import json
+import threading
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from shopapp.baskets import ANONYMOUS_BASKET_SESSION_KEY
+from shopapp.models import Basket, BasketMergeClaim, Category, IdempotencyKey, Product, SubCategory
+from . import hashing
+from .services import get_and_update_baskets_orders
+
+
+class BasketMergeTestCase(TransactionTestCase):
+    """
+    Анонимная корзина переносится при входе ровно один раз, даже если вход идёт из нескольких вкладок
+    """
+    threads_count = 4
+    token = 'anonymous-token'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.stored = Product.objects.create(category=subcategory, title='stored', price=Decimal('10.00'), count=10)
+        self.line = Product.objects.create(category=subcategory, title='line', price=Decimal('10.00'), count=10)
+        Basket.objects.create(user=self.token, product=self.line, count=2)
+
+    def get_request(self):
+        request = RequestFactory().post('/api/sign-in')
+        request.session = {'user': self.token, ANONYMOUS_BASKET_SESSION_KEY: {str(self.stored.pk): 3}}
+        return request
+
+    def get_user_counts(self) -> dict:
+        return dict(Basket.objects.filter(archived=False, user_auth_user=self.user).values_list('product', 'count'))
+
+    def test_concurrent_logins_merge_once(self):
+        barrier = threading.Barrier(self.threads_count)
+        errors = []
+
+        def sign_in() -> None:
+            try:
+                request = self.get_request()
+                barrier.wait()
+                get_and_update_baskets_orders(self.user, request)
+            except Exception as exception:
+                errors.append(exception)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=sign_in) for _ in range(self.threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.get_user_counts(), {self.stored.pk: 3, self.line.pk: 2})
+        self.assertFalse(Basket.objects.filter(user=self.token).exists())
+        self.assertEqual(list(BasketMergeClaim.objects.values_list('token', flat=True)), [self.token])
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_failed_merge_releases_claim(self):
+        with mock.patch('myauth.services.get_available_stock', side_effect=RuntimeError('database is down')):
+            with self.assertRaises(RuntimeError):
+                get_and_update_baskets_orders(self.user, self.get_request())
+        self.assertEqual(self.get_user_counts(), {})
+        get_and_update_baskets_orders(self.user, self.get_request())
+        self.assertEqual(self.get_user_counts(), {self.stored.pk: 3, self.line.pk: 2})
+
+
+class HashingTestCase(TestCase):
+    """
+    Вход при занятом пуле хеширования получает 503 с Retry-After, устаревший хеш пароля пересчитывается при входе
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+
+    def sign_in(self, password: str = 'password'):
+        return self.client.post(
+            reverse('myauth:post_sign_in'),
+            json.dumps(dict(username='buyer', password=password)),
+            content_type='application/x-www-form-urlencoded'
+        )
+
+    @override_settings(AUTH_HASHING_WORKERS=1, AUTH_HASHING_QUEUE_SIZE=0, AUTH_HASHING_RETRY_AFTER=3)
+    def test_busy_pool(self):
+        started, release = threading.Event(), threading.Event()
+
+        def block() -> None:
+            started.set()
+            release.wait(10)
+
+        with mock.patch.object(hashing, '_executor', None), mock.patch.object(hashing, '_slots', None):
+            blocker = threading.Thread(target=hashing.run_hashing, args=(block,))
+            blocker.start()
+            started.wait(10)
+            try:
+                response = self.sign_in()
+            finally:
+                release.set()
+                blocker.join()
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '3')
+            # место в пуле освобождается колбэком future уже после возврата run_hashing
+            self.assertTrue(hashing._slots.acquire(timeout=10))
+            hashing._slots.release()
+            self.assertEqual(self.sign_in().status_code, 200)
+            hashing._executor.shutdown()
+
+    def test_hash_upgraded_on_login(self):
+        User.objects.filter(pk=self.user.pk).update(password=make_password('password', hasher='pbkdf2_sha1'))
+        self.assertEqual(self.sign_in('wrong').status_code, 400)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha1$'))
+        self.assertEqual(self.sign_in().status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha256$'))
+        self.assertTrue(self.user.check_password('password'))
+        upgraded = self.user.password
+        self.assertEqual(self.sign_in().status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.password, upgraded)
@@ -8,6 +8,7 @@ from rest_framework.views import APIView
 
 from .serializers import UserSerializer
 from myprofile.models import Profile
+from .hashing import HashingPoolBusy, get_busy_response, hash_password, verify_password
 from .services import get_user_data, get_and_update_baskets_orders
 
 
@@ -24,8 +25,12 @@ class RegisterUserAPIView(APIView):
             message_error = {'error': 'Incorrect data'}
             return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
         password = data.pop('password')
+        try:
+            password_hash = hash_password(password)
+        except HashingPoolBusy:
+            return get_busy_response()
         user = user_serializer.create(data)
-        user.set_password(password)
+        user.password = password_hash
         user.save()
         Profile.objects.create(user=user)
         get_and_update_baskets_orders(user, request)
@@ -47,7 +52,11 @@ class UserLogin(APIView):
         data = get_user_data(request.data)
         if data:
             user = get_object_or_404(self.model, username=data['username'])
-            if user.check_password(data['password']):
+            try:
+                password_valid = verify_password(user, data['password'])
+            except HashingPoolBusy:
+                return get_busy_response()
+            if password_valid:
                 get_and_update_baskets_orders(user, request)
                 login(request=request, user=user)
                 return Response(status=status.HTTP_200_OK)
@@ -6,6 +6,7 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from .models import Profile
 from .serializers import ProfileSerializer, UserPasswordSerializer
+from myauth.hashing import HashingPoolBusy, get_busy_response, hash_password, verify_password
 
 
 class ProfileAPIView(APIView):
@@ -66,15 +67,19 @@ class ChangePasswordAPIView(APIView):
             message_error = {'error': 'Authentication Error'}
             return Response(data=message_error, status=status.HTTP_404_NOT_FOUND)
         user = self.model.objects.get(pk=current_user.pk)
-        if not user.check_password(request.data['currentPassword']):
-            message_error = {'error': 'Incorrect current password'}
-            return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
-        data = dict(password=request.data['newPassword'])
-        user_password_serializer = self.serializer(data=data, instance=user)
-        if user_password_serializer.is_valid():
-            user.set_password(request.data['newPassword'])
-            user.save()
-            login(request=request, user=user)
-            return Response(status=status.HTTP_200_OK)
-        message_error = {'error': 'Incorrect new password'}
-        return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            if not verify_password(user, request.data['currentPassword']):
+                message_error = {'error': 'Incorrect current password'}
+                return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+            data = dict(password=request.data['newPassword'])
+            user_password_serializer = self.serializer(data=data, instance=user)
+            if not user_password_serializer.is_valid():
+                message_error = {'error': 'Incorrect new password'}
+                return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+            password_hash = hash_password(request.data['newPassword'])
+        except HashingPoolBusy:
+            return get_busy_response()
+        user.password = password_hash
+        user.save()
+        login(request=request, user=user)
+        return Response(status=status.HTTP_200_OK)
@@ -83,6 +83,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Сколько секунд ждать освобождения блокировки на запись (параллельные оплаты)
+        'OPTIONS': {'timeout': 20},
+        # Тестовая база в файле, а не в памяти: тесты конкурентной оплаты обращаются к ней из потоков
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
@@ -105,6 +109,23 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Первый хешер — основной: новые пароли хешируются им, а старые хеши (другим алгоритмом
+# или с устаревшим числом итераций) пересчитываются им при успешном входе (myauth/hashing.py).
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
+# Хеширование паролей (вход, регистрация, смена пароля) выполняется в отдельном пуле из AUTH_HASHING_WORKERS потоков.
+# Если в работе и в очереди уже AUTH_HASHING_WORKERS + AUTH_HASHING_QUEUE_SIZE паролей,
+# запрос сразу получает 503 с заголовком Retry-After (секунды).
+AUTH_HASHING_WORKERS = 2
+AUTH_HASHING_QUEUE_SIZE = 8
+AUTH_HASHING_RETRY_AFTER = 1
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/4.2/topics/i18n/
@@ -166,5 +187,66 @@ LOGGING = {
     }
 }
 
+# LocMemCache подходит только для одного процесса (runserver, один воркер): у каждого процесса свой кэш,
+# и сброс кэша каталога после изменения продукта виден только процессу, который его изменил.
+# При нескольких воркерах (gunicorn/uwsgi) нужен общий бэкенд, например:
+#     'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://127.0.0.1:6379'
+#     'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache', 'LOCATION': '127.0.0.1:11211'
+# (нужен пакет redis или pymemcache соответственно).
+# MAX_ENTRIES: одна страница каталога добавляет до 40 ключей (версии и короткие представления продуктов),
+# при стандартных 300 записях кэш вытеснял бы сам себя.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    }
+}
+# Время жизни закэшированных ответов /api/catalog (секунды).
+# Кэш сбрасывается раньше при изменении Product, Tag, ProductImage и Reviews.
+CATALOG_CACHE_TIMEOUT = 300
+# Время жизни закэшированных коротких представлений продуктов (секунды).
+PRODUCT_FRAGMENT_CACHE_TIMEOUT = 300
+
+# In-memory фасетный индекс каталога (shopapp/facets.py).
+# MAX_AGE — граница устаревания индекса в секундах: не реже этого индекс перестраивается целиком.
+# BACKGROUND_REBUILD — перестраивать в фоновом потоке (запросы тем временем обслуживает прежний индекс,
+# а до первой готовой сборки — SQL). False — перестраивать в потоке запроса.
+CATALOG_FACET_INDEX_ENABLED = True
+CATALOG_FACET_INDEX_MAX_AGE = 60
+CATALOG_FACET_INDEX_BACKGROUND_REBUILD = True
+
+# Хранилище корзины анонимного пользователя (shopapp/baskets.py):
+# shopapp.baskets.SessionBasketStore или shopapp.baskets.CacheBasketStore.
+# Строки Basket создаются только при оформлении заказа или при входе пользователя.
+ANONYMOUS_BASKET_STORE = 'shopapp.baskets.SessionBasketStore'
+# Время жизни корзины в CacheBasketStore (секунды).
+ANONYMOUS_BASKET_TIMEOUT = 60 * 60 * 24 * 14
+
+# Время жизни устаревших данных (секунды), которые удаляет команда collect_garbage (shopapp/cleanup.py):
+# активные корзины анонимных пользователей, архивные строки корзины без заказа, заказы в статусе created.
+STALE_ANONYMOUS_BASKET_TTL = 60 * 60 * 24 * 30
+STALE_ARCHIVED_BASKET_TTL = 60 * 60 * 24 * 30
+STALE_CREATED_ORDER_TTL = 60 * 60 * 24 * 30
+# Сколько секунд хранится ответ на запрос с заголовком Idempotency-Key (shopapp/idempotency.py)
+IDEMPOTENCY_KEY_TTL = 60 * 60 * 24
+# Через сколько секунд запрос с Idempotency-Key, так и не получивший ответа, считается брошенным
+# и повтор с тем же ключом выполняется заново вместо ответа 409
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+# Сколько секунд хранятся завершённые (paid, failed) задания очереди оплат
+STALE_PAYMENT_JOB_TTL = 60 * 60 * 24 * 30
+# Сколько секунд хранятся отметки о переносе анонимной корзины при входе (нужны, пока жив токен анонимного пользователя)
+STALE_BASKET_MERGE_CLAIM_TTL = 60 * 60 * 24
+GARBAGE_COLLECTION_CHUNK_SIZE = 1000
+
+# Сколько секунд подтверждённый заказ удерживает резерв продуктов (shopapp.services.reserve_order).
+# Истёкшие резервы снимает команда collect_garbage.
+STOCK_RESERVATION_TIMEOUT = 60 * 15
+
+# Потоки обработчика очереди оплат (shopapp/payments.py). 0 — оплата обрабатывается сразу в потоке запроса.
+# Задания, оставшиеся в очереди после перезапуска, разбирает команда process_payments.
+PAYMENT_WORKERS = 2
+# Через сколько секунд задание в статусе processing считается брошенным и захватывается обработчиком повторно
+PAYMENT_JOB_TIMEOUT = 60 * 5
+
 MEDIA_ROOT = BASE_DIR / 'uploads'
 MEDIA_URL = '/media/'
@@ -0,0 +1,130 @@
+from abc import ABC, abstractmethod
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils.module_loading import import_string
+from rest_framework.request import Request
+
+from shopapp.models import BasketMergeClaim
+
+ANONYMOUS_BASKET_SESSION_KEY = 'basket'
+ANONYMOUS_BASKET_CACHE_KEY = 'basket:anonymous:{token}'
+
+
+def get_anonymous_basket_timeout() -> int:
+    return getattr(settings, 'ANONYMOUS_BASKET_TIMEOUT', 60 * 60 * 24 * 14)
+
+
+class BasketStore(ABC):
+    """
+    Хранилище корзины анонимного пользователя: компактный словарь id продукта -> количество.
+    Строки Basket для анонимного пользователя создаются только при оформлении заказа
+    или при входе пользователя (persist_anonymous_basket в shopapp.services).
+    Реализация выбирается настройкой ANONYMOUS_BASKET_STORE.
+    """
+
+    def __init__(self, request: Request, token: str):
+        self.request = request
+        self.token = token
+
+    @abstractmethod
+    def load(self) -> dict:
+        """
+        :return: сохранённый словарь (ключи — строки)
+        """
+
+    @abstractmethod
+    def save(self, counts: dict) -> None:
+        """
+        :param counts: dict str(id продукта) -> количество
+        :return:
+        """
+
+    @abstractmethod
+    def clear(self) -> None:
+        """
+        Удаляет корзину из хранилища
+        :return:
+        """
+
+    def get(self) -> dict:
+        """
+        :return: dict id продукта -> количество
+        """
+        return {int(product_pk): int(count) for product_pk, count in self.load().items()}
+
+    def set(self, counts: dict) -> None:
+        """
+        Сохраняет корзину целиком (строки с количеством меньше 1 отбрасываются)
+        :param counts: dict id продукта -> количество
+        :return:
+        """
+        counts = {str(product_pk): int(count) for product_pk, count in counts.items() if count > 0}
+        if counts:
+            self.save(counts)
+        else:
+            self.clear()
+
+
+class SessionBasketStore(BasketStore):
+    """
+    Корзина хранится в сессии пользователя
+    """
+
+    def load(self) -> dict:
+        return self.request.session.get(ANONYMOUS_BASKET_SESSION_KEY, {})
+
+    def save(self, counts: dict) -> None:
+        self.request.session[ANONYMOUS_BASKET_SESSION_KEY] = counts
+
+    def clear(self) -> None:
+        self.request.session.pop(ANONYMOUS_BASKET_SESSION_KEY, None)
+
+
+class CacheBasketStore(BasketStore):
+    """
+    Корзина хранится в кэше по токену анонимного пользователя и живёт ANONYMOUS_BASKET_TIMEOUT секунд
+    """
+
+    @property
+    def cache_key(self) -> str:
+        return ANONYMOUS_BASKET_CACHE_KEY.format(token=self.token)
+
+    def load(self) -> dict:
+        return cache.get(self.cache_key, {})
+
+    def save(self, counts: dict) -> None:
+        cache.set(self.cache_key, counts, timeout=get_anonymous_basket_timeout())
+
+    def clear(self) -> None:
+        cache.delete(self.cache_key)
+
+
+def get_basket_store(request: Request, token: str) -> BasketStore:
+    """
+    Возвращает хранилище корзины анонимного пользователя
+    :param request:
+    :param token: токен анонимного пользователя (request.session['user'])
+    :return:
+    """
+    store_class = import_string(getattr(settings, 'ANONYMOUS_BASKET_STORE', 'shopapp.baskets.SessionBasketStore'))
+    return store_class(request, token)
+
+
+def claim_anonymous_basket(token: str) -> bool:
+    """
+    Захватывает корзину анонимного пользователя для переноса при входе записью BasketMergeClaim
+    с уникальным токеном (удаляется collect_garbage).
+    Вызывается внутри транзакции переноса: если перенос упадёт, захват откатится вместе с ним.
+    Если пользователь входит одновременно из двух вкладок (в том числе в разных процессах),
+    второй запрос дождётся коммита первого, получит IntegrityError, и корзину перенесёт только первый
+    :param token: токен анонимного пользователя
+    :return: True, если корзина захвачена этим запросом
+    """
+    try:
+        with transaction.atomic():
+            BasketMergeClaim.objects.create(token=token)
+    except IntegrityError:
+        return False
+    return True
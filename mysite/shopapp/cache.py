@@ -0,0 +1,239 @@
+import hashlib
+import json
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import QueryDict
+from django.utils.http import quote_etag
+
+CATALOG_CACHE_PARAMS = (
+    'filter[name]',
+    'filter[minPrice]',
+    'filter[maxPrice]',
+    'filter[freeDelivery]',
+    'filter[available]',
+    'category',
+    'tags[]',
+    'sort',
+    'sortType',
+    'currentPage',
+    'limit',
+    'cursor',
+)
+CATALOG_GENERATION_KEY = 'catalog:generation'
+CATALOG_HITS_KEY = 'catalog:hits'
+CATALOG_MISSES_KEY = 'catalog:misses'
+PRODUCT_VERSION_KEY = 'product:version:{product_pk}'
+PRODUCT_FRAGMENT_KEY = 'product:short:{product_pk}:{version}'
+PRODUCT_DETAIL_KEY = 'product:detail:{product_pk}:{version}'
+
+
+def get_catalog_cache_timeout() -> int:
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+
+def get_catalog_generation() -> int:
+    """
+    Текущее поколение кэша каталога. Смена поколения делает все ранее сохранённые ответы недоступными.
+    Поколение — время смены в наносекундах (time.time_ns()), как и версии продуктов:
+    после вытеснения счётчика из кэша новое поколение не совпадёт ни с одним из прежних,
+    и старые ответы каталога не вернутся
+    :return:
+    """
+    generation = cache.get(CATALOG_GENERATION_KEY)
+    if generation is None:
+        cache.add(CATALOG_GENERATION_KEY, time.time_ns(), timeout=None)
+        generation = cache.get(CATALOG_GENERATION_KEY)
+    return generation
+
+
+def _bump_catalog_generation() -> None:
+    cache.set(CATALOG_GENERATION_KEY, time.time_ns(), timeout=None)
+
+
+def invalidate_catalog_cache() -> None:
+    """
+    Сбрасывает кэш каталога после коммита текущей транзакции.
+    Вызывается при сохранении и удалении Product, Tag, ProductImage и Reviews.
+    :return:
+    """
+    transaction.on_commit(_bump_catalog_generation)
+
+
+def get_product_fragment_timeout() -> int:
+    return getattr(settings, 'PRODUCT_FRAGMENT_CACHE_TIMEOUT', 300)
+
+
+def _bump_product_versions(product_pks: list) -> None:
+    version = time.time_ns()
+    cache.set_many(
+        {PRODUCT_VERSION_KEY.format(product_pk=product_pk): version for product_pk in product_pks},
+        timeout=None
+    )
+
+
+def bump_product_versions(product_pks: list) -> None:
+    """
+    После коммита текущей транзакции меняет версии продуктов,
+    из-за чего их закэшированные короткие представления перестают использоваться.
+    Версия — время смены в наносекундах (time.time_ns()), поэтому по ней же определяется Last-Modified
+    :param product_pks:
+    :return:
+    """
+    product_pks = list(product_pks)
+    transaction.on_commit(lambda: _bump_product_versions(product_pks))
+
+
+def get_product_versions(product_pks: list) -> dict:
+    """
+    Возвращает текущие версии продуктов одним запросом get_many.
+    Продуктам без версии (новым или вытесненным из кэша) назначается новая версия — текущее время.
+    :param product_pks:
+    :return: dict id -> версия
+    """
+    version_keys = {product_pk: PRODUCT_VERSION_KEY.format(product_pk=product_pk) for product_pk in product_pks}
+    versions = cache.get_many(version_keys.values())
+    new_versions = {}
+    product_versions = {}
+    for product_pk, version_key in version_keys.items():
+        version = versions.get(version_key)
+        if version is None:
+            version = time.time_ns()
+            new_versions[version_key] = version
+        product_versions[product_pk] = version
+    if new_versions:
+        cache.set_many(new_versions, timeout=None)
+    return product_versions
+
+
+def get_product_fragments(product_pks: list) -> tuple:
+    """
+    Достаёт из кэша короткие представления продуктов (два запроса get_many независимо от количества продуктов)
+    :param product_pks:
+    :return: (dict id -> представление для найденных, dict id -> ключ для сохранения отсутствующих)
+    """
+    fragment_keys = {
+        product_pk: PRODUCT_FRAGMENT_KEY.format(product_pk=product_pk, version=version)
+        for product_pk, version in get_product_versions(product_pks).items()
+    }
+    cached = cache.get_many(fragment_keys.values())
+    fragments = {}
+    missing_keys = {}
+    for product_pk, fragment_key in fragment_keys.items():
+        if fragment_key in cached:
+            fragments[product_pk] = cached[fragment_key]
+        else:
+            missing_keys[product_pk] = fragment_key
+    return fragments, missing_keys
+
+
+def set_product_fragments(fragments: dict) -> None:
+    """
+    Сохраняет короткие представления продуктов в кэш
+    :param fragments: dict ключ -> представление
+    :return:
+    """
+    cache.set_many(fragments, timeout=get_product_fragment_timeout())
+
+
+def get_version_time(version: int) -> datetime:
+    """
+    Время смены версии продукта. Для версии, назначенной после вытеснения из кэша, это время назначения:
+    Last-Modified получится не раньше настоящего изменения, и условный запрос просто получит полный ответ
+    :param version:
+    :return:
+    """
+    return datetime.fromtimestamp(version / 10 ** 9, tz=timezone.utc)
+
+
+def get_product_detail_cache_key(product_pk: int, version: int) -> str:
+    return PRODUCT_DETAIL_KEY.format(product_pk=product_pk, version=version)
+
+
+def get_cached_product_detail(cache_key: str) -> Optional[dict]:
+    return cache.get(cache_key)
+
+
+def set_cached_product_detail(cache_key: str, data: dict, last_modified: datetime) -> dict:
+    """
+    Сохраняет полное представление продукта вместе с валидаторами для условных запросов:
+    сильным ETag (хэш содержимого) и Last-Modified
+    :param cache_key:
+    :param data: представление продукта
+    :param last_modified: время последнего изменения продукта, его отзывов или связанных данных
+    :return: dict(data=..., etag=..., last_modified=...)
+    """
+    content = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True)
+    detail = dict(
+        data=data,
+        etag=quote_etag(hashlib.md5(content.encode()).hexdigest()),
+        last_modified=int(last_modified.timestamp())
+    )
+    cache.set(cache_key, detail, timeout=get_product_fragment_timeout())
+    return detail
+
+
+def get_catalog_cache_key(data_request: QueryDict) -> str:
+    """
+    Формирует ключ кэша по нормализованным параметрам запроса каталога:
+    учитываются только параметры, которые читает каталог, пустые значения отбрасываются,
+    теги сортируются и не повторяются.
+    :param data_request:
+    :return:
+    """
+    params = []
+    for name in CATALOG_CACHE_PARAMS:
+        if name == 'tags[]':
+            values = sorted(set(value for value in data_request.getlist(name) if value))
+        else:
+            value = data_request.get(name)
+            values = [value] if value else []
+        if values:
+            params.append(f'{name}={",".join(values)}')
+    digest = hashlib.md5('&'.join(params).encode()).hexdigest()
+    return f'catalog:{get_catalog_generation()}:{digest}'
+
+
+def _incr_counter(key: str) -> None:
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+
+
+def get_cached_catalog(cache_key: str) -> Optional[dict]:
+    """
+    Возвращает сохранённый ответ каталога и учитывает попадание или промах в статистике
+    :param cache_key:
+    :return:
+    """
+    data = cache.get(cache_key)
+    _incr_counter(CATALOG_MISSES_KEY if data is None else CATALOG_HITS_KEY)
+    return data
+
+
+def set_cached_catalog(cache_key: str, data: dict) -> None:
+    cache.set(cache_key, data, timeout=get_catalog_cache_timeout())
+
+
+def get_catalog_cache_stats() -> dict:
+    """
+    Статистика кэша каталога
+    :return: dict(hits=..., misses=..., hitRate=..., generation=...)
+    """
+    stats = cache.get_many([CATALOG_HITS_KEY, CATALOG_MISSES_KEY])
+    hits = stats.get(CATALOG_HITS_KEY, 0)
+    misses = stats.get(CATALOG_MISSES_KEY, 0)
+    total = hits + misses
+    return dict(
+        hits=hits,
+        misses=misses,
+        hitRate=round(hits / total, 3) if total else 0,
+        generation=get_catalog_generation()
+    )
@@ -0,0 +1,128 @@
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import transaction
+from django.db.models import Q, QuerySet
+from django.utils import timezone
+
+from shopapp.idempotency import get_idempotency_key_ttl
+from shopapp.models import Basket, BasketMergeClaim, IdempotencyKey, Order, PaymentJob
+from shopapp.services import release_expired_reservations
+
+DAY = 60 * 60 * 24
+DB_SESSION_ENGINES = ('django.contrib.sessions.backends.db', 'django.contrib.sessions.backends.cached_db')
+
+
+def get_stale_data_ttl() -> dict:
+    """
+    Время жизни (секунды) данных, которые удаляет collect_garbage
+    :return: dict(anonymous_baskets=..., archived_baskets=..., created_orders=..., idempotency_keys=..., payment_jobs=...,
+    basket_merge_claims=...)
+    """
+    return dict(
+        anonymous_baskets=getattr(settings, 'STALE_ANONYMOUS_BASKET_TTL', 30 * DAY),
+        archived_baskets=getattr(settings, 'STALE_ARCHIVED_BASKET_TTL', 30 * DAY),
+        created_orders=getattr(settings, 'STALE_CREATED_ORDER_TTL', 30 * DAY),
+        idempotency_keys=get_idempotency_key_ttl(),
+        payment_jobs=getattr(settings, 'STALE_PAYMENT_JOB_TTL', 30 * DAY),
+        basket_merge_claims=getattr(settings, 'STALE_BASKET_MERGE_CLAIM_TTL', DAY),
+    )
+
+
+def delete_in_chunks(queryset: QuerySet, chunk_size: int, pause: float = 0) -> int:
+    """
+    Удаляет записи queryset пачками по chunk_size. Каждая пачка удаляется в отдельной короткой транзакции,
+    пачки выбираются по возрастанию pk (pk > последнего удалённого), поэтому блокировка на запись
+    никогда не держится дольше одной пачки.
+    :param queryset:
+    :param chunk_size:
+    :param pause: пауза между пачками (секунды), чтобы не мешать запросам сайта
+    :return: количество удалённых записей (без каскадно удалённых)
+    """
+    deleted = 0
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(chunk.order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            return deleted
+        with transaction.atomic():
+            # Условие queryset повторяется: строка, изменившаяся после выборки (заказ подтвердили), не удаляется
+            deleted += queryset.filter(pk__in=pks).delete()[1].get(queryset.model._meta.label, 0)
+        last_pk = pks[-1]
+        if pause and len(pks) == chunk_size:
+            time.sleep(pause)
+
+
+def collect_garbage(
+        now: Optional[datetime] = None,
+        ttl: Optional[dict] = None,
+        chunk_size: Optional[int] = None,
+        pause: float = 0
+) -> dict:
+    """
+    Снимает истёкшие резервы продуктов и удаляет устаревшие данные: активные корзины анонимных пользователей,
+    архивные строки корзины без заказа, заказы в статусе created (вместе со строками),
+    сохранённые ответы Idempotency-Key, завершённые задания очереди оплат, отметки о переносе корзин при входе
+    и истёкшие сессии.
+    Точка входа для планировщика (cron, celery beat) и команды collect_garbage.
+    :param now: момент, от которого отсчитывается время жизни (по умолчанию текущее время)
+    :param ttl: время жизни в секундах, ключи как у get_stale_data_ttl
+    :param chunk_size: размер пачки удаления (по умолчанию GARBAGE_COLLECTION_CHUNK_SIZE)
+    :param pause: пауза между пачками (секунды)
+    :return: dict вид данных -> количество удалённых записей
+    """
+    now = now or timezone.now()
+    ttl = {**get_stale_data_ttl(), **(ttl or {})}
+    chunk_size = chunk_size or getattr(settings, 'GARBAGE_COLLECTION_CHUNK_SIZE', 1000)
+
+    def expired(name: str) -> datetime:
+        return now - timedelta(seconds=ttl[name])
+
+    report = dict(
+        reservations=release_expired_reservations(now, chunk_size),
+        anonymous_baskets=delete_in_chunks(
+            Basket.objects.filter(
+                Q(archived=False) & Q(user__isnull=False) & Q(user_auth_user__isnull=True) &
+                Q(created_at__lt=expired('anonymous_baskets'))
+            ),
+            chunk_size,
+            pause
+        ),
+        archived_baskets=delete_in_chunks(
+            Basket.objects.filter(
+                Q(archived=True) & Q(order__isnull=True) & Q(created_at__lt=expired('archived_baskets'))
+            ),
+            chunk_size,
+            pause
+        ),
+        created_orders=delete_in_chunks(
+            Order.objects.filter(Q(status='created') & Q(createdAt__lt=expired('created_orders'))),
+            chunk_size,
+            pause
+        ),
+        idempotency_keys=delete_in_chunks(
+            IdempotencyKey.objects.filter(created_at__lt=expired('idempotency_keys')),
+            chunk_size,
+            pause
+        ),
+        payment_jobs=delete_in_chunks(
+            PaymentJob.objects.filter(
+                Q(status__in=('paid', 'failed')) & Q(finished_at__lt=expired('payment_jobs'))
+            ),
+            chunk_size,
+            pause
+        ),
+        basket_merge_claims=delete_in_chunks(
+            BasketMergeClaim.objects.filter(created_at__lt=expired('basket_merge_claims')),
+            chunk_size,
+            pause
+        ),
+        sessions=0,
+    )
+    if settings.SESSION_ENGINE in DB_SESSION_ENGINES:
+        report['sessions'] = delete_in_chunks(Session.objects.filter(expire_date__lt=now), chunk_size, pause)
+    return report
@@ -0,0 +1,497 @@
+import heapq
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from math import ceil
+from typing import Iterable, Optional
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.http import QueryDict
+
+log = logging.getLogger(__name__)
+
+SORT_KEYS = ('date', 'price', 'rating', 'reviews_count')
+PRICE_BUCKETS = 64
+COMPACTION_MIN_GARBAGE = 1024
+
+
+def get_facet_index_max_age() -> int:
+    """
+    Максимальный возраст индекса в секундах (граница устаревания).
+    Изменения продуктов, сделанные в этом же процессе, попадают в индекс сразу после коммита транзакции.
+    Изменения из других процессов и массовые UPDATE (остатки, рейтинг) видны не позже,
+    чем через это время плюс время фоновой перестройки.
+    :return:
+    """
+    return getattr(settings, 'CATALOG_FACET_INDEX_MAX_AGE', 60)
+
+
+def facet_index_enabled() -> bool:
+    return getattr(settings, 'CATALOG_FACET_INDEX_ENABLED', True)
+
+
+def facet_index_background_rebuild() -> bool:
+    return getattr(settings, 'CATALOG_FACET_INDEX_BACKGROUND_REBUILD', True)
+
+
+def to_bitset(positions: Iterable[int], size: int) -> int:
+    """
+    Собирает битовую маску (int) из списка позиций
+    :param positions:
+    :param size: количество позиций в индексе
+    :return:
+    """
+    data = bytearray((size + 7) // 8)
+    for position in positions:
+        data[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(data, 'little')
+
+
+def iter_bits(mask: int, size: int) -> Iterable[int]:
+    """
+    Перебирает позиции установленных битов маски по возрастанию.
+    Маска читается 64-битными словами, пустые слова пропускаются целиком
+    :param mask:
+    :param size: количество позиций в индексе
+    :return:
+    """
+    words = array('Q', mask.to_bytes(((size + 63) // 64) * 8, 'little'))
+    for word_index, word in enumerate(words):
+        base = word_index << 6
+        while word:
+            low = word & -word
+            yield base + low.bit_length() - 1
+            word ^= low
+
+
+class FacetSnapshot:
+    """
+    Данные фасетного индекса каталога.
+    Каждый продукт получает позицию, а фасеты (теги, подкатегории, категории, бесплатная доставка, наличие)
+    хранятся как битовые маски по этим позициям. Для каждого ключа сортировки хранится массив позиций,
+    отсортированный по (значение, id). Цены дополнительно разбиты на PRICE_BUCKETS диапазонов с готовой маской
+    на каждый диапазон, поэтому фильтр по цене собирается из готовых масок, а не из всех позиций диапазона.
+    """
+
+    def __init__(self, rows: list):
+        self.ids = array('q')
+        self.positions = {}
+        self.subcategory_of = array('q')
+        self.category_of = array('q')
+        self.tags_of = {}
+        self.keys = {key: array('d') for key in SORT_KEYS}
+        facets = dict(tags={}, subcategories={}, categories={})
+        free_delivery, available = [], []
+        for position, row in enumerate(rows):
+            self.ids.append(row['pk'])
+            self.positions[row['pk']] = position
+            self.subcategory_of.append(row['subcategory'])
+            self.category_of.append(row['category'])
+            if row['tags']:
+                self.tags_of[position] = row['tags']
+            for key in SORT_KEYS:
+                self.keys[key].append(row['keys'][key])
+            for tag_pk in row['tags']:
+                facets['tags'].setdefault(tag_pk, []).append(position)
+            facets['subcategories'].setdefault(row['subcategory'], []).append(position)
+            facets['categories'].setdefault(row['category'], []).append(position)
+            if row['free_delivery']:
+                free_delivery.append(position)
+            if row['available']:
+                available.append(position)
+        size = len(rows)
+        self.tags = {pk: to_bitset(positions, size) for pk, positions in facets['tags'].items()}
+        self.subcategories = {pk: to_bitset(positions, size) for pk, positions in facets['subcategories'].items()}
+        self.categories = {pk: to_bitset(positions, size) for pk, positions in facets['categories'].items()}
+        self.free_delivery = to_bitset(free_delivery, size)
+        self.available = to_bitset(available, size)
+        self.alive = (1 << size) - 1
+        self.orders = {key: array('q', sorted(range(size), key=self._sort_key(key))) for key in SORT_KEYS}
+        self._build_price_buckets()
+
+    def _build_price_buckets(self) -> None:
+        """
+        Делит продукты на PRICE_BUCKETS диапазонов цен примерно равного размера.
+        Диапазон j содержит цены [price_bounds[j], price_bounds[j + 1]), у первого нижней границы нет.
+        Для каждого диапазона хранятся маска и наименьшая/наибольшая цена, попадавшие в него
+        (после удаления продуктов границы не сужаются, поэтому проверка полного попадания остаётся верной)
+        :return:
+        """
+        order = self.orders['price']
+        prices = self.keys['price']
+        step = max(1, ceil(len(order) / PRICE_BUCKETS))
+        self.price_bounds = sorted({prices[order[index]] for index in range(step, len(order), step)})
+        self.price_bounds.insert(0, float('-inf'))
+        positions = [[] for _ in self.price_bounds]
+        self.price_ranges = [[float('inf'), float('-inf')] for _ in self.price_bounds]
+        for position in order:
+            bucket = self._price_bucket(prices[position])
+            positions[bucket].append(position)
+            self._extend_price_range(bucket, prices[position])
+        self.price_buckets = [to_bitset(bucket_positions, len(self.ids)) for bucket_positions in positions]
+
+    def _price_bucket(self, price: float) -> int:
+        return bisect_right(self.price_bounds, price) - 1
+
+    def _extend_price_range(self, bucket: int, price: float) -> None:
+        price_range = self.price_ranges[bucket]
+        price_range[0] = min(price_range[0], price)
+        price_range[1] = max(price_range[1], price)
+
+    def _sort_key(self, key: str):
+        values = self.keys[key]
+        ids = self.ids
+        return lambda position: (values[position], ids[position])
+
+    def _remove(self, product_pk: int) -> None:
+        position = self.positions.pop(product_pk, None)
+        if position is None:
+            return
+        bit = 1 << position
+        for key in SORT_KEYS:
+            order = self.orders[key]
+            index = bisect_left(order, self._sort_key(key)(position), key=self._sort_key(key))
+            del order[index]
+        for tag_pk in self.tags_of.pop(position, ()):
+            self.tags[tag_pk] &= ~bit
+        self.subcategories[self.subcategory_of[position]] &= ~bit
+        self.categories[self.category_of[position]] &= ~bit
+        self.price_buckets[self._price_bucket(self.keys['price'][position])] &= ~bit
+        self.free_delivery &= ~bit
+        self.available &= ~bit
+        self.alive &= ~bit
+
+    def _add(self, row: dict) -> None:
+        position = len(self.ids)
+        bit = 1 << position
+        self.ids.append(row['pk'])
+        self.positions[row['pk']] = position
+        self.subcategory_of.append(row['subcategory'])
+        self.category_of.append(row['category'])
+        for key in SORT_KEYS:
+            self.keys[key].append(row['keys'][key])
+            insort(self.orders[key], position, key=self._sort_key(key))
+        if row['tags']:
+            self.tags_of[position] = row['tags']
+        for tag_pk in row['tags']:
+            self.tags[tag_pk] = self.tags.get(tag_pk, 0) | bit
+        self.subcategories[row['subcategory']] = self.subcategories.get(row['subcategory'], 0) | bit
+        self.categories[row['category']] = self.categories.get(row['category'], 0) | bit
+        bucket = self._price_bucket(row['keys']['price'])
+        self.price_buckets[bucket] |= bit
+        self._extend_price_range(bucket, row['keys']['price'])
+        if row['free_delivery']:
+            self.free_delivery |= bit
+        if row['available']:
+            self.available |= bit
+        self.alive |= bit
+
+    def needs_compaction(self) -> bool:
+        """
+        Удалённый или изменённый продукт оставляет пустую позицию, а новая версия продукта добавляется в конец,
+        поэтому маски и массивы сортировки растут до следующей перестройки.
+        Когда пустых позиций больше, чем занятых (и больше COMPACTION_MIN_GARBAGE), снимок пора перестроить
+        :return:
+        """
+        garbage = len(self.ids) - len(self.positions)
+        return garbage > max(len(self.positions), COMPACTION_MIN_GARBAGE)
+
+    def update(self, rows: list, product_pks: set) -> None:
+        """
+        Заменяет в снимке указанные продукты строками rows (продукты без строки убираются)
+        :param rows: строки FacetIndex.load_rows(product_pks)
+        :param product_pks:
+        :return:
+        """
+        for product_pk in product_pks:
+            self._remove(product_pk)
+        for row in rows:
+            self._add(row)
+
+    def _price_mask(self, min_price: float, max_price: float) -> int:
+        """
+        Маска продуктов с ценой в [min_price, max_price].
+        Диапазоны цен, целиком попавшие в фильтр, берутся готовыми масками,
+        позиции перебираются только в (не больше чем двух) диапазонах на границах фильтра
+        :param min_price:
+        :param max_price:
+        :return:
+        """
+        order = self.orders['price']
+        sort_key = self._sort_key('price')
+        mask = 0
+        for bucket, (low, high) in zip(self.price_buckets, self.price_ranges):
+            if not bucket or high < min_price or low > max_price:
+                continue
+            if min_price <= low and high <= max_price:
+                mask |= bucket
+                continue
+            start = bisect_left(order, (max(min_price, low), float('-inf')), key=sort_key)
+            stop = bisect_right(order, (min(max_price, high), float('inf')), key=sort_key)
+            mask |= to_bitset(order[start:stop], len(self.ids))
+        return mask
+
+    def get_mask(self, data_request: QueryDict) -> int:
+        """
+        Пересекает маски фасетов по параметрам запроса каталога (те же параметры, что читает get_filter_param)
+        :param data_request:
+        :return:
+        """
+        mask = self.alive
+
+        filter_min_price = data_request.get('filter[minPrice]', None)
+        filter_max_price = data_request.get('filter[maxPrice]', None)
+        if filter_min_price and filter_max_price and (int(filter_max_price) >= int(filter_min_price)):
+            mask &= self._price_mask(float(filter_min_price), float(filter_max_price))
+
+        category = data_request.get('category', None)
+        if category and int(category) // 10e6:
+            mask &= self.categories.get(int(int(category) % 10e6), 0)
+        elif category:
+            mask &= self.subcategories.get(int(category), 0)
+
+        if data_request.get('filter[freeDelivery]', None) == 'true':
+            mask &= self.free_delivery
+
+        if data_request.get('filter[available]', None) == 'true':
+            mask &= self.available
+
+        tags_list = data_request.getlist('tags[]', None)
+        if tags_list and len(tags_list):
+            tags_mask = 0
+            for tag_pk in tags_list:
+                tags_mask |= self.tags.get(int(tag_pk), 0)
+            mask &= tags_mask
+
+        return mask
+
+    def query(self, data_request: QueryDict, sort: str, current_page, limit: int) -> dict:
+        """
+        Возвращает id продуктов запрошенной страницы каталога.
+        Номер страницы обрабатывается так же, как Paginator.get_page.
+        :param data_request:
+        :param sort: поле сортировки из SORT_KEYS, например '-date' или 'price'
+        :param current_page:
+        :param limit:
+        :return: dict(ids=[...], currentPage=..., lastPage=...)
+        """
+        mask = self.get_mask(data_request)
+        total = mask.bit_count()
+        last_page = max(1, ceil(total / limit))
+        try:
+            page = int(current_page)
+        except (TypeError, ValueError):
+            page = 1
+        if page < 1 or page > last_page:
+            page = last_page if page > 1 else 1
+
+        key = sort.lstrip('-')
+        descending = sort.startswith('-')
+        needed = min(page * limit, total)
+        size = len(self.ids)
+        if not needed:
+            selected = []
+        elif needed * size <= total * total:
+            # Маска плотная: проход по массиву сортировки находит нужные позиции
+            # примерно за needed * size / total шагов, это меньше, чем перебрать total битов маски
+            bits = mask.to_bytes((size + 7) // 8, 'little')
+            order = self.orders[key]
+            positions = reversed(order) if descending else order
+            selected = []
+            for position in positions:
+                if bits[position >> 3] >> (position & 7) & 1:
+                    selected.append(position)
+                    if len(selected) == needed:
+                        break
+        else:
+            # Маска разреженная: перебираются только её биты, первые needed выбираются по ключу сортировки
+            select = heapq.nlargest if descending else heapq.nsmallest
+            selected = select(needed, iter_bits(mask, size), key=self._sort_key(key))
+        ids = [self.ids[position] for position in selected[(page - 1) * limit:]]
+        return dict(ids=ids, currentPage=page, lastPage=last_page)
+
+
+class FacetIndex:
+    """
+    In-memory фасетный индекс каталога (один на процесс).
+    Запрос к каталогу сводится к пересечению масок снимка (FacetSnapshot) и проходу по массиву сортировки,
+    после чего продукты страницы загружаются одним запросом pk__in.
+    Изменённые продукты обновляются в текущем снимке инкрементально. Полная перестройка строит новый снимок
+    в фоновом потоке без блокировки и подменяет им текущий, поэтому запросы каталога её не ждут.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._built_at = None
+        self._dirty = set()
+        self._changed_during_rebuild = None
+        self._rebuild_thread = None
+
+    @classmethod
+    def load_rows(cls, product_pks: Optional[set] = None) -> list:
+        product_model = apps.get_model('shopapp', 'Product')
+        queryset = product_model.objects.order_by('pk')
+        tags_queryset = product_model.tags.through.objects.all()
+        if product_pks is not None:
+            queryset = queryset.filter(pk__in=product_pks)
+            tags_queryset = tags_queryset.filter(product_id__in=product_pks)
+        product_tags = {}
+        for product_pk, tag_pk in tags_queryset.values_list('product_id', 'tag_id').iterator():
+            product_tags.setdefault(product_pk, []).append(tag_pk)
+        rows = []
+        for row in queryset.values_list(
+                'pk',
+                'category_id',
+                'category__category_id',
+                'price',
+                'count',
+                'reserved',
+                'freeDelivery',
+                'date',
+                'rating',
+                'reviews_count'
+        ).iterator():
+            (product_pk, subcategory_pk, category_pk, price, count, reserved,
+             free_delivery, date, rating, reviews_count) = row
+            rows.append(dict(
+                pk=product_pk,
+                subcategory=subcategory_pk,
+                category=category_pk,
+                tags=tuple(product_tags.get(product_pk, ())),
+                free_delivery=free_delivery,
+                available=count > reserved,
+                keys=dict(
+                    date=date.timestamp(),
+                    price=float(price),
+                    rating=-1.0 if rating is None else float(rating),
+                    reviews_count=float(reviews_count)
+                )
+            ))
+        return rows
+
+    def rebuild(self) -> None:
+        """
+        Полностью перестраивает индекс в текущем потоке: новый снимок строится без блокировки
+        и подменяет текущий. Если перестройка уже идёт в другом потоке, ничего не делает
+        :return:
+        """
+        if self._begin_rebuild():
+            self._build()
+
+    def _begin_rebuild(self) -> bool:
+        with self._lock:
+            if self._changed_during_rebuild is not None:
+                return False
+            self._changed_during_rebuild = set()
+            return True
+
+    def _build(self) -> None:
+        try:
+            snapshot = FacetSnapshot(self.load_rows())
+        except Exception:
+            with self._lock:
+                self._changed_during_rebuild = None
+            raise
+        with self._lock:
+            # Продукты, изменённые, пока строился снимок, могли попасть в него в старом виде
+            product_pks = self._changed_during_rebuild | self._dirty
+            self._changed_during_rebuild = None
+            self._dirty.clear()
+            if product_pks:
+                snapshot.update(self.load_rows(product_pks), product_pks)
+            self._snapshot = snapshot
+            self._built_at = time.monotonic()
+
+    def _build_in_thread(self) -> None:
+        try:
+            self._build()
+        except Exception:
+            log.exception('Facet index rebuild failed')
+        finally:
+            connection.close()
+
+    def start_rebuild(self) -> None:
+        """
+        Запускает полную перестройку в фоновом потоке (если CATALOG_FACET_INDEX_BACKGROUND_REBUILD = False —
+        в текущем потоке). Пока она идёт, запросы обслуживает прежний снимок
+        :return:
+        """
+        if not facet_index_background_rebuild():
+            self.rebuild()
+        elif self._begin_rebuild():
+            self._rebuild_thread = threading.Thread(
+                target=self._build_in_thread,
+                name='facet-index',
+                daemon=True
+            )
+            self._rebuild_thread.start()
+
+    def refresh(self, product_pks: set) -> None:
+        """
+        Инкрементально обновляет в индексе указанные продукты (удалённые продукты убираются из индекса)
+        :param product_pks:
+        :return:
+        """
+        with self._lock:
+            if self._changed_during_rebuild is not None:
+                self._changed_during_rebuild.update(product_pks)
+            if self._snapshot is not None:
+                self._snapshot.update(self.load_rows(product_pks), product_pks)
+
+    def mark_dirty(self, product_pks: Iterable[int]) -> None:
+        with self._lock:
+            self._dirty.update(product_pks)
+            if self._changed_during_rebuild is not None:
+                self._changed_during_rebuild.update(product_pks)
+
+    def ensure_fresh(self) -> None:
+        """
+        Применяет накопленные изменения к текущему снимку и запускает перестройку,
+        если индекс старше CATALOG_FACET_INDEX_MAX_AGE, ещё не построен или его пора сжать
+        :return:
+        """
+        with self._lock:
+            stale = self._built_at is None or time.monotonic() - self._built_at > get_facet_index_max_age()
+            stale = stale or (self._snapshot is not None and self._snapshot.needs_compaction())
+            if self._snapshot is not None and self._dirty:
+                product_pks = set(self._dirty)
+                self._dirty.clear()
+                self._snapshot.update(self.load_rows(product_pks), product_pks)
+        if stale:
+            self.start_rebuild()
+
+    def query(self, data_request: QueryDict, sort: str, current_page, limit: int) -> Optional[dict]:
+        """
+        Возвращает id продуктов запрошенной страницы каталога
+        :param data_request:
+        :param sort: поле сортировки, например '-date' или 'price'
+        :param current_page:
+        :param limit:
+        :return: dict(ids=[...], currentPage=..., lastPage=...) или None, если первый снимок ещё строится
+        или сортировка не по полю из SORT_KEYS (тогда страницу выбирает SQL)
+        """
+        if sort.lstrip('-') not in SORT_KEYS:
+            return None
+        self.ensure_fresh()
+        with self._lock:
+            if self._snapshot is None:
+                return None
+            return self._snapshot.query(data_request, sort, current_page, limit)
+
+
+catalog_facet_index = FacetIndex()
+
+
+def mark_products_changed(product_pks: Iterable[int]) -> None:
+    """
+    Помечает продукты для инкрементального обновления фасетного индекса после коммита транзакции
+    :param product_pks:
+    :return:
+    """
+    product_pks = list(product_pks)
+    transaction.on_commit(lambda: catalog_facet_index.mark_dirty(product_pks))
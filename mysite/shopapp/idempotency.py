@@ -0,0 +1,105 @@
+import hashlib
+from datetime import timedelta
+from functools import wraps
+from typing import Optional
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from shopapp.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_REPLAYED_HEADER = 'Idempotent-Replayed'
+
+
+def get_idempotency_key_ttl() -> int:
+    return getattr(settings, 'IDEMPOTENCY_KEY_TTL', 60 * 60 * 24)
+
+
+def get_idempotency_lock_timeout() -> int:
+    return getattr(settings, 'IDEMPOTENCY_LOCK_TIMEOUT', 60)
+
+
+def get_idempotency_digest(request: Request, key: str) -> Optional[str]:
+    """
+    Ключ записи: один и тот же Idempotency-Key разных пользователей или разных эндпоинтов не пересекается
+    :param request:
+    :param key: значение заголовка Idempotency-Key
+    :return: sha256 (hex) или None, если у анонимного пользователя ещё нет токена
+    и запрос не с чем связать (повтор такого запроса тоже придёт без токена)
+    """
+    if request.user.is_authenticated:
+        owner = f'user:{request.user.pk}'
+    elif request.session.get('user'):
+        owner = f"token:{request.session['user']}"
+    else:
+        return None
+    return hashlib.sha256(f'{owner}:{request.method}:{request.path}:{key}'.encode()).hexdigest()
+
+
+def take_over_abandoned_key(record: IdempotencyKey) -> bool:
+    """
+    Запись без ответа старше IDEMPOTENCY_LOCK_TIMEOUT считается брошенной (процесс упал посреди запроса).
+    Её захватывает один повтор: условный UPDATE продлевает created_at, только если запись всё ещё та же
+    :param record:
+    :return: True, если запись захвачена и запрос можно выполнить заново
+    """
+    now = timezone.now()
+    if record.created_at > now - timedelta(seconds=get_idempotency_lock_timeout()):
+        return False
+    return bool(IdempotencyKey.objects.filter(
+        pk=record.pk,
+        status_code__isnull=True,
+        created_at=record.created_at
+    ).update(created_at=now))
+
+
+def idempotent(view_method):
+    """
+    Декоратор метода APIView: если в запросе есть заголовок Idempotency-Key, ответ сохраняется,
+    а повтор запроса с тем же ключом получает сохранённый ответ без повторного выполнения.
+    Пока первый запрос выполняется, повтор получает 409; если запрос не завершился
+    за IDEMPOTENCY_LOCK_TIMEOUT секунд, повтор выполняет его заново. Ответы 5xx не сохраняются.
+    Без заголовка (и у анонимного пользователя без токена) метод выполняется как обычно,
+    без обращений к таблице ключей.
+    :param view_method:
+    :return:
+    """
+
+    @wraps(view_method)
+    def wrapper(self, request: Request, *args, **kwargs) -> Response:
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        digest = get_idempotency_digest(request, key) if key else None
+        if digest is None:
+            return view_method(self, request, *args, **kwargs)
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(key=digest)
+        except IntegrityError:
+            record = IdempotencyKey.objects.filter(key=digest).first()
+            if record is None or (record.status_code is None and not take_over_abandoned_key(record)):
+                message_error = {'error': 'Request with this Idempotency-Key is in progress'}
+                return Response(data=message_error, status=status.HTTP_409_CONFLICT)
+            if record.status_code is not None:
+                response = Response(data=record.response, status=record.status_code)
+                response[IDEMPOTENCY_REPLAYED_HEADER] = 'true'
+                return response
+        try:
+            response = view_method(self, request, *args, **kwargs)
+        except Exception:
+            record.delete()
+            raise
+        if response.status_code >= 500:
+            record.delete()
+        else:
+            IdempotencyKey.objects.filter(pk=record.pk).update(
+                status_code=response.status_code,
+                response=response.data
+            )
+        return response
+
+    return wrapper
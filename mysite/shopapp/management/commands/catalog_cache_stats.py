@@ -0,0 +1,14 @@
+from django.core.management import BaseCommand
+
+from shopapp.cache import get_catalog_cache_stats
+
+
+class Command(BaseCommand):
+    """
+    Выведет статистику кэша ответов /api/catalog (попадания, промахи, текущее поколение).
+    """
+
+    def handle(self, *args, **options):
+        stats = get_catalog_cache_stats()
+        for name, value in stats.items():
+            print(f'{name}: {value}')
@@ -0,0 +1,35 @@
+from django.core.management import BaseCommand
+
+from shopapp.cleanup import collect_garbage, get_stale_data_ttl
+
+
+class Command(BaseCommand):
+    """
+    Снимет истёкшие резервы продуктов и удалит устаревшие данные: корзины анонимных пользователей,
+    архивные строки корзины без заказа, неподтверждённые заказы (статус created),
+    сохранённые ответы Idempotency-Key, завершённые задания очереди оплат, отметки о переносе корзин при входе
+    и истёкшие сессии.
+    Время жизни берётся из настроек STALE_*_TTL, его можно переопределить параметрами (в днях).
+    Данные удаляются пачками по --chunk-size, каждая пачка в отдельной транзакции.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--anonymous-baskets-days', type=float, default=None)
+        parser.add_argument('--archived-baskets-days', type=float, default=None)
+        parser.add_argument('--created-orders-days', type=float, default=None)
+        parser.add_argument('--idempotency-keys-days', type=float, default=None)
+        parser.add_argument('--payment-jobs-days', type=float, default=None)
+        parser.add_argument('--basket-merge-claims-days', type=float, default=None)
+        parser.add_argument('--chunk-size', type=int, default=None)
+        parser.add_argument('--pause', type=float, default=0, help='seconds between chunks')
+
+    def handle(self, *args, **options):
+        ttl = get_stale_data_ttl()
+        for name in ttl:
+            days = options[f'{name}_days']
+            if days is not None:
+                ttl[name] = days * 60 * 60 * 24
+        report = collect_garbage(ttl=ttl, chunk_size=options['chunk_size'], pause=options['pause'])
+        for name, value in report.items():
+            print(f'{name} deleted: {value}')
+        print('ok')
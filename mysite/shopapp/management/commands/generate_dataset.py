@@ -0,0 +1,231 @@
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, FloatField, OuterRef, Subquery, Sum
+from django.db.models.functions import Cast, Coalesce, Round
+from django.utils import timezone
+
+from myprofile.models import Profile
+from shopapp.cache import invalidate_catalog_cache
+from shopapp.models import Category, SubCategory, Product, Tag, ProductImage, Reviews, Basket, Order
+from shopapp.search import rebuild_search_index
+from shopapp.services import snapshot_basket_lines
+
+
+class Command(BaseCommand):
+    """
+    Сгенерирует синтетический набор данных для нагрузочного тестирования:
+     категории, подкатегории, теги, продукты с изображениями и отзывами, пользователей, корзины и заказы.
+    Данные вставляются пачками через bulk_create, производные поля (рейтинг, количество отзывов, сумма заказа)
+    пересчитываются одним UPDATE после вставки. При одинаковом --seed генерируются одинаковые данные.
+    Пароль всех сгенерированных пользователей — значение --password.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--subcategories', type=int, default=50)
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--tags', type=int, default=100)
+        parser.add_argument('--images', type=int, default=1, help='images per product')
+        parser.add_argument('--reviews', type=int, default=5, help='maximum reviews per product')
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--baskets', type=int, default=1000, help='active basket lines')
+        parser.add_argument('--orders', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--password', default='dataset-password')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.chunk_size = options['chunk_size']
+        self.prefix = f"gen{options['seed']}"
+        if Category.objects.filter(title=f'{self.prefix}-category-1').exists():
+            print(f'**** A dataset with seed {options["seed"]} has already been generated ****')
+            return
+        started = time.monotonic()
+        with transaction.atomic():
+            subcategory_pks = self.create_categories(options['categories'], options['subcategories'])
+            tag_pks = self.create_tags(options['tags'])
+            product_pks = self.create_products(options['products'], subcategory_pks, tag_pks, options['images'])
+            self.create_reviews(product_pks, options['reviews'])
+            self.update_products_rating(product_pks)
+            user_pks = self.create_users(options['users'], options['password'])
+            self.create_baskets(options['baskets'], user_pks, product_pks)
+            self.create_orders(options['orders'], user_pks, product_pks)
+            indexed = rebuild_search_index()
+            invalidate_catalog_cache()
+        print(f'products indexed: {indexed}')
+        print(f'ok ({time.monotonic() - started:.1f}s)')
+
+    def bulk_create(self, model, objects) -> list:
+        """
+        Вставляет объекты пачками по --chunk-size и возвращает их id
+        :param model:
+        :param objects: итератор объектов
+        :return:
+        """
+        pks = []
+        chunk = []
+        for obj in objects:
+            chunk.append(obj)
+            if len(chunk) >= self.chunk_size:
+                pks.extend(obj.pk for obj in model.objects.bulk_create(chunk))
+                chunk = []
+        if chunk:
+            pks.extend(obj.pk for obj in model.objects.bulk_create(chunk))
+        return pks
+
+    def create_categories(self, categories_count: int, subcategories_count: int) -> list:
+        category_pks = self.bulk_create(Category, (
+            Category(title=f'{self.prefix}-category-{i}') for i in range(1, categories_count + 1)
+        ))
+        subcategory_pks = self.bulk_create(SubCategory, (
+            SubCategory(title=f'{self.prefix}-subcategory-{i}', category_id=self.random.choice(category_pks))
+            for i in range(1, subcategories_count + 1)
+        ))
+        print(f'categories: {len(category_pks)}, subcategories: {len(subcategory_pks)}')
+        return subcategory_pks
+
+    def create_tags(self, tags_count: int) -> list:
+        tag_pks = self.bulk_create(Tag, (Tag(name=f'{self.prefix}-tag-{i}') for i in range(1, tags_count + 1)))
+        print(f'tags: {len(tag_pks)}')
+        return tag_pks
+
+    def generate_product(self, number: int, subcategory_pks: list) -> Product:
+        price = Decimal(self.random.randint(100, 300000)) / 100
+        product = Product(
+            category_id=self.random.choice(subcategory_pks),
+            price=price,
+            count=self.random.randint(0, 50),
+            title=f'{self.prefix}-product-{number}',
+            description=f'generated product {number}',
+            fullDescription=f'generated product {number} for load testing',
+            freeDelivery=self.random.random() < 0.3,
+            salePrice=None
+        )
+        if self.random.random() < 0.1:
+            today = timezone.now()
+            product.discount = Decimal(self.random.randint(5, 50))
+            product.dateFrom = today - timedelta(days=self.random.randint(0, 10))
+            product.dateTo = today + timedelta(days=self.random.randint(1, 30))
+            product.salePrice = round((price - (price * product.discount) / 100), 1)
+        return product
+
+    def create_products(self, products_count: int, subcategory_pks: list, tag_pks: list, images: int) -> list:
+        product_pks = self.bulk_create(Product, (
+            self.generate_product(i, subcategory_pks) for i in range(1, products_count + 1)
+        ))
+        tags_through = Product.tags.through
+        if tag_pks:
+            self.bulk_create(tags_through, (
+                tags_through(product_id=product_pk, tag_id=tag_pk)
+                for product_pk in product_pks
+                for tag_pk in self.random.sample(tag_pks, k=min(len(tag_pks), self.random.randint(0, 3)))
+            ))
+        self.bulk_create(ProductImage, (
+            ProductImage(product_id=product_pk, image='product/no_image/noimg.jpg')
+            for product_pk in product_pks
+            for _ in range(images)
+        ))
+        print(f'products: {len(product_pks)}')
+        return product_pks
+
+    def create_reviews(self, product_pks: list, max_reviews: int) -> None:
+        reviews_pks = self.bulk_create(Reviews, (
+            Reviews(
+                author=f'author{i}',
+                email=f'author{i}@example.com',
+                product_review_id=product_pk,
+                text='Product received',
+                rate=self.random.randint(1, 5)
+            )
+            for product_pk in product_pks
+            for i in range(self.random.randint(0, max_reviews))
+        ))
+        print(f'reviews: {len(reviews_pks)}')
+
+    @classmethod
+    def update_products_rating(cls, product_pks: list) -> None:
+        """
+        Пересчитывает reviews_count, rating_sum, rating_count и rating сгенерированных продуктов одним UPDATE
+        :param product_pks:
+        :return:
+        """
+        reviews = Reviews.objects.filter(product_review=OuterRef('pk')).order_by().values('product_review')
+        rated_reviews = reviews.filter(rate__isnull=False)
+        products = Product.objects.filter(pk__gte=min(product_pks, default=0))
+        products.update(
+            reviews_count=Coalesce(Subquery(reviews.annotate(total=Count('pk')).values('total')), 0),
+            rating_sum=Coalesce(Subquery(rated_reviews.annotate(total=Sum('rate')).values('total')), 0),
+            rating_count=Coalesce(Subquery(rated_reviews.annotate(total=Count('pk')).values('total')), 0),
+        )
+        products.filter(rating_count__gt=0).update(
+            rating=Round(Cast('rating_sum', FloatField()) / F('rating_count'), 1)
+        )
+
+    def create_users(self, users_count: int, password: str) -> list:
+        password_hash = make_password(password)
+        user_pks = self.bulk_create(User, (
+            User(username=f'{self.prefix}-user-{i}', first_name=f'User {i}', password=password_hash)
+            for i in range(1, users_count + 1)
+        ))
+        self.bulk_create(Profile, (Profile(user_id=user_pk) for user_pk in user_pks))
+        print(f'users: {len(user_pks)}')
+        return user_pks
+
+    def create_baskets(self, baskets_count: int, user_pks: list, product_pks: list) -> None:
+        if not user_pks or not product_pks:
+            return
+        lines = {(self.random.choice(user_pks), self.random.choice(product_pks)) for _ in range(baskets_count)}
+        baskets_pks = self.bulk_create(Basket, (
+            Basket(
+                user_auth_user_id=user_pk,
+                product_id=product_pk,
+                count=self.random.randint(1, 5)
+            )
+            for user_pk, product_pk in sorted(lines)
+        ))
+        print(f'baskets: {len(baskets_pks)}')
+
+    def create_orders(self, orders_count: int, user_pks: list, product_pks: list) -> None:
+        if not user_pks or not product_pks:
+            return
+        order_users = [self.random.choice(user_pks) for _ in range(orders_count)]
+        order_pks = self.bulk_create(Order, (
+            Order(
+                user_auth_user_id=user_pk,
+                fullName=f'User {user_pk}',
+                status=self.random.choice(['created', 'confirmed', 'paid'])
+            )
+            for user_pk in order_users
+        ))
+        self.bulk_create(Basket, (
+            Basket(
+                user_auth_user_id=user_pk,
+                order_id=order_pk,
+                archived=True,
+                product_id=self.random.choice(product_pks),
+                count=self.random.randint(1, 5)
+            )
+            for order_pk, user_pk in zip(order_pks, order_users)
+            for _ in range(self.random.randint(1, 5))
+        ))
+        snapshot_basket_lines(Basket.objects.filter(order_id__gte=min(order_pks, default=0)))
+        total_cost = (
+            Basket.objects.filter(order=OuterRef('pk')).
+            order_by().
+            values('order').
+            annotate(total=Sum(ExpressionWrapper(
+                F('count') * F('price'),
+                output_field=DecimalField(max_digits=10, decimal_places=2)
+            ))).
+            values('total')
+        )
+        Order.objects.filter(pk__gte=min(order_pks, default=0)).update(totalCost=Coalesce(Subquery(total_cost), 0))
+        print(f'orders: {len(order_pks)}')
@@ -0,0 +1,16 @@
+from django.core.management import BaseCommand
+
+from shopapp.payments import process_payment_jobs
+
+
+class Command(BaseCommand):
+    """
+    Обработает все задания очереди оплат в статусе queued (например, оставшиеся после перезапуска сервера)
+    и брошенные задания в статусе processing, которые начали обрабатываться раньше PAYMENT_JOB_TIMEOUT секунд назад.
+    Можно запускать отдельным процессом-обработчиком по расписанию.
+    """
+
+    def handle(self, *args, **options):
+        processed = process_payment_jobs()
+        print(f'payment jobs processed: {processed}')
+        print('ok')
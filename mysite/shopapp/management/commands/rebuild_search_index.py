@@ -0,0 +1,19 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from shopapp.search import rebuild_search_index, search_index_available
+
+
+class Command(BaseCommand):
+    """
+    Перестроит полнотекстовый поисковый индекс продуктов (title, description, fullDescription).
+    """
+
+    def handle(self, *args, **options):
+        if not search_index_available():
+            print('**** Full-text search index is only available for SQLite ****')
+            return
+        with transaction.atomic():
+            count = rebuild_search_index()
+        print(f'products indexed: {count}')
+        print('ok')
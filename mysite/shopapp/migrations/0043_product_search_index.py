@@ -0,0 +1,31 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS shopapp_product_fts '
+        'USING fts5(title, description, fullDescription, tokenize="unicode61")'
+    )
+    schema_editor.execute(
+        'INSERT INTO shopapp_product_fts (rowid, title, description, fullDescription) '
+        'SELECT id, title, COALESCE(description, \'\'), COALESCE("fullDescription", \'\') FROM shopapp_product'
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS shopapp_product_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0042_alter_order_totalcost'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
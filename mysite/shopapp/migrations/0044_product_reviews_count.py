@@ -0,0 +1,34 @@
+# Generated by Django 4.2.6 on 2026-10-18 02:51
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_reviews_count(apps, schema_editor):
+    Product = apps.get_model('shopapp', 'Product')
+    Reviews = apps.get_model('shopapp', 'Reviews')
+    reviews_count = (
+        Reviews.objects.filter(product_review=OuterRef('pk')).
+        order_by().
+        values('product_review').
+        annotate(total=Count('pk')).
+        values('total')
+    )
+    Product.objects.update(reviews_count=Coalesce(Subquery(reviews_count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0043_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='reviews_count',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(fill_reviews_count, migrations.RunPython.noop),
+    ]
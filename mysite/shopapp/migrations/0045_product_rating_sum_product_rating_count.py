@@ -0,0 +1,40 @@
+# Generated by Django 4.2.6 on 2026-10-18 02:51
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_rating_sum_count(apps, schema_editor):
+    Product = apps.get_model('shopapp', 'Product')
+    Reviews = apps.get_model('shopapp', 'Reviews')
+    rated_reviews = (
+        Reviews.objects.filter(product_review=OuterRef('pk'), rate__isnull=False).
+        order_by().
+        values('product_review')
+    )
+    Product.objects.update(
+        rating_sum=Coalesce(Subquery(rated_reviews.annotate(total=Sum('rate')).values('total')), 0),
+        rating_count=Coalesce(Subquery(rated_reviews.annotate(total=Count('pk')).values('total')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0044_product_reviews_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_rating_sum_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.6 on 2026-10-18 03:04
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_duplicate_basket_lines(apps, schema_editor):
+    Basket = apps.get_model('shopapp', 'Basket')
+    for owner_field in ('user_auth_user', 'user'):
+        duplicates = (
+            Basket.objects.filter(archived=False, **{f'{owner_field}__isnull': False}).
+            values(owner_field, 'product').
+            annotate(lines=Count('pk'), total=Sum('count')).
+            filter(lines__gt=1)
+        )
+        for duplicate in duplicates:
+            lines = Basket.objects.filter(
+                archived=False,
+                product=duplicate['product'],
+                **{owner_field: duplicate[owner_field]}
+            ).order_by('pk')
+            first_line = lines.first()
+            lines.exclude(pk=first_line.pk).delete()
+            Basket.objects.filter(pk=first_line.pk).update(count=duplicate['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0045_product_rating_sum_product_rating_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_basket_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='basket',
+            constraint=models.UniqueConstraint(condition=models.Q(('archived', False)), fields=('user_auth_user', 'product'), name='unique_active_basket_line_user_auth_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='basket',
+            constraint=models.UniqueConstraint(condition=models.Q(('archived', False)), fields=('user', 'product'), name='unique_active_basket_line_user'),
+        ),
+    ]
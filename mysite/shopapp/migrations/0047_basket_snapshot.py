@@ -0,0 +1,55 @@
+# Generated by Django 4.2.6 on 2026-10-18 03:10
+
+from datetime import datetime
+
+from django.db import migrations, models
+from django.db.models import Case, F, OuterRef, Q, Subquery, When
+
+
+def snapshot_order_lines(apps, schema_editor):
+    Basket = apps.get_model('shopapp', 'Basket')
+    Product = apps.get_model('shopapp', 'Product')
+    ProductImage = apps.get_model('shopapp', 'ProductImage')
+    today = datetime.now().date()
+    product = Product.objects.filter(pk=OuterRef('product_id'))
+    effective_price = Case(
+        When(
+            Q(dateFrom__date__lte=today, dateTo__date__gte=today, salePrice__isnull=False),
+            then=F('salePrice')
+        ),
+        default=F('price'),
+        output_field=models.DecimalField(max_digits=10, decimal_places=2)
+    )
+    Basket.objects.filter(order__isnull=False).update(
+        price=Subquery(product.values(effective_price=effective_price)[:1]),
+        title=Subquery(product.values('title')[:1]),
+        image=Subquery(
+            ProductImage.objects.filter(product=OuterRef('product_id')).order_by('pk').values('image')[:1]
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0046_basket_unique_active_line'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basket',
+            name='image',
+            field=models.CharField(blank=True, default=None, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='basket',
+            name='price',
+            field=models.DecimalField(blank=True, decimal_places=2, default=None, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='basket',
+            name='title',
+            field=models.CharField(blank=True, default=None, max_length=200, null=True),
+        ),
+        migrations.RunPython(snapshot_order_lines, migrations.RunPython.noop),
+    ]
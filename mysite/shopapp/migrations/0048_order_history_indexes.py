@@ -0,0 +1,21 @@
+# Generated by Django 4.2.6 on 2026-10-18 03:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0047_basket_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user_auth_user', 'createdAt'], name='order_user_auth_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'createdAt'], name='order_user_created'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.6 on 2026-10-18 03:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0049_stock_reservations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(db_index=True, default='queued', max_length=20)),
+                ('error', models.CharField(blank=True, default='', max_length=100)),
+                ('worker', models.CharField(blank=True, default=None, max_length=32, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_jobs', to='shopapp.order')),
+            ],
+        ),
+    ]
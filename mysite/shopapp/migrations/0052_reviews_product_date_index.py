@@ -0,0 +1,17 @@
+# Generated by Django 4.2.6 on 2026-10-18 03:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0051_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reviews',
+            index=models.Index(fields=['product_review', 'date', 'id'], name='reviews_product_date_id'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.6 on 2026-10-18 03:38
+
+from django.db import migrations, models
+
+
+def count_started_attempts(apps, schema_editor):
+    PaymentJob = apps.get_model('shopapp', 'PaymentJob')
+    PaymentJob.objects.exclude(status='queued').update(attempts=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0052_reviews_product_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='paymentjob',
+            name='worker',
+            field=models.CharField(blank=True, db_index=True, default=None, max_length=32, null=True),
+        ),
+        migrations.RunPython(count_started_attempts, migrations.RunPython.noop),
+    ]
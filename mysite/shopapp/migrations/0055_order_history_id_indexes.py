@@ -0,0 +1,29 @@
+# Generated by Django 4.2.6 on 2026-10-18 04:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0054_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='order',
+            name='order_user_auth_user_created',
+        ),
+        migrations.RemoveIndex(
+            model_name='order',
+            name='order_user_created',
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user_auth_user', 'id'], name='order_user_auth_user_id'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'id'], name='order_user_id'),
+        ),
+    ]
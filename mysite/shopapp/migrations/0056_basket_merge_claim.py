@@ -0,0 +1,21 @@
+# Generated by Django 4.2.6 on 2026-10-18 04:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0055_order_history_id_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BasketMergeClaim',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=100, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
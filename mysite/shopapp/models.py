@@ -1,11 +1,19 @@
 from datetime import datetime
+from typing import Optional
 
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
-from django.db.models import Avg
+from django.db import models, transaction
+from django.db.models import Case, F, FloatField, Q, When
+from django.db.models.functions import Cast, Greatest, Round
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 
+from .cache import invalidate_catalog_cache, bump_product_versions
+from .facets import mark_products_changed
+from .search import index_product, unindex_product
+
 
 def product_image_directory_path(instance: 'ProductImage', filename: str) -> str:
     """
@@ -46,9 +54,33 @@ def subcategory_image_directory_path(instance: 'SubCategory', filename: str) ->
     )
 
 
+def products_changed(product_pks: list) -> None:
+    """
+    Функция сообщает кэшам о том, что продукты (или их изображения, теги, отзывы) изменились:
+    обновляет фасетный индекс, версии закэшированных представлений продуктов и сбрасывает кэш каталога
+    :param product_pks:
+    :return:
+    """
+    mark_products_changed(product_pks)
+    bump_product_versions(product_pks)
+    invalidate_catalog_cache()
+
+
 class Tag(models.Model):
     name = models.CharField(max_length=100, unique=True)
 
+    def save(
+            self, force_insert=False, force_update=False, using=None, update_fields=None
+    ):
+        super().save(force_insert, force_update, using, update_fields)
+        products_changed(list(self.products.values_list('pk', flat=True)))
+
+    def delete(self, using=None, keep_parents=False):
+        product_pks = list(self.products.values_list('pk', flat=True))
+        result = super().delete(using, keep_parents)
+        products_changed(product_pks)
+        return result
+
     def __str__(self) -> str:
         return f"{self.name.title()}"
 
@@ -115,6 +147,11 @@ class Product(models.Model):
             MinValueValidator(0)
         ]
     )
+    reviews_count = models.PositiveIntegerField(default=0, db_index=True)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    # Количество, удерживаемое резервами подтверждённых заказов (Reservation). Доступно к заказу: count - reserved
+    reserved = models.PositiveIntegerField(default=0)
     discount = models.DecimalField(
         default=0,
         max_digits=4,
@@ -134,6 +171,14 @@ class Product(models.Model):
     dateFrom = models.DateTimeField(null=True, blank=True)
     dateTo = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        # Ключи курсорной пагинации каталога (shopapp.services.get_keyset_page): (поле сортировки, id)
+        indexes = [
+            models.Index(fields=['date', 'id'], name='product_date_id'),
+            models.Index(fields=['price', 'id'], name='product_price_id'),
+            models.Index(fields=['rating', 'id'], name='product_rating_id'),
+        ]
+
     def save(
             self, force_insert=False, force_update=False, using=None, update_fields=None
     ):
@@ -145,25 +190,87 @@ class Product(models.Model):
         except:
             self.salePrice = None
         super().save()
+        index_product(self)
+        products_changed([self.pk])
+
+    def delete(self, using=None, keep_parents=False):
+        product_pk = self.pk
+        result = super().delete()
+        unindex_product(product_pk)
+        products_changed([product_pk])
+        return result
 
     def __str__(self) -> str:
         return f"{self.title.title()}"
 
 
+@receiver(m2m_changed, sender=Product.tags.through)
+def product_tags_changed(sender, instance, action: str, reverse: bool, pk_set: Optional[set], **kwargs) -> None:
+    """
+    Теги продукта меняются без Product.save() (product.tags.add, tag.products.remove, форма админки),
+    поэтому кэши продуктов обновляются по сигналу m2m_changed
+    :param sender:
+    :param instance: продукт или тег (reverse=True)
+    :param action:
+    :param reverse:
+    :param pk_set:
+    :param kwargs:
+    :return:
+    """
+    if action in ('post_add', 'post_remove'):
+        product_pks = list(pk_set) if reverse else [instance.pk]
+    elif action == 'pre_clear':
+        product_pks = list(instance.products.values_list('pk', flat=True)) if reverse else [instance.pk]
+    else:
+        return
+    if product_pks:
+        products_changed(product_pks)
+
+
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to=product_image_directory_path)
 
+    def save(
+            self, force_insert=False, force_update=False, using=None, update_fields=None
+    ):
+        super().save(force_insert, force_update, using, update_fields)
+        products_changed([self.product_id])
+
+    def delete(self, using=None, keep_parents=False):
+        result = super().delete(using, keep_parents)
+        products_changed([self.product_id])
+        return result
 
-def set_average_rating(product_pk: int) -> None:
+
+def update_product_rating(product_pk: int, reviews_delta: int, rate_delta: int, rated_delta: int) -> None:
     """
-    Функция делает перерасчёт среднего рейтинга продукта при сохранении или удалении отзыва на этот продукт
+    Функция обновляет счётчики отзывов и рейтинг продукта одним UPDATE при сохранении или удалении отзыва
+    (сигналы post_save и post_delete модели Reviews).
+    Средний рейтинг считается из накопленных rating_sum / rating_count, таблица отзывов не сканируется.
+    В правой части UPDATE используются значения строки до изменения, поэтому приращения учитываются явно.
     :param product_pk:
+    :param reviews_delta: изменение количества отзывов
+    :param rate_delta: изменение суммы оценок
+    :param rated_delta: изменение количества отзывов с оценкой
     :return:
     """
-    product = Product.objects.prefetch_related('reviews').get(pk=product_pk)
-    product.rating = product.reviews.aggregate(Avg('rate'))['rate__avg']
-    product.save()
+    rating_sum = F('rating_sum') + rate_delta
+    rating_count = F('rating_count') + rated_delta
+    Product.objects.filter(pk=product_pk).update(
+        reviews_count=F('reviews_count') + reviews_delta,
+        rating_sum=rating_sum,
+        rating_count=rating_count,
+        rating=Case(
+            When(
+                rating_count__gt=-rated_delta,
+                then=Round(Cast(rating_sum, FloatField()) / rating_count, 1)
+            ),
+            default=None,
+            output_field=models.DecimalField(max_digits=2, decimal_places=1)
+        )
+    )
+    products_changed([product_pk])
 
 
 class Reviews(models.Model):
@@ -192,16 +299,63 @@ class Reviews(models.Model):
         verbose_name = _("Review")
         verbose_name_plural = _("Reviews")
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['product_review', 'date', 'id'], name='reviews_product_date_id'),
+        ]
 
     def save(
             self, force_insert=False, force_update=False, using=None, update_fields=None
     ):
-        super().save()
-        set_average_rating(self.product_review.pk)
+        with transaction.atomic():
+            super().save(force_insert, force_update, using, update_fields)
 
-    def delete(self, using=None, keep_parents=False):
-        super().delete()
-        set_average_rating(self.product_review.pk)
+
+@receiver(pre_save, sender=Reviews)
+def remember_review_rate(sender, instance: Reviews, **kwargs) -> None:
+    """
+    Запоминает оценку, сохранённую в базе до изменения отзыва: по ней post_save считает приращения
+    :param sender:
+    :param instance:
+    :param kwargs:
+    :return:
+    """
+    instance._saved_rate = None
+    if not instance._state.adding:
+        instance._saved_rate = Reviews.objects.filter(pk=instance.pk).values_list('rate', flat=True).first()
+
+
+@receiver(post_save, sender=Reviews)
+def review_saved(sender, instance: Reviews, created: bool, **kwargs) -> None:
+    """
+    Добавляет к счётчикам продукта новый отзыв или изменение оценки.
+    Версия продукта меняется при любом сохранении отзыва: текст и автор тоже попадают в представление продукта
+    :param sender:
+    :param instance:
+    :param created:
+    :param kwargs:
+    :return:
+    """
+    old_rate = None if created else getattr(instance, '_saved_rate', None)
+    rate_delta = (instance.rate or 0) - (old_rate or 0)
+    rated_delta = (instance.rate is not None) - (old_rate is not None)
+    if created or rate_delta or rated_delta:
+        update_product_rating(instance.product_review_id, int(created), rate_delta, rated_delta)
+    else:
+        products_changed([instance.product_review_id])
+
+
+@receiver(post_delete, sender=Reviews)
+def review_deleted(sender, instance: Reviews, **kwargs) -> None:
+    """
+    Вычитает удалённый отзыв из счётчиков продукта.
+    Сигнал срабатывает и при queryset.delete() (действие «удалить выбранные» в админке),
+    и при каскадном удалении (удаление пользователя), поэтому счётчики не расходятся с таблицей отзывов
+    :param sender:
+    :param instance:
+    :param kwargs:
+    :return:
+    """
+    update_product_rating(instance.product_review_id, -1, -(instance.rate or 0), -(instance.rate is not None))
 
 
 class Specification(models.Model):
@@ -209,6 +363,17 @@ class Specification(models.Model):
     name = models.CharField(max_length=100, blank=False, null=False)
     value = models.CharField(max_length=100)
 
+    def save(
+            self, force_insert=False, force_update=False, using=None, update_fields=None
+    ):
+        super().save(force_insert, force_update, using, update_fields)
+        products_changed([self.product_id])
+
+    def delete(self, using=None, keep_parents=False):
+        result = super().delete(using, keep_parents)
+        products_changed([self.product_id])
+        return result
+
     def __str__(self) -> str:
         return f"{self.name.title()}"
 
@@ -261,6 +426,13 @@ class Order(models.Model):
     city = models.CharField(max_length=100, blank=True, null=True)
     address = models.CharField(max_length=100, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # История заказов листается по id: createdAt (auto_now) меняется при оплате
+            models.Index(fields=['user_auth_user', 'id'], name='order_user_auth_user_id'),
+            models.Index(fields=['user', 'id'], name='order_user_id'),
+        ]
+
 
 class Basket(models.Model):
     user_auth_user = models.ForeignKey(
@@ -286,3 +458,82 @@ class Basket(models.Model):
         on_delete=models.CASCADE,
     )
     archived = models.BooleanField(default=False)
+    price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, default=None)
+    title = models.CharField(max_length=200, blank=True, null=True, default=None)
+    image = models.CharField(max_length=255, blank=True, null=True, default=None)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user_auth_user', 'product'],
+                condition=Q(archived=False),
+                name='unique_active_basket_line_user_auth_user'
+            ),
+            models.UniqueConstraint(
+                fields=['user', 'product'],
+                condition=Q(archived=False),
+                name='unique_active_basket_line_user'
+            ),
+        ]
+
+
+class Reservation(models.Model):
+    """
+    Резерв продукта под подтверждённый заказ. Пока резерв не истёк, это количество недоступно другим покупателям.
+    Сумма резервов продукта хранится в Product.reserved
+    """
+    order = models.ForeignKey(Order, related_name='reservations', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE)
+    count = models.PositiveSmallIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+
+
+@receiver(post_delete, sender=Reservation)
+def release_reserved_stock(sender, instance: Reservation, **kwargs) -> None:
+    """
+    Возвращает количество удалённого резерва в продажу (уменьшает Product.reserved).
+    Сигнал срабатывает и при queryset.delete(), и при каскадном удалении (удаление заказа в админке,
+    удаление пользователя вместе с заказами), поэтому резерв не может пропасть, не вернув остаток
+    :param sender:
+    :param instance:
+    :param kwargs:
+    :return:
+    """
+    Product.objects.filter(pk=instance.product_id).update(reserved=Greatest(F('reserved') - instance.count, 0))
+    products_changed([instance.product_id])
+
+
+class PaymentJob(models.Model):
+    """
+    Задание очереди оплаты (shopapp/payments.py).
+    Статусы: queued — ждёт обработчика, processing — обрабатывается, paid — заказ оплачен, failed — оплата не прошла.
+    attempts — сколько раз задание захватывал обработчик (больше 1, если обработчик упал и задание захвачено повторно)
+    """
+    order = models.ForeignKey(Order, related_name='payment_jobs', on_delete=models.CASCADE)
+    status = models.CharField(max_length=20, default='queued', db_index=True)
+    error = models.CharField(max_length=100, blank=True, default='')
+    worker = models.CharField(max_length=32, blank=True, null=True, default=None, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True, default=None)
+    finished_at = models.DateTimeField(blank=True, null=True, default=None)
+
+
+class IdempotencyKey(models.Model):
+    """
+    Сохранённый ответ на запрос с заголовком Idempotency-Key (shopapp/idempotency.py).
+    key — sha256 от владельца, метода, пути и значения заголовка; status_code = NULL, пока запрос выполняется
+    """
+    key = models.CharField(max_length=64, unique=True)
+    status_code = models.PositiveSmallIntegerField(blank=True, null=True, default=None)
+    response = models.JSONField(blank=True, null=True, default=None)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class BasketMergeClaim(models.Model):
+    """
+    Отметка о переносе корзины анонимного пользователя при входе (shopapp/baskets.py, claim_anonymous_basket).
+    Уникальный token не даёт перенести одну корзину дважды при входе из нескольких вкладок
+    """
+    token = models.CharField(max_length=100, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
@@ -0,0 +1,164 @@
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q, Subquery
+from django.utils import timezone
+
+from shopapp.models import Order, PaymentJob
+from shopapp.services import pay_order, payment_validator
+
+log = logging.getLogger(__name__)
+
+ACTIVE_JOB_STATUSES = ('queued', 'processing')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_payment_workers() -> int:
+    """
+    Количество потоков обработчика очереди оплат.
+    0 — задания обрабатываются сразу после коммита в потоке запроса (удобно для разработки и тестов)
+    :return:
+    """
+    return getattr(settings, 'PAYMENT_WORKERS', 2)
+
+
+def get_payment_job_timeout() -> int:
+    """
+    Через сколько секунд задание в статусе processing считается брошенным (обработчик упал или сервер
+    перезапущен) и может быть захвачено повторно
+    :return:
+    """
+    return getattr(settings, 'PAYMENT_JOB_TIMEOUT', 60 * 5)
+
+
+def get_claimable_jobs(now: Optional[datetime] = None) -> Q:
+    """
+    Условие заданий, которые может захватить обработчик: queued и брошенные processing
+    :param now:
+    :return:
+    """
+    abandoned_before = (now or timezone.now()) - timedelta(seconds=get_payment_job_timeout())
+    return Q(status='queued') | Q(status='processing', started_at__lt=abandoned_before)
+
+
+def get_payment_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_payment_workers(), thread_name_prefix='payment')
+        return _executor
+
+
+def get_public_status(job: PaymentJob) -> str:
+    """
+    Статус задания для клиента: processing, paid или failed
+    :param job:
+    :return:
+    """
+    return 'processing' if job.status in ACTIVE_JOB_STATUSES else job.status
+
+
+def enqueue_payment(order: Order) -> PaymentJob:
+    """
+    Ставит оплату заказа в очередь и после коммита будит обработчик.
+    Если по заказу уже есть незавершённое задание, новое не создаётся, но обработчик всё равно будится:
+    так брошенное задание будет захвачено повторно, когда истечёт PAYMENT_JOB_TIMEOUT
+    :param order:
+    :return: задание очереди
+    """
+    job = PaymentJob.objects.filter(order=order, status__in=ACTIVE_JOB_STATUSES).first()
+    if job is None:
+        job = PaymentJob.objects.create(order=order)
+    if get_payment_workers():
+        transaction.on_commit(lambda: get_payment_executor().submit(run_payment_worker))
+    else:
+        transaction.on_commit(process_payment_jobs)
+    return job
+
+
+def claim_payment_job() -> Optional[PaymentJob]:
+    """
+    Захватывает самое старое задание в статусе queued или брошенное задание в статусе processing
+    (started_at старше PAYMENT_JOB_TIMEOUT) одним UPDATE (без отдельного чтения),
+    поэтому одно задание не достанется двум обработчикам
+    :return: захваченное задание или None, если очередь пуста
+    """
+    worker = uuid.uuid4().hex
+    now = timezone.now()
+    claimable = get_claimable_jobs(now)
+    next_job = PaymentJob.objects.filter(claimable).order_by('pk').values('pk')[:1]
+    claimed = PaymentJob.objects.filter(claimable, pk__in=Subquery(next_job)).update(
+        status='processing',
+        worker=worker,
+        started_at=now,
+        attempts=F('attempts') + 1
+    )
+    if not claimed:
+        return None
+    return PaymentJob.objects.select_related('order').get(worker=worker)
+
+
+def process_payment_job(job: PaymentJob) -> None:
+    """
+    Проверяет наличие продуктов, списывает остатки и отмечает результат в задании.
+    Повторно захваченное задание могло оплатить заказ перед падением обработчика: если заказ уже оплачен
+    и ни одно другое задание заказа не отмечено paid, задание отмечается оплаченным
+    :param job: захваченное задание
+    :return:
+    """
+    try:
+        if job.attempts > 1 and is_paid_by_job(job):
+            error = None
+        else:
+            error = payment_validator.validate_stock(job.order) or pay_order(job.order)
+    except Exception:
+        log.exception('Payment job %s failed', job.pk)
+        error = 'Payment failed'
+    job.status = 'paid' if error is None else 'failed'
+    job.error = error or ''
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished_at'])
+
+
+def is_paid_by_job(job: PaymentJob) -> bool:
+    return (
+        Order.objects.filter(pk=job.order_id, status='paid').exists() and
+        not PaymentJob.objects.filter(order_id=job.order_id, status='paid').exclude(pk=job.pk).exists()
+    )
+
+
+def process_payment_jobs() -> int:
+    """
+    Обрабатывает задания, пока очередь не опустеет
+    :return: количество обработанных заданий
+    """
+    processed = 0
+    while True:
+        job = claim_payment_job()
+        if job is None:
+            if PaymentJob.objects.filter(get_claimable_jobs()).exists():
+                continue
+            return processed
+        process_payment_job(job)
+        processed += 1
+
+
+def run_payment_worker() -> None:
+    """
+    Точка входа потока обработчика: разбирает очередь и закрывает соединение с базой потока
+    :return:
+    """
+    try:
+        process_payment_jobs()
+    except Exception:
+        log.exception('Payment worker failed')
+    finally:
+        connection.close()
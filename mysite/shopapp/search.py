@@ -0,0 +1,150 @@
+import re
+from typing import Optional
+
+from django.db import connection
+from django.db.models import Q, QuerySet
+from django.db.models.expressions import RawSQL
+
+SEARCH_TABLE = 'shopapp_product_fts'
+
+
+def search_index_available() -> bool:
+    """
+    Полнотекстовый индекс (FTS5) есть только у SQLite.
+    На остальных базах поиск работает через обычный LIKE.
+    :return:
+    """
+    return connection.vendor == 'sqlite'
+
+
+def get_match_query(text: str) -> Optional[str]:
+    """
+    Превращает строку поиска в запрос FTS5: каждое слово ищется по префиксу, все слова обязательны.
+    Если в строке нет ни одного слова, функция вернёт None
+    :param text:
+    :return:
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def get_search_filter(text: str) -> Q:
+    """
+    Возвращает условие для фильтрации queryset продуктов по строке поиска
+    :param text:
+    :return:
+    """
+    match_query = get_match_query(text)
+    if match_query is None or not search_index_available():
+        return Q(title__contains=text)
+    return Q(pk__in=RawSQL(
+        f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s',
+        (match_query,)
+    ))
+
+
+def get_search_source(text: str, queryset: QuerySet) -> Optional[tuple]:
+    """
+    FROM и WHERE запроса к индексу FTS5: совпадение со строкой поиска среди продуктов queryset.
+    Индекс соединяется с таблицей продуктов, остальные фильтры каталога подставляются подзапросом id IN (...).
+    Условие rowid IN (...) на самой таблице FTS5 не подходит: FTS5 выполняет MATCH заново для каждого rowid.
+    Если поиск по индексу недоступен или в строке нет ни одного слова, функция вернёт None
+    :param text: строка поиска
+    :param queryset: отфильтрованный queryset продуктов
+    :return: (sql, params)
+    """
+    match_query = get_match_query(text)
+    if match_query is None or not search_index_available():
+        return None
+    products_sql, products_params = queryset.order_by().values('pk').query.sql_with_params()
+    sql = (
+        f'{SEARCH_TABLE} JOIN shopapp_product AS product ON product.id = {SEARCH_TABLE}.rowid '
+        f'WHERE {SEARCH_TABLE} MATCH %s AND product.id IN ({products_sql})'
+    )
+    return sql, (match_query, *products_params)
+
+
+def count_search_results(text: str, queryset: QuerySet) -> Optional[int]:
+    """
+    Количество продуктов queryset, подходящих под строку поиска
+    :param text:
+    :param queryset:
+    :return: количество или None, если поиск по индексу недоступен
+    """
+    source = get_search_source(text, queryset)
+    if source is None:
+        return None
+    sql, params = source
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT COUNT(*) FROM {sql}', params)
+        return cursor.fetchone()[0]
+
+
+def search_products(text: str, queryset: QuerySet, offset: int, limit: int) -> Optional[list]:
+    """
+    Страница продуктов queryset, подходящих под строку поиска, по убыванию релевантности (bm25).
+    Релевантность считается одним запросом к индексу (ORDER BY rank LIMIT/OFFSET), а не подзапросом на каждый продукт
+    :param text:
+    :param queryset:
+    :param offset:
+    :param limit:
+    :return: список id или None, если поиск по индексу недоступен
+    """
+    source = get_search_source(text, queryset)
+    if source is None:
+        return None
+    sql, params = source
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT product.id FROM {sql} ORDER BY {SEARCH_TABLE}.rank, product.id LIMIT %s OFFSET %s',
+            (*params, limit, offset)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def index_product(product) -> None:
+    """
+    Добавляет или обновляет продукт в поисковом индексе
+    :param product:
+    :return:
+    """
+    if not search_index_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', (product.pk,))
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, title, description, fullDescription) VALUES (%s, %s, %s, %s)',
+            (product.pk, product.title, product.description or '', product.fullDescription or '')
+        )
+
+
+def unindex_product(product_pk: int) -> None:
+    """
+    Удаляет продукт из поискового индекса
+    :param product_pk:
+    :return:
+    """
+    if not search_index_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', (product_pk,))
+
+
+def rebuild_search_index() -> int:
+    """
+    Полностью перестраивает поисковый индекс по таблице продуктов
+    :return: количество проиндексированных продуктов
+    """
+    if not search_index_available():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, title, description, fullDescription) '
+            f'SELECT id, title, COALESCE(description, \'\'), COALESCE("fullDescription", \'\') FROM shopapp_product'
+        )
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+        cursor.execute(f'SELECT COUNT(*) FROM {SEARCH_TABLE}')
+        return cursor.fetchone()[0]
@@ -1,6 +1,10 @@
 from rest_framework import serializers
-from .models import Category, SubCategory, Product, Reviews, Tag, Specification, Basket, Order, ProductImage
-from .services import get_no_img, get_price_or_sale_price
+from .models import Category, SubCategory, Product, Reviews, Tag, Specification, Order, ProductImage
+from .cache import get_product_fragments, set_product_fragments
+from .services import get_no_img, get_price_or_sale_price, get_keyset_page, get_order_lines
+
+REVIEWS_PAGE_SIZE = 10
+ORDERS_PAGE_SIZE = 10
 
 
 class SubCategorySerializer(serializers.ModelSerializer):
@@ -51,6 +55,22 @@ class ReviewsSerializer(serializers.ModelSerializer):
         )
 
 
+def get_reviews_page_data(product_pk: int, cursor: str = '', limit: int = REVIEWS_PAGE_SIZE) -> dict:
+    """
+    Возвращает страницу отзывов продукта (новые сначала) с курсорной пагинацией по (date, id).
+    При повреждённом курсоре будет выброшено ValueError
+    :param product_pk:
+    :param cursor: курсор, полученный вместе с предыдущей страницей (пустой — первая страница)
+    :param limit:
+    :return: dict(items=[...], nextCursor=...)
+    """
+    reviews, next_cursor = get_keyset_page(Reviews.objects.filter(product_review=product_pk), '-date', cursor, limit)
+    return dict(
+        items=ReviewsSerializer(reviews, many=True, read_only=True).data,
+        nextCursor=next_cursor
+    )
+
+
 class TagSerializer(serializers.ModelSerializer):
     class Meta:
         model = Tag
@@ -125,11 +145,9 @@ class ProductSerializer(serializers.ModelSerializer):
             ])
         return fields
 
-    def get_reviews(self, instance: Product):
-        product_short = self.context.get('short', False)
-        if not product_short:
-            return ReviewsSerializer(read_only=True, many=True, instance=instance.reviews).data
-        return instance.reviews.count()
+    @classmethod
+    def get_reviews(cls, instance: Product):
+        return instance.reviews_count
 
     @classmethod
     def get_specifications(cls, instance: Product):
@@ -141,37 +159,40 @@ class ProductSerializer(serializers.ModelSerializer):
             data['images'] = [
                 dict(src=get_no_img(), alt='No Image')
             ]
+        product_short = self.context.get('short', False)
+        if not product_short:
+            # В полном представлении вместо количества отзывов отдаётся их первая страница
+            reviews_page = get_reviews_page_data(instance.pk)
+            data['reviews'] = reviews_page['items']
+            data['reviewsCount'] = instance.reviews_count
+            data['reviewsNextCursor'] = reviews_page['nextCursor']
         return data
 
 
-class BasketSerializer(serializers.ModelSerializer):
-    product = serializers.SerializerMethodField()
-
-    class Meta:
-        model = Basket
-        fields = (
-            'product',
-        )
-
-    @classmethod
-    def get_product(cls, instance: Basket):
-        product = ProductSerializer(
-            read_only=True,
-            context={'short': True},
-            instance=instance.product
-        )
-        data = product.data
-        data['count'] = instance.count
-        return data
-
-    def to_representation(self, instance: Product):
-        data = super().to_representation(instance)
-
-        return data['product']
+def get_short_products_data(product_pks: list, queryset=None) -> list:
+    """
+    Возвращает короткие представления продуктов (ProductSerializer с context={'short': True}) в порядке product_pks.
+    Представления берутся из общего кэша, из базы загружаются и сериализуются только отсутствующие в кэше продукты.
+    :param product_pks:
+    :param queryset: queryset для загрузки отсутствующих продуктов
+    :return:
+    """
+    fragments, missing_keys = get_product_fragments(product_pks)
+    if missing_keys:
+        if queryset is None:
+            queryset = Product.objects.select_related('category').prefetch_related('tags', 'images')
+        products = queryset.in_bulk(list(missing_keys))
+        new_fragments = {}
+        for product_pk, product in products.items():
+            data = dict(ProductSerializer(product, read_only=True, context={'short': True}).data)
+            fragments[product_pk] = data
+            new_fragments[missing_keys[product_pk]] = data
+        set_product_fragments(new_fragments)
+    return [dict(fragments[product_pk]) for product_pk in product_pks if product_pk in fragments]
 
 
 class OrderSerializer(serializers.ModelSerializer):
-    products = BasketSerializer(read_only=True, many=True)
+    products = serializers.SerializerMethodField()
     createdAt = serializers.SerializerMethodField()
 
     class Meta:
@@ -195,6 +216,12 @@ class OrderSerializer(serializers.ModelSerializer):
     def get_createdAt(cls, instance: Order):
         return instance.createdAt.strftime("%d.%m.%Y %H:%M")
 
+    def get_products(self, instance: Order):
+        order_lines = self.context.get('order_lines')
+        if order_lines is None:
+            order_lines = get_order_lines([instance.pk])
+        return order_lines.get(instance.pk, [])
+
 
 class SaleProductSerializer(serializers.ModelSerializer):
     images = ProductImageSerializer(read_only=True, many=True)
@@ -1,16 +1,38 @@
+import base64
+import binascii
+import json
 import uuid
 from calendar import monthrange
 from collections import Counter
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from decimal import Decimal
 from typing import Optional
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connection, transaction
+from django.db.models import (
+    Case,
+    DecimalField,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Q,
+    QuerySet,
+    Subquery,
+    Sum,
+    When,
+)
+from django.db.models.functions import Coalesce
 from django.http import QueryDict
+from django.utils import timezone
 from rest_framework.request import Request
 
 from mysite.settings import MEDIA_URL
-from shopapp.models import Product
+from shopapp.baskets import BasketStore, get_basket_store
+from shopapp.models import Product, ProductImage, Basket, Order, Reservation, products_changed
+from shopapp.search import get_search_filter
 
 
 def get_popular_tags(data: list) -> list:
@@ -36,7 +58,7 @@ def get_filter_param(data_request: QueryDict) -> list:
 
     filter_name = data_request.get('filter[name]', None)
     if filter_name:
-        filter_param.append(Q(title__contains=filter_name))
+        filter_param.append(get_search_filter(filter_name))
 
     filter_min_price = data_request.get('filter[minPrice]', None)
     filter_max_price = data_request.get('filter[maxPrice]', None)
@@ -56,7 +78,7 @@ def get_filter_param(data_request: QueryDict) -> list:
 
     filter_available = data_request.get('filter[available]', None)
     if filter_available == 'true':
-        filter_param.append(Q(count__gt=0))
+        filter_param.append(Q(count__gt=F('reserved')))
 
     tags_list = data_request.getlist('tags[]', None)
     if tags_list and len(tags_list):
@@ -65,6 +87,100 @@ def get_filter_param(data_request: QueryDict) -> list:
     return filter_param
 
 
+def encode_cursor(values: list) -> str:
+    """
+    Кодирует значения ключа сортировки последнего элемента страницы в строку курсора
+    :param values: [значение поля сортировки, id]
+    :return:
+    """
+    data = json.dumps(
+        values,
+        default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value)
+    )
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Optional[list]:
+    """
+    Декодирует строку курсора. Если курсор повреждён, функция вернёт None
+    :param cursor:
+    :return: [значение поля сортировки, id]
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != 2 or not isinstance(values[1], int):
+        return None
+    return values
+
+
+def get_keyset_page(queryset: QuerySet, sort: str, cursor: str, limit: int) -> tuple:
+    """
+    Курсорная (keyset) пагинация queryset.
+    Вместо COUNT(*) и OFFSET страница выбирается условием по ключу сортировки (sort, id),
+    которое читается из индекса (sort, id) диапазоном, поэтому любая страница стоит столько же, сколько первая.
+    Если поле сортировки допускает NULL (rating), строки с NULL идут последними при убывании и первыми
+    при возрастании и выбираются отдельным запросом: так условие курсора остаётся диапазоном по индексу.
+    Пустой курсор означает первую страницу.
+    :param queryset:
+    :param sort: поле сортировки, например '-date' или 'price'
+    :param cursor: курсор, полученный вместе с предыдущей страницей
+    :param limit: размер страницы
+    :return: (список объектов страницы, курсор следующей страницы или None)
+    """
+    descending = sort.startswith('-')
+    field = sort.lstrip('-')
+    prefix = '-' if descending else ''
+    lookup = 'lt' if descending else 'gt'
+    try:
+        nullable = queryset.model._meta.get_field(field).null
+    except FieldDoesNotExist:
+        nullable = False
+    # Части выборки по порядку: None — все строки, True — строки с NULL, False — строки со значением
+    if not nullable:
+        segments = [None]
+    else:
+        segments = [False, True] if descending else [True, False]
+
+    values = None
+    if cursor:
+        values = decode_cursor(cursor)
+        if values is None:
+            raise ValueError('Invalid cursor')
+        if nullable:
+            segments = segments[segments.index(values[0] is None):]
+
+    items = []
+    for index, is_null in enumerate(segments):
+        segment = queryset
+        if is_null is not None:
+            segment = segment.filter(**{f'{field}__isnull': is_null})
+        if is_null:
+            segment = segment.order_by(f'{prefix}pk')
+        else:
+            segment = segment.order_by(f'{prefix}{field}', f'{prefix}pk')
+        if index == 0 and values is not None:
+            value, pk = values
+            if is_null:
+                segment = segment.filter(**{f'pk__{lookup}': pk})
+            else:
+                # field <= value (>= value) задаёт границу диапазона индекса, остальное — уточнение внутри него
+                segment = segment.filter(**{f'{field}__{lookup}e': value}).filter(
+                    Q(**{f'{field}__{lookup}': value}) | Q(**{f'pk__{lookup}': pk})
+                )
+        items += list(segment[:limit + 1 - len(items)])
+        if len(items) > limit:
+            break
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, field), last.pk])
+    return items, next_cursor
+
+
 def get_user_param_create_token(request: Request) -> Optional[dict]:
     """
     Функция принимает на себя request запроса.
@@ -115,6 +231,67 @@ def get_user_param_no_create_token(request: Request) -> Optional[dict]:
     return user_param
 
 
+def upsert_basket_line(user_param: dict, product_id: int, count: int) -> Optional[dict]:
+    """
+    Функция добавляет продукт в активную корзину одним запросом INSERT ... ON CONFLICT DO UPDATE.
+    Количество в строке увеличивается на count и ограничивается доступным остатком (но не меньше 1),
+    поэтому параллельные добавления (например, двойной клик) не теряют обновлений.
+    Если продукта нет или его нет в наличии, функция вернёт None
+    :param user_param: результат get_user_param_create_token
+    :param product_id:
+    :param count: на сколько увеличить количество (может быть отрицательным)
+    :return: dict(id=id продукта, count=новое количество в корзине)
+    """
+    if 'user_auth_user' in user_param:
+        owner_column, owner_value = 'user_auth_user_id', user_param['user_auth_user'].pk
+    else:
+        owner_column, owner_value = 'user', user_param['user']
+    least, greatest = ('MIN', 'MAX') if connection.vendor == 'sqlite' else ('LEAST', 'GREATEST')
+    basket_table = Basket._meta.db_table
+    product_table = Product._meta.db_table
+    sql = f'''
+        INSERT INTO {basket_table} ("{owner_column}", created_at, product_id, count, archived)
+        SELECT %s, %s, product.id, {greatest}(1, {least}(%s, product.count - product.reserved)), false
+        FROM {product_table} AS product
+        WHERE product.id = %s AND product.count > product.reserved
+        ON CONFLICT ("{owner_column}", product_id) WHERE NOT archived DO UPDATE SET
+            count = {greatest}(1, {least}(
+                {basket_table}.count + %s,
+                (SELECT product.count - product.reserved FROM {product_table} AS product WHERE product.id = excluded.product_id)
+            )),
+            created_at = excluded.created_at
+        RETURNING product_id, count
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (owner_value, timezone.now(), count, product_id, count))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(id=row[0], count=row[1])
+
+
+def reconcile_baskets_with_stock(baskets: QuerySet) -> None:
+    """
+    Функция приводит строки корзины в соответствие с доступными остатками (без резервов).
+    Сначала один SELECT EXISTS проверяет, есть ли что исправлять: обычно нечего, и запрос корзины
+    обходится без записи (на SQLite каждая запись берёт блокировку всей базы).
+    Если есть, одним DELETE удаляет строки с отсутствующими продуктами
+    и одним UPDATE уменьшает количество до остатка там, где заказано больше, чем есть
+    :param baskets: queryset строк корзины
+    :return:
+    """
+    out_of_stock = Q(product__count__lte=F('product__reserved'))
+    over_stock = Q(count__gt=F('product__count') - F('product__reserved'))
+    if not baskets.filter(out_of_stock | over_stock).exists():
+        return
+    baskets.filter(out_of_stock).delete()
+    baskets.filter(over_stock).update(
+        count=Subquery(
+            Product.objects.filter(pk=OuterRef('product_id')).values(available=F('count') - F('reserved'))[:1]
+        )
+    )
+
+
 def get_fullname_email_phone(user: User) -> tuple:
     """
     Функция принимает текущего пользователя и возвращает его:
@@ -132,75 +309,247 @@ def get_fullname_email_phone(user: User) -> tuple:
     return full_name, email, phone
 
 
-class PymentValidator:
+def get_short_lines(order: Order) -> list:
+    """
+    Одним агрегирующим запросом находит строки заказа, для которых не хватает продуктов.
+    Доступным считается count - reserved плюс резерв, уже сделанный под этот заказ
+    :param order:
+    :return: [dict(id=id продукта, count=заказано, available=доступно), ...]
+    """
+    held = (
+        Reservation.objects.
+        filter(order=order.pk, product=OuterRef('product_id')).
+        order_by().
+        values('product').
+        annotate(total=Sum('count')).
+        values('total')
+    )
+    lines = (
+        Basket.objects.
+        filter(order=order.pk).
+        order_by('product_id').
+        values('product_id').
+        annotate(
+            total=Sum('count'),
+            available=F('product__count') - F('product__reserved') + Coalesce(Subquery(held), 0)
+        ).
+        filter(total__gt=F('available'))
+    )
+    return [dict(id=line['product_id'], count=line['total'], available=line['available']) for line in lines]
+
+
+class PaymentValidator:
     """
-    Эмулятор оплаты.
-    Обязательно нужно передать:
-    order — сам заказ,
+    Эмулятор оплаты: проверки данных карты и наличия продуктов заказа.
+    Проверки выполняются по очереди до первой ошибки.
+    Объект не хранит состояния запроса, поэтому используется один экземпляр payment_validator
+    (в том числе для проверки наличия при подтверждении заказа).
+    В данных карты обязательно нужно передать:
     number — номер карты,
     name — имя владельца карты,
     month — срок действия (месяц),
     year — срок действия (год),
     code — код с обратной стороны
     """
-    order = None
-    number = None
-    name = None
-    month = None
-    year = None
-    code = None
-
-    def __init__(self, *args, **kwargs):
-        self.__dict__.update(kwargs)
-        self.__is_valid = False
-        self.__messages_error = {'error': ''}
-        self.__validate()
-
-    @property
-    def messages_error(self):
-        return self.__messages_error
-
-    @property
-    def is_valid(self):
-        return self.__is_valid
-
-    def __set_is_valid(self, value):
-        self.__is_valid = value
-
-    def __set_messages_error(self, messages):
-        self.__messages_error['error'] = messages
-
-    def __validate(self):
-        if not all([value for key, value in self.__dict__.items() if not key.startswith('_')]):
-            self.__messages_error = {'error': 'Not all data available'}
-        elif len(self.number) != 8 or (not self.number.isdigit()) or int(self.number) % 2 != 0:
-            self.__set_messages_error('Invalid card number')
-        elif len(self.code) != 3:
-            self.__set_messages_error('Incorrect CVV code')
-        elif (not self.month.isdigit()) or (not self.year.isdigit()):
-            self.__set_messages_error('date must be a number')
-        elif len(self.name.strip()) == 0:
-            self.__set_messages_error('wrong name')
+    card_fields = ('number', 'name', 'month', 'year', 'code')
+
+    @staticmethod
+    def check_required(card: dict) -> Optional[str]:
+        if not all(card.values()):
+            return 'Not all data available'
+
+    @staticmethod
+    def check_number(card: dict) -> Optional[str]:
+        number = card['number']
+        if len(number) != 8 or (not number.isdigit()) or int(number) % 2 != 0:
+            return 'Invalid card number'
+
+    @staticmethod
+    def check_code(card: dict) -> Optional[str]:
+        if len(card['code']) != 3:
+            return 'Incorrect CVV code'
+
+    @staticmethod
+    def check_date_is_number(card: dict) -> Optional[str]:
+        if (not card['month'].isdigit()) or (not card['year'].isdigit()):
+            return 'date must be a number'
+
+    @staticmethod
+    def check_name(card: dict) -> Optional[str]:
+        if len(card['name'].strip()) == 0:
+            return 'wrong name'
+
+    @staticmethod
+    def check_expiry(card: dict) -> Optional[str]:
         try:
-            year = self.year
-            if len(year) == 2:
-                year = int(year) + 2000
-            target_date = date(
-                year=int(year),
-                month=int(self.month),
-                day=monthrange(int(self.year), int(self.month))[1]
-            )
-            if target_date < datetime.now().date():
-                self.__set_messages_error('The card has expired')
-        except:
-            self.__set_messages_error('wrong date')
-        baskets = self.order.products
-        for basket in baskets.all():
-            if basket.count > basket.product.count:
-                self.__set_messages_error('Not enough goods in stock')
-                break
-        if self.messages_error['error'] == '':
-            self.__set_is_valid(True)
+            year = int(card['year'])
+            if len(card['year']) == 2:
+                year += 2000
+            month = int(card['month'])
+            target_date = date(year=year, month=month, day=monthrange(year, month)[1])
+        except ValueError:
+            return 'wrong date'
+        if target_date < datetime.now().date():
+            return 'The card has expired'
+
+    card_checks = ('check_required', 'check_number', 'check_code', 'check_date_is_number', 'check_name', 'check_expiry')
+
+    def validate_card(self, data: dict) -> Optional[str]:
+        """
+        :param data: данные карты (request.data)
+        :return: текст первой ошибки или None
+        """
+        card = {field: str(data.get(field) or '') for field in self.card_fields}
+        for check in self.card_checks:
+            error = getattr(self, check)(card)
+            if error is not None:
+                return error
+        return None
+
+    @classmethod
+    def validate_stock(cls, order: Order) -> Optional[str]:
+        """
+        :param order:
+        :return: текст ошибки, если каких-то продуктов заказа не хватает, иначе None
+        """
+        if get_short_lines(order):
+            return 'Not enough goods in stock'
+        return None
+
+    def validate(self, order: Order, data: dict) -> Optional[str]:
+        """
+        Проверяет данные карты, а затем наличие продуктов заказа
+        :param order:
+        :param data: данные карты (request.data)
+        :return: текст первой ошибки или None
+        """
+        return self.validate_card(data) or self.validate_stock(order)
+
+
+payment_validator = PaymentValidator()
+
+
+def get_available_stock(product_pks) -> dict:
+    """
+    Доступные к заказу остатки (count - reserved) одним запросом.
+    Продукты, которых нет в наличии, в результат не попадают
+    :param product_pks:
+    :return: dict id продукта -> доступное количество
+    """
+    return dict(
+        Product.objects.
+        filter(pk__in=product_pks, count__gt=F('reserved')).
+        values_list('pk', F('count') - F('reserved'))
+    )
+
+
+def get_reservation_timeout() -> int:
+    return getattr(settings, 'STOCK_RESERVATION_TIMEOUT', 60 * 15)
+
+
+def reserve_order(order: Order) -> Optional[str]:
+    """
+    Резервирует продукты заказа на STOCK_RESERVATION_TIMEOUT секунд (при подтверждении заказа).
+    Резерв каждого продукта — условный UPDATE ... SET reserved = reserved + n WHERE count - reserved >= n,
+    всё в одной транзакции: если какого-то продукта не хватает, не резервируется ничего.
+    Повторное подтверждение заказа продлевает уже сделанный резерв.
+    :param order:
+    :return: None, если продукты зарезервированы, иначе текст ошибки
+    """
+    expires_at = timezone.now() + timedelta(seconds=get_reservation_timeout())
+    with transaction.atomic():
+        if order.reservations.update(expires_at=expires_at):
+            return None
+        lines = order.products.order_by('product_id').values('product_id').annotate(total=Sum('count'))
+        reservations = []
+        for line in lines:
+            updated = Product.objects.filter(
+                pk=line['product_id'],
+                count__gte=F('reserved') + line['total']
+            ).update(reserved=F('reserved') + line['total'])
+            if not updated:
+                transaction.set_rollback(True)
+                return 'Not enough goods in stock'
+            reservations.append(Reservation(
+                order=order,
+                product_id=line['product_id'],
+                count=line['total'],
+                expires_at=expires_at
+            ))
+        Reservation.objects.bulk_create(reservations)
+        products_changed([reservation.product_id for reservation in reservations])
+    return None
+
+
+def release_reservations(reservations: QuerySet) -> int:
+    """
+    Снимает резервы: удаляет записи резервов, Product.reserved уменьшает сигнал post_delete
+    (shopapp.models.release_reserved_stock). Вызывается внутри транзакции
+    :param reservations: queryset резервов
+    :return: количество снятых резервов
+    """
+    deleted, _ = reservations.delete()
+    return deleted
+
+
+def release_expired_reservations(now: Optional[datetime] = None, chunk_size: int = 1000) -> int:
+    """
+    Снимает истёкшие резервы пачками по chunk_size, каждую пачку в отдельной короткой транзакции
+    :param now: момент, с которым сравнивается срок резерва (по умолчанию текущее время)
+    :param chunk_size:
+    :return: количество снятых резервов
+    """
+    now = now or timezone.now()
+    released = 0
+    while True:
+        with transaction.atomic():
+            expired = Reservation.objects.filter(expires_at__lt=now).order_by('expires_at')
+            pks = list(expired.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return released
+            released += release_reservations(Reservation.objects.filter(pk__in=pks))
+
+
+def pay_order(order: Order) -> Optional[str]:
+    """
+    Списывает остатки по строкам заказа и переводит заказ в статус paid в одной транзакции.
+    Резерв заказа (если он ещё не снят) сначала снимается, затем остаток списывается условным
+    UPDATE ... SET count = count - n WHERE count - reserved >= n,
+    поэтому параллельные оплаты не уводят остаток в минус, не перезаписывают друг друга
+    и не забирают продукты, зарезервированные под другие заказы.
+    Если хотя бы одного продукта не хватает или заказ уже оплачен, транзакция откатывается целиком.
+    :param order:
+    :return: None, если заказ оплачен, иначе текст ошибки
+    """
+    total_cost = get_order_total(order.products.all())
+    with transaction.atomic():
+        # Первым запросом транзакции идёт запись: так SQLite сразу берёт блокировку на запись
+        # и параллельная оплата ждёт её, а не получает ошибку при повышении блокировки чтения
+        paid = Order.objects.filter(pk=order.pk).exclude(status='paid').update(
+            status='paid',
+            totalCost=total_cost,
+            createdAt=timezone.now()
+        )
+        if not paid:
+            transaction.set_rollback(True)
+            return 'Order already paid'
+        # Резерв заказа возвращается в остаток (сигнал post_delete) и тут же списывается;
+        # при ошибке откат транзакции восстанавливает и резерв
+        order.reservations.all().delete()
+        lines = order.products.order_by('product_id').values('product_id').annotate(total=Sum('count'))
+        product_pks = []
+        for line in lines:
+            updated = Product.objects.filter(
+                pk=line['product_id'],
+                count__gte=F('reserved') + line['total']
+            ).update(count=F('count') - line['total'])
+            if not updated:
+                transaction.set_rollback(True)
+                return 'Not enough goods in stock'
+            product_pks.append(line['product_id'])
+        products_changed(product_pks)
+    order.refresh_from_db()
+    return None
 
 
 def get_no_img() -> str:
@@ -217,9 +566,258 @@ def get_price_or_sale_price(instance: Product):
     :param instance:
     :return:
     """
+    return get_effective_price(instance.price, instance.salePrice, instance.dateFrom, instance.dateTo)
+
+
+def get_effective_price(price, sale_price, date_from: Optional[datetime], date_to: Optional[datetime]):
+    """
+    Функция возвращает цену со скидкой, если сегодня идёт акция, иначе обычную цену.
+    :param price:
+    :param sale_price:
+    :param date_from: начало акции
+    :param date_to: окончание акции
+    :return:
+    """
     try:
-        if instance.dateFrom.date() <= datetime.now().date() <= instance.dateTo.date():
-            return instance.salePrice
+        if sale_price is not None and date_from.date() <= datetime.now().date() <= date_to.date():
+            return sale_price
     except:
         pass
-    return instance.price
+    return price
+
+
+def get_effective_price_expression(prefix: str = '') -> Case:
+    """
+    SQL-выражение цены продукта с учётом акции (аналог get_effective_price)
+    :param prefix: путь к продукту, например 'product__' для строк корзины
+    :return:
+    """
+    today = datetime.now().date()
+    return Case(
+        When(
+            Q(**{
+                f'{prefix}dateFrom__date__lte': today,
+                f'{prefix}dateTo__date__gte': today,
+                f'{prefix}salePrice__isnull': False
+            }),
+            then=F(f'{prefix}salePrice')
+        ),
+        default=F(f'{prefix}price'),
+        output_field=DecimalField(max_digits=10, decimal_places=2)
+    )
+
+
+def get_order_total(baskets: QuerySet) -> Decimal:
+    """
+    Считает стоимость строк корзины или заказа одним агрегирующим запросом (цена с учётом акции × количество).
+    Для строк заказа используется цена, зафиксированная при оформлении (snapshot_basket_lines).
+    :param baskets: queryset строк корзины
+    :return:
+    """
+    total = baskets.aggregate(total=Sum(
+        ExpressionWrapper(
+            F('count') * Coalesce('price', get_effective_price_expression('product__')),
+            output_field=DecimalField(max_digits=10, decimal_places=2)
+        )
+    ))['total']
+    return Decimal(total or 0).quantize(Decimal('0.01'))
+
+
+def snapshot_basket_lines(baskets: QuerySet, **fields) -> int:
+    """
+    Одним UPDATE фиксирует в строках корзины цену с учётом акции, название и первое изображение продукта.
+    Вызывается при оформлении заказа, чтобы история заказов не зависела от текущих данных продуктов.
+    :param baskets: queryset строк корзины
+    :param fields: дополнительные поля для обновления, например archived=True, order=order
+    :return: количество обновлённых строк
+    """
+    product = Product.objects.filter(pk=OuterRef('product_id'))
+    first_image = ProductImage.objects.filter(product=OuterRef('product_id')).order_by('pk')
+    return baskets.update(
+        price=Subquery(product.values(effective_price=get_effective_price_expression())[:1]),
+        title=Subquery(product.values('title')[:1]),
+        image=Subquery(first_image.values('image')[:1]),
+        **fields
+    )
+
+
+BASKET_LINE_FIELDS = (
+    'order_id',
+    'count',
+    'product_id',
+    'product__category_id',
+    'product__title',
+    'product__description',
+    'product__freeDelivery',
+    'product__price',
+    'product__salePrice',
+    'product__dateFrom',
+    'product__dateTo',
+)
+
+
+def build_basket_lines(rows: list) -> list:
+    """
+    Функция строит строки корзины из словарей с полями BASKET_LINE_FIELDS.
+    Изображения всех продуктов загружаются одним запросом.
+    :param rows:
+    :return: [(id заказа, строка), ...]
+    """
+    storage = ProductImage._meta.get_field('image').storage
+    images = {}
+    product_images = (
+        ProductImage.objects.
+        filter(product_id__in={row['product_id'] for row in rows}).
+        order_by('pk').
+        values_list('product_id', 'image')
+    )
+    for product_id, image in product_images:
+        images.setdefault(product_id, []).append(dict(src=storage.url(image), alt='No Image'))
+    lines = []
+    for row in rows:
+        line = dict(
+            id=row['product_id'],
+            category=row['product__category_id'],
+            price=get_effective_price(
+                row['product__price'],
+                row['product__salePrice'],
+                row['product__dateFrom'],
+                row['product__dateTo']
+            ),
+            count=row['count'],
+            title=row['product__title'],
+            description=row['product__description'],
+            freeDelivery=row['product__freeDelivery'],
+            images=images.get(row['product_id']) or [dict(src=get_no_img(), alt='No Image')]
+        )
+        lines.append((row['order_id'], line))
+    return lines
+
+
+def get_basket_lines_by_order(baskets: QuerySet) -> list:
+    """
+    Функция строит компактное представление строк корзины или заказа
+    (только поля, которые выводятся на страницах корзины и заказа) за два запроса,
+    независимо от количества строк: строки с данными продукта через values() и изображения продуктов.
+    :param baskets: queryset строк корзины
+    :return: [(id заказа, строка), ...]
+    """
+    return build_basket_lines(list(baskets.order_by('pk').values(*BASKET_LINE_FIELDS)))
+
+
+def get_basket_lines(baskets: QuerySet) -> list:
+    """
+    Компактное представление строк корзины (см. get_basket_lines_by_order)
+    :param baskets:
+    :return:
+    """
+    return [line for order_id, line in get_basket_lines_by_order(baskets)]
+
+
+def get_order_lines(order_pks: list) -> dict:
+    """
+    Строки нескольких заказов одним запросом к таблице корзины без обращения к продуктам:
+    цена, название и изображение берутся из снимка, сделанного при оформлении (snapshot_basket_lines)
+    :param order_pks:
+    :return: dict id заказа -> [строка, ...]
+    """
+    storage = ProductImage._meta.get_field('image').storage
+    order_lines = {order_pk: [] for order_pk in order_pks}
+    rows = (
+        Basket.objects.
+        filter(order__in=order_pks).
+        order_by('pk').
+        values_list('order_id', 'product_id', 'price', 'count', 'title', 'image')
+    )
+    for order_pk, product_pk, price, count, title, image in rows:
+        order_lines[order_pk].append(dict(
+            id=product_pk,
+            price=price,
+            count=count,
+            title=title,
+            images=[dict(src=storage.url(image) if image else get_no_img(), alt='No Image')]
+        ))
+    return order_lines
+
+
+def get_anonymous_basket_store(request: Request, user_param: dict) -> Optional[BasketStore]:
+    """
+    Возвращает хранилище корзины анонимного пользователя или None, если пользователь прошёл аутентификацию
+    :param request:
+    :param user_param: результат get_user_param_create_token или get_user_param_no_create_token
+    :return:
+    """
+    if 'user' not in user_param:
+        return None
+    return get_basket_store(request, user_param['user'])
+
+
+def add_to_basket_store(store: BasketStore, product_id: int, count: int) -> Optional[dict]:
+    """
+    Добавляет продукт в корзину анонимного пользователя по тем же правилам, что и upsert_basket_line:
+    количество ограничивается остатком на складе, но не меньше 1.
+    Если продукта нет или его нет в наличии, функция вернёт None
+    :param store:
+    :param product_id:
+    :param count: на сколько увеличить количество (может быть отрицательным)
+    :return: dict(id=id продукта, count=новое количество в корзине)
+    """
+    stock = get_available_stock([product_id]).get(product_id)
+    if stock is None:
+        return None
+    counts = store.get()
+    counts[product_id] = max(1, min(counts.get(product_id, 0) + count, stock))
+    store.set(counts)
+    return dict(id=product_id, count=counts[product_id])
+
+
+def reconcile_counts_with_stock(counts: dict) -> dict:
+    """
+    Приводит корзину анонимного пользователя в соответствие с остатками одним запросом:
+    продукты, которых нет в наличии (или которые удалены), убираются, количество ограничивается остатком
+    :param counts: dict id продукта -> количество
+    :return: dict id продукта -> количество
+    """
+    if not counts:
+        return {}
+    stock = get_available_stock(counts)
+    return {
+        product_pk: min(count, stock[product_pk])
+        for product_pk, count in counts.items()
+        if product_pk in stock
+    }
+
+
+def get_basket_lines_from_counts(counts: dict) -> list:
+    """
+    Компактное представление корзины анонимного пользователя (см. get_basket_lines_by_order)
+    :param counts: dict id продукта -> количество
+    :return:
+    """
+    product_fields = [field.split('__', 1)[1] for field in BASKET_LINE_FIELDS if field.startswith('product__')]
+    rows = []
+    for product in Product.objects.filter(pk__in=counts).order_by('pk').values('pk', *product_fields):
+        row = {f'product__{field}': product[field] for field in product_fields}
+        row.update(order_id=None, product_id=product['pk'], count=counts[product['pk']])
+        rows.append(row)
+    return [line for order_id, line in build_basket_lines(rows)]
+
+
+def persist_anonymous_basket(store: BasketStore, **owner) -> int:
+    """
+    Переносит корзину анонимного пользователя в активные строки Basket и очищает хранилище.
+    Вызывается при оформлении заказа и при входе пользователя.
+    Активные строки владельца с теми же продуктами заменяются.
+    :param store:
+    :param owner: user=token или user_auth_user=user
+    :return: количество созданных строк
+    """
+    counts = reconcile_counts_with_stock(store.get())
+    if counts:
+        Basket.objects.filter(archived=False, product__in=counts, **owner).delete()
+        Basket.objects.bulk_create([
+            Basket(product_id=product_pk, count=count, archived=False, **owner)
+            for product_pk, count in counts.items()
+        ])
+    store.clear()
+    return len(counts)
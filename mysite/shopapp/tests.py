@@ -1,3 +1,1502 @@
-from django.test import TestCase
+import contextlib
+import io
+import random
+import threading
+import time
+from datetime import timedelta
+from decimal import ROUND_HALF_UP, Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import QueryDict
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from myprofile.models import Profile
+
+from .baskets import BasketStore, CacheBasketStore, SessionBasketStore
+from .cache import CATALOG_GENERATION_KEY, _bump_catalog_generation, get_catalog_generation
+from .cleanup import collect_garbage, delete_in_chunks
+from .facets import COMPACTION_MIN_GARBAGE, FacetIndex, FacetSnapshot, catalog_facet_index
+from .idempotency import IDEMPOTENCY_REPLAYED_HEADER, idempotent
+from .models import (
+    Category, SubCategory, Product, Order, Basket, BasketMergeClaim, IdempotencyKey, PaymentJob, ProductImage,
+    Reservation, Reviews, Tag
+)
+from .payments import process_payment_jobs
+from .search import search_products
+from .services import (
+    encode_cursor,
+    get_basket_lines,
+    get_basket_lines_from_counts,
+    get_effective_price,
+    get_effective_price_expression,
+    get_keyset_page,
+    get_no_img,
+    get_order_total,
+    pay_order,
+    payment_validator,
+    reconcile_baskets_with_stock,
+    release_expired_reservations,
+    reserve_order,
+    upsert_basket_line,
+)
+
+ORDER_DATA = {
+    'fullName': 'Ivan Ivanov',
+    'email': 'ivan@example.com',
+    'phone': '+79990000000',
+    'deliveryType': 'ordinary',
+    'paymentType': 'online',
+    'city': 'Moscow',
+    'address': 'Red Square, 1',
+}
+PAYMENT_DATA = {'number': '12345678', 'name': 'Ivan Ivanov', 'month': '12', 'year': '2099', 'code': '123'}
+
+
+@override_settings(PAYMENT_WORKERS=0)
+class PaymentConcurrencyTestCase(TransactionTestCase):
+    """
+    Параллельные оплаты из нескольких потоков не должны уводить остаток в минус
+    и не должны оплачивать один заказ дважды.
+    Очередь оплат обрабатывается в потоке запроса (PAYMENT_WORKERS=0), чтобы потоки теста соревновались за остатки
+    """
+    threads_count = 12
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.product = Product.objects.create(
+            category=subcategory,
+            title='product',
+            price=Decimal('10.00'),
+            count=5
+        )
+
+    def create_order(self, count: int, status: str = 'confirmed') -> Order:
+        order = Order.objects.create(user_auth_user=self.user, status=status)
+        Basket.objects.create(
+            user_auth_user=self.user,
+            product=self.product,
+            count=count,
+            order=order,
+            archived=True,
+            price=self.product.price
+        )
+        return order
+
+    def post_concurrently(self, url_name: str, order_pks: list, data: dict) -> list:
+        barrier = threading.Barrier(len(order_pks))
+        responses = [None] * len(order_pks)
+
+        def pay(index: int, order_pk: int) -> None:
+            try:
+                client = Client()
+                client.force_login(self.user)
+                barrier.wait()
+                response = client.post(
+                    reverse(url_name, kwargs={'id': order_pk}),
+                    data,
+                    content_type='application/json'
+                )
+                responses[index] = response
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=pay, args=(index, pk)) for index, pk in enumerate(order_pks)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def pay_concurrently(self, order_pks: list) -> dict:
+        responses = self.post_concurrently('shopapp:payment-api', order_pks, PAYMENT_DATA)
+        self.assertEqual([response.status_code for response in responses], [202] * len(order_pks))
+        return {
+            status: PaymentJob.objects.filter(status=status).count()
+            for status in ('queued', 'processing', 'paid', 'failed')
+        }
+
+    def test_last_units_are_sold_once(self):
+        orders = [self.create_order(count=1) for _ in range(self.threads_count)]
+        jobs = self.pay_concurrently([order.pk for order in orders])
+        self.product.refresh_from_db()
+        self.assertEqual(jobs, dict(queued=0, processing=0, paid=5, failed=self.threads_count - 5))
+        self.assertEqual(self.product.count, 0)
+        self.assertEqual(Order.objects.filter(status='paid').count(), 5)
+
+    def test_order_is_paid_once(self):
+        order = self.create_order(count=2)
+        jobs = self.pay_concurrently([order.pk] * self.threads_count)
+        self.product.refresh_from_db()
+        self.assertEqual(jobs['paid'], 1)
+        self.assertEqual(self.product.count, 3)
+
+    def test_payment_is_all_or_nothing(self):
+        other_product = Product.objects.create(
+            category=self.product.category,
+            title='other product',
+            price=Decimal('5.00'),
+            count=1
+        )
+        order = self.create_order(count=2)
+        Basket.objects.create(
+            user_auth_user=self.user,
+            product=other_product,
+            count=1,
+            order=order,
+            archived=True
+        )
+        Product.objects.filter(pk=other_product.pk).update(count=0)
+        jobs = self.pay_concurrently([order.pk])
+        self.product.refresh_from_db()
+        self.assertEqual(jobs['failed'], 1)
+        self.assertEqual(self.product.count, 5)
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'confirmed')
+
+    def test_confirmations_reserve_stock_once(self):
+        orders = [self.create_order(count=1, status='created') for _ in range(self.threads_count)]
+        responses = self.post_concurrently('shopapp:order-id-api', [order.pk for order in orders], ORDER_DATA)
+        self.product.refresh_from_db()
+        self.assertEqual([response.status_code for response in responses].count(200), 5)
+        self.assertEqual(self.product.reserved, 5)
+        self.assertEqual(self.product.count, 5)
+        confirmed = Order.objects.filter(status='confirmed')
+        self.assertEqual(confirmed.count(), 5)
+        jobs = self.pay_concurrently(list(confirmed.values_list('pk', flat=True)))
+        self.product.refresh_from_db()
+        self.assertEqual(jobs['paid'], 5)
+        self.assertEqual((self.product.count, self.product.reserved), (0, 0))
+
+
+@override_settings(PAYMENT_WORKERS=2)
+class PaymentQueueTestCase(PaymentConcurrencyTestCase):
+    """
+    Те же сценарии через пул обработчиков: запрос сразу возвращает задание, результат читается эндпоинтом статуса
+    """
+
+    def pay_concurrently(self, order_pks: list) -> dict:
+        responses = self.post_concurrently('shopapp:payment-api', order_pks, PAYMENT_DATA)
+        client = Client()
+        client.force_login(self.user)
+        for response in responses:
+            self.assertEqual(response.status_code, 202)
+            deadline = time.monotonic() + 10
+            job = response.json()
+            while job['status'] == 'processing' and time.monotonic() < deadline:
+                time.sleep(0.05)
+                job = client.get(reverse('shopapp:payment-job-api', kwargs={'id': job['jobId']})).json()
+            self.assertIn(job['status'], ('paid', 'failed'))
+        return {
+            status: PaymentJob.objects.filter(status=status).count()
+            for status in ('queued', 'processing', 'paid', 'failed')
+        }
+
+    def test_invalid_card_is_rejected_without_job(self):
+        order = self.create_order(count=1)
+        client = Client()
+        client.force_login(self.user)
+        response = client.post(
+            reverse('shopapp:payment-api', kwargs={'id': order.pk}),
+            {**PAYMENT_DATA, 'number': '1234567'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PaymentJob.objects.exists())
+
+
+@override_settings(PAYMENT_WORKERS=0, PAYMENT_JOB_TIMEOUT=60)
+class PaymentJobRecoveryTestCase(TestCase):
+    """
+    Задание, брошенное в статусе processing упавшим обработчиком, захватывается повторно после PAYMENT_JOB_TIMEOUT
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.product = Product.objects.create(
+            category=subcategory,
+            title='product',
+            price=Decimal('10.00'),
+            count=5
+        )
+
+    def create_order(self) -> Order:
+        order = Order.objects.create(user_auth_user=self.user, status='confirmed')
+        Basket.objects.create(
+            user_auth_user=self.user,
+            product=self.product,
+            count=1,
+            order=order,
+            archived=True,
+            price=self.product.price
+        )
+        return order
+
+    def create_processing_job(self, order: Order, seconds_ago: int) -> PaymentJob:
+        return PaymentJob.objects.create(
+            order=order,
+            status='processing',
+            worker='crashed',
+            attempts=1,
+            started_at=timezone.now() - timedelta(seconds=seconds_ago)
+        )
+
+    def test_abandoned_job_is_claimed_again(self):
+        abandoned = self.create_processing_job(self.create_order(), seconds_ago=61)
+        running = self.create_processing_job(self.create_order(), seconds_ago=10)
+        self.assertEqual(process_payment_jobs(), 1)
+        abandoned.refresh_from_db()
+        running.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((abandoned.status, abandoned.attempts), ('paid', 2))
+        self.assertEqual(running.status, 'processing')
+        self.assertEqual(self.product.count, 4)
+
+    def test_job_that_paid_before_crash_is_marked_paid(self):
+        order = self.create_order()
+        self.assertIsNone(pay_order(order))
+        job = self.create_processing_job(order, seconds_ago=61)
+        process_payment_jobs()
+        job.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(job.status, 'paid')
+        self.assertEqual(self.product.count, 4)
+
+    def test_payment_retry_recovers_abandoned_job(self):
+        order = self.create_order()
+        job = self.create_processing_job(order, seconds_ago=61)
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('shopapp:payment-api', kwargs={'id': order.pk}),
+                PAYMENT_DATA,
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['jobId'], job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'paid')
+
+
+class ReservationReleaseTestCase(TestCase):
+    """
+    Резерв возвращается в остаток при любом удалении: снятие по сроку, удаление заказа, каскад от пользователя
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.product = Product.objects.create(
+            category=subcategory,
+            title='product',
+            price=Decimal('10.00'),
+            count=5
+        )
+        self.order = Order.objects.create(user_auth_user=self.user, status='confirmed')
+        Basket.objects.create(
+            user_auth_user=self.user,
+            product=self.product,
+            count=2,
+            order=self.order,
+            archived=True,
+            price=self.product.price
+        )
+        self.assertIsNone(reserve_order(self.order))
+        self.assert_reserved(2)
+
+    def assert_reserved(self, reserved: int) -> None:
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved, reserved)
+
+    def test_expired_reservation_is_released(self):
+        self.assertEqual(release_expired_reservations(timezone.now() + timedelta(days=1)), 1)
+        self.assert_reserved(0)
+
+    def test_order_delete_releases_reservation(self):
+        self.order.delete()
+        self.assert_reserved(0)
+
+    def test_queryset_delete_releases_reservation(self):
+        User.objects.filter(pk=self.user.pk).delete()
+        self.assert_reserved(0)
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_payment_consumes_reservation(self):
+        self.assertIsNone(pay_order(self.order))
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.count, self.product.reserved), (3, 0))
+
+
+class BasketReconcileTestCase(TestCase):
+    """
+    Корзина приводится к остаткам, но без записи в базу, если исправлять нечего
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.plenty = Product.objects.create(category=subcategory, title='plenty', price=Decimal('10.00'), count=5)
+        self.scarce = Product.objects.create(category=subcategory, title='scarce', price=Decimal('10.00'), count=3)
+        for product in (self.plenty, self.scarce):
+            Basket.objects.create(user_auth_user=self.user, product=product, count=2)
+        self.baskets = Basket.objects.filter(user_auth_user=self.user, archived=False)
+
+    def test_nothing_to_fix_reads_only(self):
+        with self.assertNumQueries(1):
+            reconcile_baskets_with_stock(self.baskets)
+
+    def test_lines_follow_available_stock(self):
+        Product.objects.filter(pk=self.scarce.pk).update(reserved=2)
+        Product.objects.filter(pk=self.plenty.pk).update(reserved=5)
+        reconcile_baskets_with_stock(self.baskets)
+        self.assertEqual(list(self.baskets.values_list('product', 'count')), [(self.scarce.pk, 1)])
+
+
+class CatalogGenerationTestCase(TestCase):
+    """
+    Поколение кэша каталога не повторяется после сброса и после вытеснения из кэша
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_generation_never_repeats(self):
+        seen = {get_catalog_generation()}
+        _bump_catalog_generation()
+        seen.add(get_catalog_generation())
+        cache.delete(CATALOG_GENERATION_KEY)
+        seen.add(get_catalog_generation())
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(get_catalog_generation(), get_catalog_generation())
+
+
+class ReviewCountersTestCase(TestCase):
+    """
+    Счётчики отзывов и рейтинг продукта следуют за таблицей отзывов при любом способе изменения
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.product = Product.objects.create(category=subcategory, title='product', price=Decimal('10.00'))
+
+    def create_review(self, rate, user: User = None) -> Reviews:
+        return Reviews.objects.create(product_review=self.product, author_auth_user=user, rate=rate)
+
+    def assert_counters(self, reviews_count: int, rating_sum: int, rating_count: int, rating) -> None:
+        self.product.refresh_from_db()
+        self.assertEqual(
+            (self.product.reviews_count, self.product.rating_sum, self.product.rating_count, self.product.rating),
+            (reviews_count, rating_sum, rating_count, rating)
+        )
+
+    def test_save_and_delete(self):
+        review = self.create_review(4)
+        self.create_review(None)
+        self.assert_counters(2, 4, 1, Decimal('4.0'))
+        review.rate = 5
+        review.save()
+        self.assert_counters(2, 5, 1, Decimal('5.0'))
+        review.delete()
+        self.assert_counters(1, 0, 0, None)
+
+    def test_queryset_and_cascade_delete(self):
+        self.create_review(5)
+        self.create_review(2)
+        self.create_review(3, user=self.user)
+        self.assert_counters(3, 10, 3, Decimal('3.3'))
+        Reviews.objects.filter(rate=5).delete()
+        self.assert_counters(2, 5, 2, Decimal('2.5'))
+        self.user.delete()
+        self.assert_counters(1, 2, 1, Decimal('2.0'))
+
+
+class OrderSnapshotTestCase(TestCase):
+    """
+    Заказ хранит цену, название и изображение продуктов на момент оформления
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        Profile.objects.create(user=self.user, fullName='Ivan Ivanov')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        today = timezone.now()
+        self.sale = Product.objects.create(
+            category=subcategory,
+            title='sale',
+            price=Decimal('100.00'),
+            discount=Decimal('10.0'),
+            dateFrom=today,
+            dateTo=today,
+            count=10
+        )
+        self.plain = Product.objects.create(category=subcategory, title='plain', price=Decimal('10.00'), count=10)
+        self.image = ProductImage.objects.create(product=self.sale, image='products/sale/first.jpg')
+        ProductImage.objects.create(product=self.sale, image='products/sale/second.jpg')
+        Basket.objects.create(user_auth_user=self.user, product=self.sale, count=1)
+        Basket.objects.create(user_auth_user=self.user, product=self.plain, count=2)
+        self.client.force_login(self.user)
+
+    def get_order(self, order_pk: int) -> dict:
+        response = self.client.get(reverse('shopapp:order-id-api', kwargs={'id': order_pk}))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def get_products(self, order: dict) -> list:
+        return [
+            (item['id'], Decimal(str(item['price'])), item['count'], item['title'], item['images'][0]['src'])
+            for item in order['products']
+        ]
+
+    def test_order_keeps_snapshot(self):
+        response = self.client.post(reverse('shopapp:orders-api'), {}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        order_pk = response.json()['orderId']
+        before = self.get_order(order_pk)
+        expected = [
+            (self.sale.pk, Decimal('90.00'), 1, 'sale', self.image.image.url),
+            (self.plain.pk, Decimal('10.00'), 2, 'plain', get_no_img()),
+        ]
+        self.assertEqual(self.get_products(before), expected)
+        self.assertEqual(Decimal(str(before['totalCost'])), Decimal('110.00'))
+
+        self.sale.title = 'sale renamed'
+        self.sale.price = Decimal('200.00')
+        self.sale.dateTo = None
+        self.sale.save()
+        self.image.delete()
+        self.plain.title = 'plain renamed'
+        self.plain.price = Decimal('1.00')
+        self.plain.save()
+        ProductImage.objects.create(product=self.plain, image='products/plain/new.jpg')
+
+        after = self.get_order(order_pk)
+        self.assertEqual(self.get_products(after), expected)
+        self.assertEqual(Decimal(str(after['totalCost'])), Decimal('110.00'))
+        self.assertEqual(get_order_total(Order.objects.get(pk=order_pk).products.all()), Decimal('110.00'))
+        history = self.client.get(reverse('shopapp:orders-api')).json()['items']
+        self.assertEqual([self.get_products(order) for order in history], [expected])
+
+
+class OrderHistoryTestCase(TestCase):
+    """
+    Курсор истории заказов не пропускает и не повторяет заказы, оплаченные во время листания
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.product = Product.objects.create(category=subcategory, title='product', price=Decimal('10.00'), count=10)
+        self.orders = []
+        for _ in range(5):
+            order = Order.objects.create(user_auth_user=self.user, status='confirmed')
+            Basket.objects.create(
+                user_auth_user=self.user,
+                product=self.product,
+                count=1,
+                order=order,
+                archived=True,
+                price=self.product.price
+            )
+            self.orders.append(order)
+        self.client.force_login(self.user)
+
+    def get_page(self, cursor: str = ''):
+        return self.client.get(reverse('shopapp:orders-api'), {'limit': 2, 'cursor': cursor})
+
+    def test_payment_during_paging(self):
+        data = self.get_page().json()
+        seen = [item['id'] for item in data['items']]
+        pay_order(self.orders[0])
+        while data['nextCursor']:
+            data = self.get_page(data['nextCursor']).json()
+            seen += [item['id'] for item in data['items']]
+        self.assertEqual(seen, [order.pk for order in reversed(self.orders)])
+
+    def test_bad_cursor(self):
+        self.assertEqual(self.get_page('broken').status_code, 400)
+
+
+class AnonymousBasketStoreTestCase(TestCase):
+    """
+    Корзина анонимного пользователя живёт в хранилище (сессия или кэш) и не создаёт строк Basket
+    """
+    stores = ('shopapp.baskets.SessionBasketStore', 'shopapp.baskets.CacheBasketStore')
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.first = Product.objects.create(category=subcategory, title='first', price=Decimal('10.00'), count=3)
+        self.second = Product.objects.create(category=subcategory, title='second', price=Decimal('5.00'), count=10)
+
+    def get_counts(self, response) -> dict:
+        self.assertEqual(response.status_code, 200)
+        return {line['id']: line['count'] for line in response.json()}
+
+    def change(self, method: str, product: Product, count: int):
+        return getattr(self.client, method)(
+            reverse('shopapp:basket-api'),
+            {'id': product.pk, 'count': count},
+            content_type='application/json'
+        )
+
+    def test_add_remove_clear(self):
+        for store in self.stores:
+            with self.subTest(store=store), override_settings(ANONYMOUS_BASKET_STORE=store):
+                self.client = Client()
+                self.assertEqual(self.get_counts(self.change('post', self.first, 2)), {self.first.pk: 2})
+                self.assertEqual(
+                    self.get_counts(self.change('post', self.first, 5)),
+                    {self.first.pk: 3},
+                    'count is clamped to stock'
+                )
+                self.assertEqual(
+                    self.get_counts(self.change('post', self.second, 4)),
+                    {self.first.pk: 3, self.second.pk: 4}
+                )
+                self.assertEqual(
+                    self.get_counts(self.change('delete', self.second, 1)),
+                    {self.first.pk: 3, self.second.pk: 3}
+                )
+                self.assertEqual(self.get_counts(self.change('delete', self.first, 3)), {self.second.pk: 3})
+                self.assertEqual(self.get_counts(self.client.get(reverse('shopapp:basket-api'))), {self.second.pk: 3})
+                self.assertEqual(self.get_counts(self.change('delete', self.second, 3)), {})
+                self.assertEqual(self.change('delete', self.second, 1).status_code, 404)
+                self.assertFalse(Basket.objects.exists())
+
+    def test_store_roundtrip(self):
+        request = RequestFactory().get('/')
+        request.session = {}
+        for store_class in (SessionBasketStore, CacheBasketStore):
+            with self.subTest(store=store_class.__name__):
+                store = store_class(request, 'token')
+                self.assertEqual(store.get(), {})
+                store.set({self.first.pk: 2, self.second.pk: 0})
+                self.assertEqual(store.get(), {self.first.pk: 2})
+                store.set({})
+                self.assertEqual(store.get(), {})
+                store.set({self.second.pk: 1})
+                store.clear()
+                self.assertEqual(store.get(), {})
+        with self.assertRaises(TypeError):
+            BasketStore(request, 'token')
+
+
+class CollectGarbageTestCase(TestCase):
+    """
+    collect_garbage удаляет только устаревшие данные и не удаляет строки, изменившиеся после выборки пачки
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.product = Product.objects.create(category=subcategory, title='product', price=Decimal('10.00'), count=5)
+        self.created_order = Order.objects.create(user_auth_user=self.user, status='created')
+        self.kept_order = Order.objects.create(user_auth_user=self.user, status='confirmed')
+        Basket.objects.create(user='token', product=self.product, count=1)
+        Basket.objects.create(user_auth_user=self.user, product=self.product, count=1)
+        Basket.objects.create(user_auth_user=self.user, product=self.product, count=1, archived=True)
+        Basket.objects.create(
+            user_auth_user=self.user,
+            product=self.product,
+            count=1,
+            archived=True,
+            order=self.kept_order
+        )
+        IdempotencyKey.objects.create(key='key', status_code=200)
+        BasketMergeClaim.objects.create(token='token')
+        PaymentJob.objects.create(order=self.kept_order, status='paid', finished_at=timezone.now())
+        PaymentJob.objects.create(order=self.kept_order, status='queued')
+        Reservation.objects.create(
+            order=self.kept_order,
+            product=self.product,
+            count=1,
+            expires_at=timezone.now() + timedelta(minutes=15)
+        )
+        self.later = timezone.now() + timedelta(days=31)
+
+    def test_collect_garbage(self):
+        self.assertEqual(collect_garbage(now=self.later, chunk_size=1), dict(
+            reservations=1,
+            anonymous_baskets=1,
+            archived_baskets=1,
+            created_orders=1,
+            idempotency_keys=1,
+            payment_jobs=1,
+            basket_merge_claims=1,
+            sessions=0,
+        ))
+        self.assertEqual(list(Order.objects.values_list('pk', flat=True)), [self.kept_order.pk])
+        self.assertEqual(Basket.objects.count(), 2)
+        self.assertEqual(list(PaymentJob.objects.values_list('status', flat=True)), ['queued'])
+        self.assertEqual(collect_garbage(now=self.later)['created_orders'], 0)
+
+    def test_row_changed_after_select_is_kept(self):
+        atomic = transaction.atomic
+
+        def confirm_then_atomic(*args, **kwargs):
+            Order.objects.filter(pk=self.created_order.pk).update(status='confirmed')
+            return atomic(*args, **kwargs)
+
+        orders = Order.objects.filter(status='created')
+        with mock.patch('shopapp.cleanup.transaction.atomic', side_effect=confirm_then_atomic):
+            self.assertEqual(delete_in_chunks(orders, 10), 0)
+        self.assertTrue(Order.objects.filter(pk=self.created_order.pk).exists())
+
+    def test_command_report(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('collect_garbage', created_orders_days=0, anonymous_baskets_days=365, chunk_size=10)
+        lines = output.getvalue().splitlines()
+        self.assertIn('created_orders deleted: 1', lines)
+        self.assertIn('anonymous_baskets deleted: 0', lines)
+        self.assertEqual(lines[-1], 'ok')
+        self.assertFalse(Order.objects.filter(status='created').exists())
+
+
+class BasketUpsertTestCase(TestCase):
+    """
+    upsert_basket_line: вставка строки, увеличение количества при конфликте, ограничение остатком, отказ без остатка
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.product = Product.objects.create(
+            category=subcategory,
+            title='product',
+            price=Decimal('10.00'),
+            count=5,
+            reserved=1
+        )
+        self.owners = (dict(user_auth_user=self.user), dict(user='token'))
+
+    def get_line(self, owner: dict) -> Basket:
+        return Basket.objects.get(archived=False, product=self.product, **owner)
+
+    def test_insert_and_increment(self):
+        for owner in self.owners:
+            with self.subTest(owner=list(owner)):
+                self.assertEqual(upsert_basket_line(owner, self.product.pk, 2), dict(id=self.product.pk, count=2))
+                self.assertEqual(upsert_basket_line(owner, self.product.pk, 1), dict(id=self.product.pk, count=3))
+                self.assertEqual(self.get_line(owner).count, 3)
+                self.assertEqual(Basket.objects.filter(archived=False, **owner).count(), 1)
+
+    def test_archived_line_is_not_reused(self):
+        owner = self.owners[0]
+        Basket.objects.create(product=self.product, count=2, archived=True, **owner)
+        self.assertEqual(upsert_basket_line(owner, self.product.pk, 1)['count'], 1)
+        self.assertEqual(Basket.objects.filter(product=self.product, **owner).count(), 2)
+
+    def test_clamped_to_stock(self):
+        owner = self.owners[0]
+        self.assertEqual(upsert_basket_line(owner, self.product.pk, 10)['count'], 4)
+        self.assertEqual(upsert_basket_line(owner, self.product.pk, 3)['count'], 4)
+        self.assertEqual(upsert_basket_line(owner, self.product.pk, -10)['count'], 1)
+        self.assertEqual(self.get_line(owner).count, 1)
+
+    def test_out_of_stock_rejected(self):
+        owner = self.owners[0]
+        Product.objects.filter(pk=self.product.pk).update(reserved=5)
+        self.assertIsNone(upsert_basket_line(owner, self.product.pk, 1))
+        self.assertIsNone(upsert_basket_line(owner, self.product.pk + 100, 1))
+        self.assertFalse(Basket.objects.exists())
+
+
+class BasketLinesQueriesTestCase(TestCase):
+    """
+    Строки корзины строятся за два запроса независимо от количества строк и изображений
+    """
+
+    def setUp(self):
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.products = [
+            Product.objects.create(category=subcategory, title=f'product {index}', price=Decimal('10.00'), count=10)
+            for index in range(20)
+        ]
+        for product in self.products[::2]:
+            ProductImage.objects.create(product=product, image=f'products/{product.pk}/first.jpg')
+            ProductImage.objects.create(product=product, image=f'products/{product.pk}/second.jpg')
+
+    def test_num_queries(self):
+        for size in (1, 5, 20):
+            with self.subTest(size=size):
+                token = f'token-{size}'
+                Basket.objects.bulk_create([
+                    Basket(user=token, product=product, count=2) for product in self.products[:size]
+                ])
+                with self.assertNumQueries(2):
+                    lines = get_basket_lines(Basket.objects.filter(user=token, archived=False))
+                self.assertEqual([line['id'] for line in lines], [product.pk for product in self.products[:size]])
+                self.assertEqual(len(lines[0]['images']), 2)
+                if size > 1:
+                    self.assertEqual(lines[1]['images'], [dict(src=get_no_img(), alt='No Image')])
+                counts = {product.pk: 3 for product in self.products[:size]}
+                with self.assertNumQueries(2):
+                    anonymous_lines = get_basket_lines_from_counts(counts)
+                self.assertEqual([line['count'] for line in anonymous_lines], [3] * size)
+
+
+class KeysetPaginationTestCase(TestCase):
+    """
+    Курсорная пагинация каталога: проход по страницам с одинаковыми значениями и NULL в ключе сортировки,
+    совпадение со страницами по номеру, 400 при повреждённом курсоре
+    """
+    ratings = (None, Decimal('4.5'), Decimal('4.5'), Decimal('3.0'), None, Decimal('4.5'), Decimal('1.0'))
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        for index in range(11):
+            Product.objects.create(
+                category=subcategory,
+                title=f'product {index}',
+                price=Decimal(index * 7 % 11 + 1),
+                count=1,
+                rating=cls.ratings[index % len(cls.ratings)]
+            )
+        now = timezone.now()
+        Product.objects.filter(pk__in=Product.objects.order_by('pk').values('pk')[:6]).update(date=now)
+        Product.objects.exclude(date=now).update(date=now - timedelta(days=1))
+
+    def setUp(self):
+        cache.clear()
+
+    def get_expected(self, sort: str) -> list:
+        """
+        Порядок (sort, id) с NULL первыми при возрастании и последними при убывании
+        :param sort:
+        :return: список id
+        """
+        field = sort.lstrip('-')
+        rows = list(Product.objects.values_list(field, 'pk'))
+        nulls = sorted(pk for value, pk in rows if value is None)
+        values = [pk for value, pk in sorted(row for row in rows if row[0] is not None)]
+        if sort.startswith('-'):
+            return values[::-1] + nulls[::-1]
+        return nulls + values
+
+    def walk(self, get_page) -> list:
+        pks, cursor = [], ''
+        for _ in range(Product.objects.count() + 1):
+            page, cursor = get_page(cursor)
+            pks += page
+            if cursor is None:
+                return pks
+        self.fail('cursor pages do not end')
+
+    def get_catalog(self, params: dict) -> dict:
+        cache.clear()
+        response = self.client.get(reverse('shopapp:catalog-api'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_ties_and_nulls(self):
+        for sort in ('rating', '-rating', 'date', '-date', 'price', '-price'):
+            with self.subTest(sort=sort):
+                def get_page(cursor: str) -> tuple:
+                    page, next_cursor = get_keyset_page(Product.objects.all(), sort, cursor, 3)
+                    return [product.pk for product in page], next_cursor
+
+                self.assertEqual(self.walk(get_page), self.get_expected(sort))
+
+    def test_api_cursor_pages(self):
+        for sort_type, prefix in (('dec', '-'), ('inc', '')):
+            with self.subTest(sort_type=sort_type):
+                def get_page(cursor: str) -> tuple:
+                    data = self.get_catalog({'sort': 'rating', 'sortType': sort_type, 'limit': 2, 'cursor': cursor})
+                    return [item['id'] for item in data['items']], data['nextCursor']
+
+                self.assertEqual(self.walk(get_page), self.get_expected(f'{prefix}rating'))
+
+    @override_settings(CATALOG_FACET_INDEX_ENABLED=False)
+    def test_cursor_pages_match_offset_pages(self):
+        for sort_type in ('dec', 'inc'):
+            params = {'sort': 'price', 'sortType': sort_type, 'limit': 3}
+            offset_pages, cursor_pages, cursor = [], [], ''
+            data = self.get_catalog(params)
+            for page in range(1, data['lastPage'] + 1):
+                offset_pages.append([item['id'] for item in self.get_catalog({**params, 'currentPage': page})['items']])
+            while cursor is not None:
+                data = self.get_catalog({**params, 'cursor': cursor})
+                cursor_pages.append([item['id'] for item in data['items']])
+                cursor = data['nextCursor']
+            self.assertEqual(cursor_pages, offset_pages, sort_type)
+
+    def test_bad_cursor(self):
+        for cursor in ('broken', encode_cursor(['4.5']), encode_cursor(['4.5', 'id'])):
+            with self.subTest(cursor=cursor):
+                cache.clear()
+                response = self.client.get(reverse('shopapp:catalog-api'), {'sort': 'rating', 'cursor': cursor})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {'error': 'Incorrect data'})
+
+
+class ProductReviewAPITestCase(TestCase):
+    """
+    Отзывы продукта: курсорные страницы (новые сначала) и ответ на добавление отзыва с новым рейтингом
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.product = Product.objects.create(category=subcategory, title='product', price=Decimal('10.00'))
+        self.url = reverse('shopapp:product-review-api', kwargs={'id': self.product.pk})
+
+    def get_page(self, **params):
+        return self.client.get(self.url, params)
+
+    def post_review(self, **review):
+        data = dict(author='', email='author@example.com', text='text', rate=4)
+        data.update(review)
+        return self.client.post(self.url, data, content_type='application/json')
+
+    def test_pages(self):
+        reviews = [
+            Reviews.objects.create(product_review=self.product, author=f'author {index}', rate=index + 1)
+            for index in range(5)
+        ]
+        now = timezone.now()
+        Reviews.objects.filter(pk__in=[review.pk for review in reviews[:3]]).update(date=now)
+        Reviews.objects.filter(pk__in=[review.pk for review in reviews[3:]]).update(date=now - timedelta(days=1))
+        authors, cursor = [], ''
+        while cursor is not None:
+            response = self.get_page(limit=2, cursor=cursor)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertEqual(data['count'], 5)
+            self.assertLessEqual(len(data['items']), 2)
+            authors += [item['author'] for item in data['items']]
+            cursor = data['nextCursor']
+        self.assertEqual(authors, ['author 2', 'author 1', 'author 0', 'author 4', 'author 3'])
+        data = self.get_page().json()
+        self.assertEqual((len(data['items']), data['nextCursor']), (5, None))
+
+    def test_bad_request(self):
+        self.assertEqual(self.get_page(cursor='broken').status_code, 400)
+        self.assertEqual(self.get_page(limit='many').status_code, 400)
+        missing = reverse('shopapp:product-review-api', kwargs={'id': self.product.pk + 1})
+        self.assertEqual(self.client.get(missing).status_code, 404)
+
+    def test_post(self):
+        response = self.post_review()
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(
+            {key: data['review'][key] for key in ('author', 'email', 'text', 'rate')},
+            dict(author='Anonymous', email='author@example.com', text='text', rate=4)
+        )
+        self.assertEqual((Decimal(str(data['rating'])), data['reviewsCount']), (Decimal('4.0'), 1))
+        self.assertIsNone(Reviews.objects.get().author_auth_user)
+
+        self.client.force_login(self.user)
+        data = self.post_review(author='Ivan', rate=1).json()
+        self.assertEqual(data['review']['author'], 'Ivan')
+        self.assertEqual((Decimal(str(data['rating'])), data['reviewsCount']), (Decimal('2.5'), 2))
+        self.assertEqual(Reviews.objects.get(author='Ivan').author_auth_user, self.user)
+        self.assertEqual(self.get_page().json()['count'], 2)
+
+    def test_post_invalid(self):
+        response = self.post_review(rate=6)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Incorrect data'})
+        self.assertFalse(Reviews.objects.exists())
+
+
+class EffectivePriceTestCase(TestCase):
+    """
+    Цена с учётом акции: границы периода акции включаются, сумма заказа считается в Decimal с округлением до копеек
+    """
+
+    def setUp(self):
+        category = Category.objects.create(title='category')
+        self.subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def create_product(self, title: str, price: str, sale_price, date_from, date_to) -> Product:
+        product = Product.objects.create(category=self.subcategory, title=title, price=Decimal(price), count=100)
+        # save() пересчитывает salePrice из discount, поэтому поля акции задаются обновлением
+        Product.objects.filter(pk=product.pk).update(
+            salePrice=sale_price and Decimal(sale_price),
+            dateFrom=date_from,
+            dateTo=date_to
+        )
+        return product
+
+    def test_sale_window_boundaries(self):
+        day = timedelta(days=1)
+        last_second = day - timedelta(seconds=1)
+        expected = {
+            self.create_product('starts today', '10.00', '7.00', self.today, self.today + day).pk: Decimal('7.00'),
+            self.create_product('ends today', '10.00', '7.00', self.today - day, self.today + last_second).pk:
+                Decimal('7.00'),
+            self.create_product('ended yesterday', '10.00', '7.00', self.today - day, self.today - day + last_second).pk:
+                Decimal('10.00'),
+            self.create_product('starts tomorrow', '10.00', '7.00', self.today + day, self.today + 2 * day).pk:
+                Decimal('10.00'),
+            self.create_product('no dates', '10.00', '7.00', None, None).pk: Decimal('10.00'),
+            self.create_product('open end', '10.00', '7.00', self.today, None).pk: Decimal('10.00'),
+            self.create_product('no sale price', '10.00', None, self.today, self.today + day).pk: Decimal('10.00'),
+        }
+        products = Product.objects.annotate(effective_price=get_effective_price_expression())
+        for product in products:
+            with self.subTest(product=product.title):
+                self.assertEqual(product.effective_price, expected[product.pk])
+                self.assertEqual(
+                    get_effective_price(product.price, product.salePrice, product.dateFrom, product.dateTo),
+                    expected[product.pk]
+                )
+
+    def test_order_total_rounding(self):
+        lines = (
+            (self.create_product('cheap', '0.10', None, None, None), 7),
+            (self.create_product('regular', '19.99', None, None, None), 3),
+            (self.create_product('on sale', '50.00', '33.33', self.today, self.today), 3),
+            (self.create_product('ordered', '12.34', None, None, None), 1),
+        )
+        for product, count in lines:
+            Basket.objects.create(user='token', product=product, count=count)
+        # строка заказа считается по цене, зафиксированной при оформлении
+        Basket.objects.filter(product=lines[-1][0]).update(price=Decimal('0.01'))
+        total = get_order_total(Basket.objects.filter(user='token'))
+        self.assertIsInstance(total, Decimal)
+        self.assertEqual(str(total), '160.67')
+        self.assertEqual(str(get_order_total(Basket.objects.none())), '0.00')
+
+
+class PaymentValidatorTestCase(TestCase):
+    """
+    Проверки данных карты выполняются по очереди и возвращают текст первой ошибки
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.product = Product.objects.create(category=subcategory, title='product', price=Decimal('10.00'), count=2)
+        self.order = Order.objects.create(user_auth_user=self.user, status='confirmed')
+        Basket.objects.create(user_auth_user=self.user, product=self.product, count=2, order=self.order, archived=True)
+
+    def test_valid_card(self):
+        self.assertIsNone(payment_validator.validate_card(PAYMENT_DATA))
+        self.assertIsNone(payment_validator.validate_card({**PAYMENT_DATA, 'year': '99'}))
+        self.assertIsNone(payment_validator.validate_card({**PAYMENT_DATA, 'number': 12345678, 'code': 123}))
+        self.assertIsNone(payment_validator.validate(self.order, PAYMENT_DATA))
+
+    def test_card_errors(self):
+        today = timezone.now().date()
+        last_month = today.replace(day=1) - timedelta(days=1)
+        cases = (
+            ({'name': ''}, 'Not all data available'),
+            ({'code': None}, 'Not all data available'),
+            ({'number': '12345677'}, 'Invalid card number'),
+            ({'number': '1234568'}, 'Invalid card number'),
+            ({'number': '1234567a'}, 'Invalid card number'),
+            ({'code': '12'}, 'Incorrect CVV code'),
+            ({'month': 'dec'}, 'date must be a number'),
+            ({'name': '   '}, 'wrong name'),
+            ({'month': '13'}, 'wrong date'),
+            ({'month': str(last_month.month), 'year': str(last_month.year)}, 'The card has expired'),
+            ({'number': '12345677', 'code': '12', 'name': '   '}, 'Invalid card number'),
+        )
+        for change, error in cases:
+            with self.subTest(change=change):
+                self.assertEqual(payment_validator.validate_card({**PAYMENT_DATA, **change}), error)
+        self.assertIsNone(
+            payment_validator.validate_card({**PAYMENT_DATA, 'month': str(today.month), 'year': str(today.year)})
+        )
+
+    def test_stock_error(self):
+        Product.objects.filter(pk=self.product.pk).update(count=1)
+        self.assertEqual(payment_validator.validate_stock(self.order), 'Not enough goods in stock')
+        self.assertEqual(payment_validator.validate(self.order, PAYMENT_DATA), 'Not enough goods in stock')
+        self.assertEqual(payment_validator.validate(self.order, {**PAYMENT_DATA, 'code': '1'}), 'Incorrect CVV code')
+
+    def test_payment_api_rejects_card(self):
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse('shopapp:payment-api', kwargs={'id': self.order.pk}),
+            {**PAYMENT_DATA, 'number': '12345677'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Invalid card number'})
+        self.assertFalse(PaymentJob.objects.exists())
+
+
+class GenerateDatasetTestCase(TestCase):
+    """
+    generate_dataset: количество созданных объектов, пересчитанные рейтинги и суммы заказов
+    """
+    options = dict(
+        categories=2, subcategories=3, products=20, tags=5, images=2, reviews=4, users=4, baskets=10, orders=5,
+        seed=7, chunk_size=7
+    )
+
+    def generate(self) -> str:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('generate_dataset', **self.options)
+        return output.getvalue()
+
+    def test_counts_and_ratings(self):
+        output = self.generate()
+        self.assertIn('products indexed: 20', output)
+        self.assertTrue(output.strip().splitlines()[-1].startswith('ok'))
+        self.assertEqual(
+            (Category.objects.count(), SubCategory.objects.count(), Tag.objects.count()),
+            (2, 3, 5)
+        )
+        self.assertEqual((Product.objects.count(), ProductImage.objects.count()), (20, 40))
+        self.assertEqual((User.objects.count(), Profile.objects.count()), (4, 4))
+        self.assertTrue(User.objects.first().check_password('dataset-password'))
+
+        for product in Product.objects.all():
+            rates = list(product.reviews.values_list('rate', flat=True))
+            self.assertEqual(
+                (product.reviews_count, product.rating_sum, product.rating_count),
+                (len(rates), sum(rates), len(rates))
+            )
+            # ROUND в SQLite округляет половину от нуля, как и пересчёт рейтинга в сигналах отзывов
+            rating = (Decimal(sum(rates)) / len(rates)).quantize(Decimal('0.1'), ROUND_HALF_UP) if rates else None
+            self.assertEqual(product.rating, rating, product.title)
+
+        active = Basket.objects.filter(archived=False)
+        self.assertTrue(0 < active.count() <= 10)
+        self.assertEqual(active.values('user_auth_user', 'product').distinct().count(), active.count())
+
+        self.assertEqual(Order.objects.count(), 5)
+        for order in Order.objects.all():
+            lines = list(order.products.values_list('count', 'price', 'title'))
+            self.assertTrue(1 <= len(lines) <= 5)
+            self.assertTrue(all(price is not None and title for count, price, title in lines))
+            self.assertEqual(order.totalCost, sum(count * price for count, price, title in lines))
+        self.assertEqual(search_products('product', Product.objects.all(), 0, 50), list(
+            Product.objects.order_by('pk').values_list('pk', flat=True)
+        ))
+
+    def test_same_seed_is_skipped(self):
+        self.generate()
+        self.assertIn('has already been generated', self.generate())
+        self.assertEqual(Product.objects.count(), 20)
+
+
+class ProductDetailConditionalTestCase(TestCase):
+    """
+    Валидаторы полного представления продукта (Last-Modified, ETag) меняются при изменениях без Product.save():
+    списание остатка при оплате, добавление тега, правка отзыва
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='password')
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.product = Product.objects.create(
+            category=subcategory,
+            title='product',
+            price=Decimal('10.00'),
+            count=5
+        )
+        self.url = reverse('shopapp:product-api', kwargs={'id': self.product.pk})
+
+    def get_last_modified(self) -> str:
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        return response['Last-Modified']
+
+    def assert_modified(self, last_modified: str, change) -> dict:
+        # Смена версии сдвигается на 5 секунд вперёд: Last-Modified передаётся с точностью до секунды
+        with mock.patch('shopapp.cache.time.time_ns', return_value=time.time_ns() + 5 * 10 ** 9):
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_payment_moves_last_modified(self):
+        order = Order.objects.create(user_auth_user=self.user, status='confirmed')
+        Basket.objects.create(
+            user_auth_user=self.user,
+            product=self.product,
+            count=2,
+            order=order,
+            archived=True,
+            price=self.product.price
+        )
+        data = self.assert_modified(self.get_last_modified(), lambda: pay_order(order))
+        self.assertEqual(data['count'], 3)
+
+    def test_tag_moves_last_modified(self):
+        tag = Tag.objects.create(name='tag')
+        data = self.assert_modified(self.get_last_modified(), lambda: self.product.tags.add(tag))
+        self.assertEqual([item['id'] for item in data['tags']], [tag.pk])
+
+
+    def test_review_text_edit_changes_detail(self):
+        review = Reviews.objects.create(product_review=self.product, author='author', text='old text', rate=5)
+        self.client.get(self.url)
+
+        def edit_text():
+            review.text = 'new text'
+            review.save()
+
+        data = self.assert_modified(self.get_last_modified(), edit_text)
+        self.assertEqual([item['text'] for item in data['reviews']], ['new text'])
+
+
+    def test_review_edit_invalidates_etag(self):
+        review = Reviews.objects.create(product_review=self.product, author='author', text='old text', rate=5)
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        review.author = 'editor'
+        with self.captureOnCommitCallbacks(execute=True):
+            review.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([item['author'] for item in response.json()['reviews']], ['editor'])
+
+
+def get_facet_row(pk: int, price: float, subcategory: int = 1, tags: tuple = ()) -> dict:
+    return dict(
+        pk=pk,
+        subcategory=subcategory,
+        category=1,
+        tags=tags,
+        free_delivery=False,
+        available=True,
+        keys=dict(date=float(pk), price=price, rating=-1.0, reviews_count=0.0)
+    )
+
+
+class FacetSnapshotTestCase(TestCase):
+    """
+    Маска фильтра по цене, собранная из диапазонов цен, совпадает с прямым перебором
+    """
+
+    def assert_price_masks(self, snapshot: FacetSnapshot, prices: dict) -> None:
+        bounds = sorted(set(prices.values()))
+        for min_price, max_price in [(0, 50000), (bounds[0], bounds[-1]), (bounds[3], bounds[3])] + [
+            tuple(sorted(random.sample(range(0, 1100), 2))) for _ in range(200)
+        ]:
+            mask = snapshot._price_mask(float(min_price), float(max_price))
+            expected = {pk for pk, price in prices.items() if min_price <= price <= max_price}
+            found = {snapshot.ids[position] for position in range(len(snapshot.ids)) if mask >> position & 1}
+            self.assertEqual(found, expected, (min_price, max_price))
+
+    def test_price_mask(self):
+        random.seed(0)
+        prices = {pk: float(random.randint(1, 1000)) for pk in range(1, 2001)}
+        snapshot = FacetSnapshot([get_facet_row(pk, price) for pk, price in prices.items()])
+        self.assert_price_masks(snapshot, prices)
+        changed = set(random.sample(sorted(prices), 300))
+        for pk in changed:
+            prices[pk] = float(random.randint(0, 1100))
+        removed = set(random.sample(sorted(changed), 50))
+        for pk in removed:
+            del prices[pk]
+        snapshot.update([get_facet_row(pk, prices[pk]) for pk in sorted(changed - removed)], changed)
+        self.assert_price_masks(snapshot, prices)
+
+    def test_query_pages(self):
+        random.seed(1)
+        rows = {
+            pk: get_facet_row(pk, float(random.randint(1, 50)), subcategory=1 if pk % 97 else 2)
+            for pk in range(1, 3001)
+        }
+        snapshot = FacetSnapshot(list(rows.values()))
+        changed = set(random.sample(sorted(rows), 200))
+        for pk in changed:
+            rows[pk] = get_facet_row(pk, float(random.randint(1, 50)), subcategory=1 if pk % 97 else 2)
+        snapshot.update([rows[pk] for pk in sorted(changed)], changed)
+        # Подкатегория 2 — разреженная маска (перебор битов), без фильтра — плотная (проход по массиву сортировки)
+        for category, pks in ((None, sorted(rows)), (2, [pk for pk in sorted(rows) if not pk % 97])):
+            data_request = QueryDict(mutable=True)
+            if category:
+                data_request['category'] = category
+            for sort in ('price', '-price'):
+                expected = sorted(pks, key=lambda pk: (rows[pk]['keys']['price'], pk), reverse=sort == '-price')
+                for page in (1, 2, 3, 1000):
+                    data = snapshot.query(data_request, sort, page, 10)
+                    start = (data['currentPage'] - 1) * 10
+                    self.assertEqual(data['ids'], expected[start:start + 10], (category, sort, page))
+
+    def test_needs_compaction(self):
+        rows = [get_facet_row(pk, float(pk)) for pk in range(1, 11)]
+        snapshot = FacetSnapshot(rows)
+        for _ in range(COMPACTION_MIN_GARBAGE // 10):
+            snapshot.update(rows, {row['pk'] for row in rows})
+        self.assertFalse(snapshot.needs_compaction())
+        snapshot.update(rows, {row['pk'] for row in rows})
+        self.assertTrue(snapshot.needs_compaction())
+        self.assertEqual(snapshot.query(QueryDict(), 'price', 1, 3)['ids'], [1, 2, 3])
+
+
+@override_settings(CATALOG_FACET_INDEX_BACKGROUND_REBUILD=False)
+class FacetIndexTestCase(TestCase):
+    """
+    Страницы каталога из фасетного индекса совпадают со страницами, выбранными SQL
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='category')
+        cls.subcategories = [
+            SubCategory.objects.create(title=f'subcategory {index}', category=category) for index in range(2)
+        ]
+        cls.tag = Tag.objects.create(name='tag')
+        for index in range(30):
+            product = Product.objects.create(
+                category=cls.subcategories[index % 2],
+                title=f'product {index}',
+                price=Decimal(index * 7 % 30 + 1),
+                count=index % 3,
+                freeDelivery=index % 4 == 0
+            )
+            if index % 3 == 0:
+                product.tags.add(cls.tag)
+
+    def setUp(self):
+        cache.clear()
+        catalog_facet_index.rebuild()
+
+    def get_catalog(self, params: dict, facet_index_enabled: bool) -> dict:
+        cache.clear()
+        with override_settings(CATALOG_FACET_INDEX_ENABLED=facet_index_enabled):
+            response = self.client.get(reverse('shopapp:catalog-api'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def assert_same_pages(self, params: dict) -> None:
+        from_index = self.get_catalog(params, True)
+        from_sql = self.get_catalog(params, False)
+        self.assertEqual(from_index['lastPage'], from_sql['lastPage'], params)
+        self.assertEqual(
+            [item['price'] for item in from_index['items']],
+            [item['price'] for item in from_sql['items']],
+            params
+        )
+
+    def test_pages_match_sql(self):
+        for sort_type in ('dec', 'inc'):
+            for page in ('1', '2', '5'):
+                for extra in (
+                        {},
+                        {'filter[available]': 'true'},
+                        {'filter[freeDelivery]': 'true'},
+                        {'tags[]': [self.tag.pk]},
+                        {'category': self.subcategories[1].pk},
+                        {'category': int(self.subcategories[0].category_id + 10e6)},
+                ):
+                    self.assert_same_pages({
+                        'filter[minPrice]': 5,
+                        'filter[maxPrice]': 20,
+                        'sort': 'price',
+                        'sortType': sort_type,
+                        'limit': 4,
+                        'currentPage': page,
+                        **extra
+                    })
+
+    def test_unindexed_sort_uses_sql(self):
+        data = self.get_catalog({'sort': 'title', 'sortType': 'inc', 'limit': 3}, True)
+        self.assertEqual([item['title'] for item in data['items']], ['product 0', 'product 1', 'product 10'])
+
+    def test_refresh_applies_changes(self):
+        product = Product.objects.get(title='product 1')
+        Product.objects.filter(pk=product.pk).update(price=Decimal('100.00'))
+        product.tags.add(self.tag)
+        catalog_facet_index.refresh({product.pk})
+        params = {'filter[minPrice]': 0, 'filter[maxPrice]': 1000, 'tags[]': [self.tag.pk], 'sort': 'price', 'limit': 50}
+        self.assert_same_pages(params)
+        self.assertEqual(self.get_catalog(params, True)['items'][0]['id'], product.pk)
+
+
+@override_settings(CATALOG_FACET_INDEX_BACKGROUND_REBUILD=True, CATALOG_FACET_INDEX_MAX_AGE=0)
+class FacetIndexRebuildTestCase(TransactionTestCase):
+    """
+    Перестройка индекса идёт в фоновом потоке, запросы не ждут её
+    """
+
+    def test_background_rebuild(self):
+        category = Category.objects.create(title='category')
+        subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        Product.objects.create(category=subcategory, title='first', price=Decimal('10.00'))
+        index = FacetIndex()
+        data_request = QueryDict()
+        self.assertIsNone(index.query(data_request, 'price', 1, 10))
+        index._rebuild_thread.join(10)
+        first_pk = Product.objects.get(title='first').pk
+        second_pk = Product.objects.create(category=subcategory, title='second', price=Decimal('5.00')).pk
+        self.assertIn(index.query(data_request, 'price', 1, 10)['ids'], ([first_pk], [second_pk, first_pk]))
+        index._rebuild_thread.join(10)
+        self.assertEqual(index.query(data_request, 'price', 1, 10)['ids'], [second_pk, first_pk])
+        index._rebuild_thread.join(10)
+
+
+class IdempotentCounterView(APIView):
+    calls = 0
+    response_status = status.HTTP_200_OK
+
+    @idempotent
+    def post(self, request, *args, **kwargs):
+        IdempotentCounterView.calls += 1
+        if self.response_status is None:
+            raise RuntimeError('view failed')
+        return Response(data={'calls': IdempotentCounterView.calls}, status=self.response_status)
+
+
+class IdempotencyTestCase(TestCase):
+    """
+    Повтор с тем же Idempotency-Key получает сохранённый ответ, незавершённый запрос - 409,
+    брошенный запрос и ответы 5xx не мешают повтору
+    """
+
+    def setUp(self):
+        IdempotentCounterView.calls = 0
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.factory = APIRequestFactory()
+
+    def post(self, key: str = 'key', user: User = None, session: dict = None, response_status=status.HTTP_200_OK):
+        request = self.factory.post('/api/orders', {}, format='json', HTTP_IDEMPOTENCY_KEY=key)
+        request.session = session if session is not None else {}
+        force_authenticate(request, user=user or self.user)
+        return IdempotentCounterView.as_view(response_status=response_status)(request)
+
+    def test_replay(self):
+        first = self.post()
+        second = self.post()
+        self.assertEqual(IdempotentCounterView.calls, 1)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second[IDEMPOTENCY_REPLAYED_HEADER], 'true')
+        self.post(key='other')
+        self.assertEqual(IdempotentCounterView.calls, 2)
+
+    def test_in_progress_conflict(self):
+        self.post()
+        IdempotencyKey.objects.update(status_code=None, response=None)
+        self.assertEqual(self.post().status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(IdempotentCounterView.calls, 1)
+
+    @override_settings(IDEMPOTENCY_LOCK_TIMEOUT=60)
+    def test_abandoned_key_taken_over(self):
+        self.post()
+        IdempotencyKey.objects.update(
+            status_code=None,
+            response=None,
+            created_at=timezone.now() - timedelta(seconds=61)
+        )
+        response = self.post()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'calls': 2})
+        self.assertEqual(IdempotencyKey.objects.get().status_code, status.HTTP_200_OK)
+
+    def test_server_error_released(self):
+        self.assertEqual(self.post(response_status=status.HTTP_502_BAD_GATEWAY).status_code, 502)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        with self.assertRaises(RuntimeError):
+            self.post(response_status=None)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.post().data, {'calls': 3})
+
+    def test_anonymous_owners(self):
+        anonymous = AnonymousUser()
+        self.post(user=anonymous)
+        self.post(user=anonymous)
+        self.assertEqual(IdempotentCounterView.calls, 2)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.post(user=anonymous, session={'user': 'first'})
+        self.post(user=anonymous, session={'user': 'second'})
+        self.post(user=anonymous, session={'user': 'first'})
+        self.assertEqual(IdempotentCounterView.calls, 4)
+
+
+class SearchTestCase(TestCase):
+    """
+    Поиск по индексу FTS5: совпадение по началу слова, сортировка по релевантности, обновление индекса
+    """
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(title='category')
+        self.subcategory = SubCategory.objects.create(title='subcategory', category=category)
+        self.once = self.create_product('Phone case', 'Leather')
+        self.often = self.create_product('Phone', 'Phone holder for phone')
+        self.pineapple = self.create_product('Pineapple', 'Fruit')
+
+    def create_product(self, title: str, description: str) -> Product:
+        return Product.objects.create(
+            category=self.subcategory,
+            title=title,
+            description=description,
+            price=Decimal('10.00'),
+            count=1
+        )
+
+    def search(self, text: str, **params) -> dict:
+        cache.clear()
+        params = {'filter[name]': text, 'sort': 'relevance', 'limit': 10, **params}
+        response = self.client.get(reverse('shopapp:catalog-api'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def get_ids(self, text: str, **params) -> list:
+        return [item['id'] for item in self.search(text, **params)['items']]
+
+    def test_word_boundary(self):
+        self.assertEqual(self.get_ids('apple'), [])
+        self.assertEqual(self.get_ids('pine'), [self.pineapple.pk])
+        self.assertEqual(self.get_ids('cas'), [self.once.pk])
+
+    def test_relevance_order(self):
+        self.assertEqual(self.get_ids('phone'), [self.often.pk, self.once.pk])
+        data = self.search('phone', limit=1)
+        self.assertEqual((data['currentPage'], data['lastPage']), (1, 2))
+        self.assertEqual(self.get_ids('phone', limit=1, currentPage=2), [self.once.pk])
+        self.assertEqual(self.get_ids('phone', **{'filter[maxPrice]': 5, 'filter[minPrice]': 0}), [])
+
+    def test_relevance_cursor(self):
+        first = self.search('phone', limit=1, cursor='')
+        second = self.search('phone', limit=1, cursor=first['nextCursor'])
+        self.assertEqual([first['items'][0]['id'], second['items'][0]['id']], [self.often.pk, self.once.pk])
+        self.assertIsNone(second['nextCursor'])
+        cache.clear()
+        response = self.client.get(
+            reverse('shopapp:catalog-api'),
+            {'filter[name]': 'phone', 'sort': 'relevance', 'cursor': 'broken'}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_index_follows_save_and_delete(self):
+        self.pineapple.title = 'Mango'
+        self.pineapple.save()
+        self.assertEqual(search_products('pine', Product.objects.all(), 0, 10), [])
+        self.assertEqual(search_products('mango', Product.objects.all(), 0, 10), [self.pineapple.pk])
+        self.often.delete()
+        self.assertEqual(search_products('phone', Product.objects.all(), 0, 10), [self.once.pk])
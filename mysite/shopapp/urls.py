@@ -11,7 +11,8 @@ from .viewsapi import (
     BasketAPIView,
     OrdersAPIView,
     OrderAPIView,
-    PaymentAPIView, SalesAPIView, BannersAPIView
+    PaymentAPIView, SalesAPIView, BannersAPIView,
+    PaymentJobAPIView,
 )
 
 app_name = "shopapp"
@@ -28,6 +29,7 @@ urlpatterns = [
     path('api/banners', BannersAPIView.as_view(), name='banners-api'),
     path('api/order/<int:id>', OrderAPIView.as_view(), name='order-id-api'),
     path('api/payment/<int:id>', PaymentAPIView.as_view(), name='payment-api'),
+    path('api/payment-job/<int:id>', PaymentJobAPIView.as_view(), name='payment-job-api'),
     path('api/product/<int:id>', ProductAPIView.as_view(), name='product-api'),
     path('api/product/<int:id>/reviews', ProductReviewAPIView.as_view(), name='product-review-api'),
 ]
@@ -2,30 +2,66 @@ import operator
 import random
 from datetime import datetime
 from functools import reduce
+from typing import Optional
 
 from django.core.paginator import Paginator
-from django.db.models import Count, Q
+from django.db.models import F, Max, Q, QuerySet
+from django.http import Http404, QueryDict
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from rest_framework import status
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import Category, Product, Tag, Basket, Order
+from .cache import (
+    get_catalog_cache_key,
+    get_cached_catalog,
+    set_cached_catalog,
+    get_product_detail_cache_key,
+    get_product_versions,
+    get_version_time,
+    get_cached_product_detail,
+    set_cached_product_detail,
+)
+from .facets import catalog_facet_index, facet_index_enabled
+from .idempotency import idempotent
+from .models import Category, Product, Tag, Basket, Order, PaymentJob
+from .payments import enqueue_payment, get_public_status
+from .search import count_search_results, search_products
 from .serializers import (
     CategorySerializer,
     ProductSerializer,
     TagSerializer,
     ReviewsSerializer,
-    BasketSerializer,
-    OrderSerializer, SaleProductSerializer
+    OrderSerializer, SaleProductSerializer,
+    get_short_products_data,
+    get_reviews_page_data,
+    REVIEWS_PAGE_SIZE,
+    ORDERS_PAGE_SIZE,
 )
 from .services import (
     get_popular_tags,
     get_filter_param,
+    get_keyset_page,
+    encode_cursor,
+    decode_cursor,
     get_user_param_no_create_token,
     get_user_param_create_token,
-    get_fullname_email_phone, PymentValidator, get_price_or_sale_price,
+    get_fullname_email_phone, payment_validator,
+    reconcile_baskets_with_stock,
+    get_basket_lines,
+    get_order_lines,
+    upsert_basket_line,
+    get_anonymous_basket_store,
+    add_to_basket_store,
+    reconcile_counts_with_stock,
+    get_basket_lines_from_counts,
+    persist_anonymous_basket,
+    get_order_total,
+    snapshot_basket_lines,
+    reserve_order,
 )
 
 
@@ -45,17 +81,33 @@ class ProductAPIView(APIView):
             'tags',
             'images',
             'specifications',
-            'reviews',
-            'reviews__author_auth_user'
-        )
+        ).
+        annotate(last_review_date=Max('reviews__date'))
     )
     serializer_class = ProductSerializer
 
     def get(self, request: Request, *args, **kwargs) -> Response:
         product_pk = kwargs['id']
-        product = get_object_or_404(self.queryset, pk=product_pk)
-        response_data = self.serializer_class(product)
-        return Response(response_data.data)
+        version = get_product_versions([product_pk])[product_pk]
+        cache_key = get_product_detail_cache_key(product_pk, version)
+        detail = get_cached_product_detail(cache_key)
+        if detail is None:
+            product = get_object_or_404(self.queryset, pk=product_pk)
+            response_data = self.serializer_class(product)
+            # Остатки, рейтинг, изображения, теги и характеристики меняются без Product.date,
+            # но каждое такое изменение меняет версию продукта, а версия — это время смены
+            last_modified = max(product.date, product.last_review_date or product.date, get_version_time(version))
+            detail = set_cached_product_detail(cache_key, dict(response_data.data), last_modified)
+        response = get_conditional_response(
+            request,
+            etag=detail['etag'],
+            last_modified=detail['last_modified']
+        )
+        if response is None:
+            response = Response(detail['data'])
+        response['ETag'] = detail['etag']
+        response['Last-Modified'] = http_date(detail['last_modified'])
+        return response
 
 
 class TagsCategoryAPIView(APIView):
@@ -80,40 +132,124 @@ class TagsCategoryAPIView(APIView):
 
 class CatalogAPIView(APIView):
     serializer_class = ProductSerializer
-    queryset = Product.objects.select_related('category').prefetch_related('tags', 'images', 'reviews')
+    queryset = Product.objects.select_related('category').prefetch_related('tags', 'images')
 
     def get(self, request: Request, *args, **kwargs) -> Response:
         data_request = request.GET
+        cache_key = get_catalog_cache_key(data_request)
+        data = get_cached_catalog(cache_key)
+        if data is None:
+            data = self.get_catalog_data(data_request)
+            if data is None:
+                message_error = {'error': 'Incorrect data'}
+                return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+            set_cached_catalog(cache_key, data)
+        return Response(data=data)
 
+    def get_catalog_data(self, data_request: QueryDict) -> Optional[dict]:
         filter_param = get_filter_param(data_request)
 
         current_page = data_request.get('currentPage', 1)
         limit = data_request.get('limit', 20)
 
         sort = data_request.get('sort', 'date')
-        sort = 'reviews_all' if sort == 'reviews' else sort
+        sort = 'reviews_count' if sort == 'reviews' else sort
         sort_type = data_request.get('sortType', 'dec')
-        sort = f"-{sort}" if sort_type == 'dec' else sort
 
-        products = self.queryset.annotate(reviews_all=Count('reviews')).filter(
-            reduce(operator.and_, filter_param)
-        ).order_by(sort)
+        products = Product.objects.filter(reduce(operator.and_, filter_param, Q()))
+        cursor = data_request.get('cursor', None)
+        if sort == 'relevance':
+            data = self.get_relevance_data(data_request, products, current_page, int(limit), cursor)
+            if data is not False:
+                return data
+            sort = 'date'
+        sort = f"-{sort}" if sort_type == 'dec' else sort
 
-        paginator = Paginator(products, limit)
+        page = None
+        if facet_index_enabled() and cursor is None and not data_request.get('filter[name]'):
+            # Пока первый снимок индекса строится в фоне, query вернёт None и страница выбирается SQL
+            page = catalog_facet_index.query(data_request, sort, current_page, int(limit))
+        if page is not None:
+            return dict(
+                items=get_short_products_data(page['ids'], self.queryset),
+                currentPage=page['currentPage'],
+                lastPage=page['lastPage']
+            )
+
+        products = products.order_by(sort)
+
+        if cursor is not None:
+            try:
+                page, next_cursor = get_keyset_page(products, sort, cursor, int(limit))
+            except ValueError:
+                return None
+            return dict(
+                items=get_short_products_data([product.pk for product in page], self.queryset),
+                nextCursor=next_cursor
+            )
+
+        paginator = Paginator(products.values_list('pk', flat=True), limit)
         page_odj = paginator.get_page(current_page)
 
-        serializer_data = self.serializer_class(page_odj, many=True, read_only=True, context={'short': True})
-        data = dict(
-            items=serializer_data.data,
+        return dict(
+            items=get_short_products_data(list(page_odj), self.queryset),
+            currentPage=current_page,
+            lastPage=paginator.page_range[-1]
+        )
+
+    def get_relevance_data(
+            self, data_request: QueryDict, products: QuerySet, current_page, limit: int, cursor: Optional[str]
+    ):
+        """
+        Страница каталога, отсортированная по релевантности поиска (sort=relevance).
+        Курсор в этом режиме хранит смещение следующей страницы
+        :param data_request:
+        :param products: отфильтрованный queryset продуктов
+        :param current_page:
+        :param limit:
+        :param cursor:
+        :return: данные ответа, None для повреждённого курсора
+        или False, если поиск по индексу недоступен (тогда каталог сортируется по дате)
+        """
+        text = data_request.get('filter[name]', '')
+        if cursor is not None:
+            offset = 0
+            if cursor:
+                values = decode_cursor(cursor)
+                if values is None or values[0] != 'relevance' or values[1] < 0:
+                    return None
+                offset = values[1]
+            page = search_products(text, products, offset, limit + 1)
+            if page is None:
+                return False
+            next_cursor = encode_cursor(['relevance', offset + limit]) if len(page) > limit else None
+            return dict(items=get_short_products_data(page[:limit], self.queryset), nextCursor=next_cursor)
+        total = count_search_results(text, products)
+        if total is None:
+            return False
+        paginator = Paginator(range(total), limit)
+        offset = max(paginator.get_page(current_page).start_index() - 1, 0)
+        return dict(
+            items=get_short_products_data(search_products(text, products, offset, limit), self.queryset),
             currentPage=current_page,
             lastPage=paginator.page_range[-1]
         )
-        return Response(data=data)
 
 
 class ProductReviewAPIView(APIView):
     serializer_class = ReviewsSerializer
-    queryset = Product.objects.prefetch_related('reviews', 'reviews__author_auth_user')
+    queryset = Product.objects.only('pk', 'reviews_count')
+
+    def get(self, request: Request, *args, **kwargs) -> Response:
+        product = get_object_or_404(self.queryset, pk=kwargs['id'])
+        try:
+            limit = min(int(request.GET.get('limit', REVIEWS_PAGE_SIZE)), 100)
+            reviews_page = get_reviews_page_data(product.pk, request.GET.get('cursor', ''), limit)
+        except ValueError:
+            message_error = {'error': 'Incorrect data'}
+            return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+        reviews_page['count'] = product.reviews_count
+        return Response(reviews_page)
 
     def post(self, request: Request, *args, **kwargs) -> Response:
         user = request.user
@@ -131,78 +267,77 @@ class ProductReviewAPIView(APIView):
             message_error = {'error': 'Incorrect data'}
             return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
         review = review_serializer.create(data)
-        product.reviews.add(review)
-        response_data = self.serializer_class(instance=product.reviews, many=True, read_only=True)
-        return Response(response_data.data)
+        product_data = Product.objects.values('rating', 'reviews_count').get(pk=product.pk)
+        response_data = dict(
+            review=self.serializer_class(instance=review, read_only=True).data,
+            rating=product_data['rating'],
+            reviewsCount=product_data['reviews_count']
+        )
+        return Response(response_data)
 
 
 class ProductPopularAPIView(APIView):
-    queryset = Product.objects.prefetch_related('tags', 'images', 'reviews', 'specifications')
+    queryset = Product.objects.prefetch_related('tags', 'images')
     serializer_class = ProductSerializer
 
     def get(self, request: Request, *args, **kwargs) -> Response:
-        products = self.queryset.filter(count__gt=0).order_by('-rating')[:4]
-        serializer_data = self.serializer_class(products, many=True, context={'short': True})
-        return Response(serializer_data.data)
+        product_pks = Product.objects.filter(count__gt=F('reserved')).order_by('-rating').values_list('pk', flat=True)[:4]
+        response_data = get_short_products_data(list(product_pks), self.queryset)
+        return Response(response_data)
 
 
 class ProductLimitedAPIView(APIView):
-    queryset = Product.objects.prefetch_related('tags', 'images', 'reviews', 'specifications')
+    queryset = Product.objects.prefetch_related('tags', 'images')
     serializer_class = ProductSerializer
 
     def get(self, request: Request, *args, **kwargs) -> Response:
-        products = self.queryset.filter(count__range=[1, 5]).order_by('count')
-        paginator = Paginator(products, 4)
+        product_pks = Product.objects.annotate(available=F('count') - F('reserved')).filter(
+            available__range=[1, 5]
+        ).order_by('available').values_list('pk', flat=True)
+        paginator = Paginator(product_pks, 4)
         list_page = list(paginator.page_range)
         current_page = random.randint(list_page[0], list_page[-1])
         page_odj = paginator.get_page(current_page)
-        serializer_data = self.serializer_class(page_odj, many=True, context={'short': True})
-        return Response(serializer_data.data)
+        response_data = get_short_products_data(list(page_odj), self.queryset)
+        return Response(response_data)
 
 
 class BasketAPIView(APIView):
-    queryset = Basket.objects.prefetch_related(
-        'product__reviews',
-        'product__tags',
-        'product__images',
-        'product__specifications'
-    )
-    serializer_class = BasketSerializer
+    queryset = Basket.objects.all()
 
     def get(self, request: Request, *args, **kwargs) -> Response:
         user_param = get_user_param_no_create_token(request)
         if user_param is None:
             return Response(status=status.HTTP_200_OK)
+        store = get_anonymous_basket_store(request, user_param)
+        if store is not None:
+            counts = reconcile_counts_with_stock(store.get())
+            store.set(counts)
+            return Response(get_basket_lines_from_counts(counts))
+        reconcile_baskets_with_stock(Basket.objects.filter(Q(archived=False) & Q(**user_param)))
         baskets = self.queryset.filter(Q(archived=False) & Q(**user_param))
-        for basket in baskets:
-            if basket.product.count == 0:
-                basket.delete()
-            elif basket.product.count < basket.count:
-                basket.count = basket.product.count
-                basket.save()
-        response = self.serializer_class(baskets, many=True).data
+        response = get_basket_lines(baskets)
         return Response(response)
 
     def post(self, request: Request, *args, **kwargs) -> Response:
         user_param = get_user_param_create_token(request)
         product_id = request.data['id']
         count = request.data['count']
-        product = get_object_or_404(Product, pk=product_id)
-        if int(product.count) > 0:
-            basket, created = Basket.objects.get_or_create(product=product, archived=False, **user_param)
-            new_count = int(basket.count) + int(count)
-            if int(product.count) >= new_count > 0:
-                basket.count = new_count
-            elif new_count > int(product.count):
-                basket.count = product.count
-            else:
-                basket.count = 1
-            basket.save()
+        store = get_anonymous_basket_store(request, user_param)
+        if store is not None:
+            line = add_to_basket_store(store, int(product_id), int(count))
         else:
+            line = upsert_basket_line(user_param, int(product_id), int(count))
+        if line is None:
+            get_object_or_404(Product, pk=product_id)
             message_error = {'error': 'Out of products'}
             return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+        if request.GET.get('lineOnly') == 'true':
+            return Response(line)
+        if store is not None:
+            return Response(get_basket_lines_from_counts(store.get()))
         baskets = self.queryset.filter(Q(archived=False) & Q(**user_param))
-        response = self.serializer_class(baskets, many=True).data
+        response = get_basket_lines(baskets)
 
         return Response(response)
 
@@ -213,6 +348,14 @@ class BasketAPIView(APIView):
             return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
         product_id = request.data['id']
         count = request.data['count']
+        store = get_anonymous_basket_store(request, user_param)
+        if store is not None:
+            counts = store.get()
+            if int(product_id) not in counts:
+                raise Http404
+            counts[int(product_id)] -= int(count)
+            store.set(counts)
+            return Response(get_basket_lines_from_counts(store.get()))
         product = get_object_or_404(Product, pk=product_id)
         basket = get_object_or_404(Basket, product=product, archived=False, **user_param)
         new_count = int(basket.count) - int(count)
@@ -222,46 +365,47 @@ class BasketAPIView(APIView):
             basket.count = new_count
             basket.save()
         baskets = self.queryset.filter(Q(archived=False) & Q(**user_param))
-        response = self.serializer_class(baskets, many=True).data
+        response = get_basket_lines(baskets)
         return Response(response)
 
 
 class OrdersAPIView(APIView):
-    order_queryset = (
-        Order.objects.
-        select_related(
-            'user_auth_user__profile',
-        ).
-        prefetch_related(
-            'products__product__tags',
-            'products__product__images',
-            'products__product__reviews',
-            'products__product__specifications'
-        )
-    )
-    basket_queryset = Basket.objects.prefetch_related(
-        'product__reviews',
-        'product__tags',
-        'product__images',
-        'product__specifications'
-    )
+    order_queryset = Order.objects.all()
+    basket_queryset = Basket.objects.all()
     serializer_class = OrderSerializer
 
     def get(self, request: Request, *args, **kwargs) -> Response:
         user_param = get_user_param_no_create_token(request)
         if not user_param:
-            return Response(status=status.HTTP_200_OK)
-        orders = self.order_queryset.filter(**user_param)
-        response = self.serializer_class(orders, many=True).data
-        return Response(response)
+            return Response(dict(items=[], nextCursor=None))
+        try:
+            limit = min(int(request.GET.get('limit', ORDERS_PAGE_SIZE)), 100)
+            orders, next_cursor = get_keyset_page(
+                self.order_queryset.filter(**user_param),
+                '-id',
+                request.GET.get('cursor', ''),
+                limit
+            )
+        except ValueError:
+            message_error = {'error': 'Incorrect data'}
+            return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+        order_lines = get_order_lines([order.pk for order in orders])
+        items = self.serializer_class(orders, many=True, context={'order_lines': order_lines}).data
+        return Response(dict(items=items, nextCursor=next_cursor))
 
+    @idempotent
     def post(self, request: Request, *args, **kwargs) -> Response:
         user_param = get_user_param_no_create_token(request)
         if user_param is None:
             message_error = {'error': 'Incorrect data'}
             return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+        store = get_anonymous_basket_store(request, user_param)
+        if store is not None:
+            persist_anonymous_basket(store, **user_param)
+        reconcile_baskets_with_stock(Basket.objects.filter(Q(archived=False) & Q(**user_param)))
         baskets = self.basket_queryset.filter(Q(archived=False) & Q(**user_param))
-        if not baskets:
+        total_cost = get_order_total(baskets)
+        if not total_cost and not baskets.exists():
             message_error = {'error': 'Incorrect data'}
             return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
         user = user_param.get('user_auth_user')
@@ -275,29 +419,14 @@ class OrdersAPIView(APIView):
             'email': email,
             'phone': phone
         }
-        total_cost = round(sum([
-            float(get_price_or_sale_price(basket.product)) * int(basket.count)
-            for basket in baskets
-        ]), 1)
         order = Order.objects.create(status='created', totalCost=total_cost, **data_order, **user_param)
-        baskets.update(archived=True, order=order)
+        snapshot_basket_lines(baskets, archived=True, order=order)
         response_id = dict(orderId=order.pk)
         return Response(response_id)
 
 
 class OrderAPIView(APIView):
-    queryset = (
-        Order.objects.
-        select_related(
-            'user_auth_user__profile',
-        ).
-        prefetch_related(
-            'products__product__tags',
-            'products__product__images',
-            'products__product__reviews',
-            'products__product__specifications'
-        )
-    )
+    queryset = Order.objects.all()
     serializer_class = OrderSerializer
 
     def get(self, request: Request, *args, **kwargs) -> Response:
@@ -308,7 +437,8 @@ class OrderAPIView(APIView):
             message_error = {'error': 'Incorrect data'}
             return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
         order = get_object_or_404(self.queryset, pk=id_order, **user_param)
-        response_order = self.serializer_class(order)
+        order_lines = get_order_lines([order.pk])
+        response_order = self.serializer_class(order, context={'order_lines': order_lines})
         if (user.is_authenticated and
                 (response_order.data['fullName'] is None or response_order.data['fullName'].strip() == '')):
             full_name, email, phone = get_fullname_email_phone(user)
@@ -318,7 +448,7 @@ class OrderAPIView(APIView):
                 'phone': phone
             }
             order = response_order.update(order, data_order)
-            response_order = self.serializer_class(order)
+            response_order = self.serializer_class(order, context={'order_lines': order_lines})
         return Response(response_order.data)
 
     def post(self, request: Request, *args, **kwargs) -> Response:
@@ -340,10 +470,11 @@ class OrderAPIView(APIView):
         }
         order_serializer = self.serializer_class(data=order_data, instance=order)
         if order_serializer.is_valid():
-            order.totalCost = round(sum([
-                float(get_price_or_sale_price(basket.product)) * int(basket.count)
-                for basket in order.products.all()
-            ]), 1)
+            reservation_error = payment_validator.validate_stock(order) or reserve_order(order)
+            if reservation_error is not None:
+                message_error = {'error': reservation_error}
+                return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+            order.totalCost = get_order_total(order.products.all())
             order = order_serializer.update(order, order_data)
             order_data = {'orderId': order.pk}
         else:
@@ -353,21 +484,9 @@ class OrderAPIView(APIView):
 
 
 class PaymentAPIView(APIView):
-    queryset = (
-        Order.objects.
-        select_related(
-            'user_auth_user',
-            'user_auth_user__profile',
-        ).
-        prefetch_related(
-            'products__product__tags',
-            'products__product__images',
-            'products__product__reviews',
-            'products__product__specifications'
-        )
-    )
-    product_serializer_class = ProductSerializer
+    queryset = Order.objects.all()
 
+    @idempotent
     def post(self, request: Request, *args, **kwargs) -> Response:
         order_pk = kwargs.get('id')
         user_param = get_user_param_no_create_token(request)
@@ -375,19 +494,28 @@ class PaymentAPIView(APIView):
             message_error = {'error': 'Incorrect data'}
             return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
         order = get_object_or_404(self.queryset, pk=order_pk, **user_param)
-        pyment = PymentValidator(order=order, **request.data)
-        if pyment.is_valid:
-            baskets = order.products
-            products_list = []
-            for basket in baskets.all():
-                product = basket.product
-                product.count -= basket.count
-                products_list.append(product)
-            Product.objects.bulk_update(products_list, fields=['count'])
-            order.status = 'paid'
-            order.save()
-            return Response(status=status.HTTP_200_OK)
-        return Response(status=status.HTTP_400_BAD_REQUEST, data=pyment.messages_error)
+        payment_error = payment_validator.validate_card(request.data)
+        if payment_error is not None:
+            message_error = {'error': payment_error}
+            return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+        job = enqueue_payment(order)
+        job.refresh_from_db()
+        response = dict(jobId=job.pk, orderId=order.pk, status=get_public_status(job), error=job.error)
+        return Response(data=response, status=status.HTTP_202_ACCEPTED)
+
+
+class PaymentJobAPIView(APIView):
+    queryset = PaymentJob.objects.all()
+
+    def get(self, request: Request, *args, **kwargs) -> Response:
+        user_param = get_user_param_no_create_token(request)
+        if not user_param:
+            message_error = {'error': 'Incorrect data'}
+            return Response(data=message_error, status=status.HTTP_400_BAD_REQUEST)
+        order_param = {f'order__{key}': value for key, value in user_param.items()}
+        job = get_object_or_404(self.queryset, pk=kwargs.get('id'), **order_param)
+        response = dict(jobId=job.pk, orderId=job.order_id, status=get_public_status(job), error=job.error)
+        return Response(response)
 
 
 class SalesAPIView(APIView):
@@ -423,15 +551,13 @@ class BannersAPIView(APIView):
         prefetch_related(
             'tags',
             'images',
-            'specifications',
-            'reviews',
         )
     )
     serializer_class = ProductSerializer
 
     def get(self, request: Request, *args, **kwargs) -> Response:
-        count_products = self.queryset.count()
+        product_pks = Product.objects.order_by('pk').values_list('pk', flat=True)
+        count_products = product_pks.count()
         selected_numbers = random.sample(range(0, count_products - 1), k=3)
-        products = tuple(self.queryset.all()[i] for i in selected_numbers)
-        serializer_data = self.serializer_class(products, many=True, context={'short': True})
-        return Response(serializer_data.data)
+        response_data = get_short_products_data([product_pks[i] for i in selected_numbers], self.queryset)
+        return Response(response_data)